@@ -0,0 +1,7 @@
+import mirbuild
+project = mirbuild.CMakeProject('test')
+rules = mirbuild.packagers.DebianRules()
+rules.target_append('override_dh_auto_install', ['mkdir -p $(TMP)/usr/etc',
+                           '(cd $(TMP)/usr/etc && ln -sf ../lib bla);'])
+project.package(mirbuild.packagers.DebianPackaging(project.env, rules))
+project.run()
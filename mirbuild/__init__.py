@@ -197,6 +197,18 @@ easy as::
 
   $ python -m mirbuild.walk realclean build
 
+The metadata of each project is cached in ~/.cache/mirbuild/meta.json, so
+build.py only has to be queried again if build.py, debian/control, debian/changelog
+or any of the applicable .mirbuildrc files have changed. Use --refresh-meta to
+query all projects again or --no-meta-cache to bypass the cache.
+
+When scanning for projects, mirbuild.walk never descends into project directories,
+hidden directories or directories that usually only contain build output. You can
+exclude more directories by listing them in a .mirbuildignore file in the base
+directory. The locations of all projects found are remembered along with the
+modification times of the directories scanned, so only directories that have
+changed since the last walk need to be read again.
+
 This is very much work in progress. There's for example support for meta-commands
 that allow package installation or removal. These will be documented when it's
 considered mature enough.
@@ -241,6 +253,202 @@ to rebuild all projects in case of a failure::
 
 The tracking file will only be removed after all projects have been processed.
 
+Installing or removing packages one project at a time means dpkg has to load
+its database and run triggers once per project. With -B, the packages of all
+projects on the same level of the dependency tree are installed in a single
+dpkg transaction, and the projects of the next level are started once that's
+done. If only dpkg commands are given, all packages are handled at once::
+
+  $ python -m mirbuild.walk -n -B package debinstall
+  $ python -m mirbuild.walk -n -B -r debremove
+
+Only a failed transaction is retried one project at a time.
+
+Independent projects can be worked on in parallel using the -j option::
+
+  $ python -m mirbuild.walk -j 8 realclean build
+
+A project is started as soon as all its dependencies have been processed. By
+default, no new projects are started once a project fails; use -k to keep going
+with all projects that don't depend on the failed one. Either way, a summary of
+succeeded, failed and skipped projects is printed at the end.
+
+When working on projects in parallel, mirbuild.walk runs a GNU make compatible
+jobserver, so make, scons and thrift running in all projects share one pool of
+job slots instead of each starting as many jobs as there are CPUs. The pool has
+one slot per CPU by default; use -l to change its size or --no-jobserver to let
+each project decide on its own::
+
+  $ python -m mirbuild.walk -j 4 -l 16 build
+
+Wherever "auto" is accepted as a number of jobs, by build.py and mirbuild.walk
+alike, it means one job per CPU that can actually be used, so CPU affinity and
+the CPU quota of a container (cgroup v1 or v2) are taken into account. It's
+also never more jobs than fit into the available memory, including the memory
+limit of the container. How much memory a job needs is learned from the build
+history database (see below), or can be set using --job-memory (for build.py
+also using job_memory in the [build] section of .mirbuildrc)::
+
+  $ python -m mirbuild.walk -j auto --job-memory 2G build
+
+The output of projects running in parallel is written to a log file per project
+and command in a new directory under ~/.cache/mirbuild/runs, so it doesn't get
+mixed up. If the output goes to a terminal, a status line for each running
+project shows how long it's been running and its last line of output. For each
+project that fails, the end of its log is printed. Use --logs to write logs in
+another place, also for sequential walks, or --no-logs to see all output as it
+happens.
+
+The time each command takes is recorded in ~/.cache/mirbuild/history.json. With
+more than one job, projects that are ready to run are started in order of the
+longest chain of work still depending on them, so long builds deep down in the
+dependency tree get started as early as possible. Once there's a history, an
+estimate of the total time is printed before starting, also with --dry-run.
+
+For small projects, most of the time is spent starting python and importing
+mirbuild for each command. The -I option makes mirbuild.walk run build.py in its
+own process instead. Each command still gets a fresh project, but only one
+project can be run in-process at a time. Projects running alongside it in child
+processes are not affected by its working directory or environment. As the
+output of a project running in-process can't be captured, -I doesn't write log
+files unless --logs is given explicitly, which in turn turns -I off. Projects
+whose build.py doesn't behave well when run this way can opt out::
+
+  project = CMakeProject('hobnob', in_process = False)
+
+To see what the dependency graph looks like, use the graph command::
+
+  $ python -m mirbuild.walk graph > graph.json
+  $ python -m mirbuild.walk --graph-format dot graph | dot -Tsvg > graph.svg
+
+For each project, the output has its depth (the longest chain of dependencies
+below it), fan-in, fan-out and number of projects depending on it directly or
+indirectly. The DOT output only shows dependencies that aren't implied by other
+dependencies. If there's a history of build times, the critical path is shown
+as well. Add commands after graph to use their times instead of those of build.
+
+Projects can also be handed to a pool of workers using the -w option::
+
+  $ python -m mirbuild.walk -w 4 package
+
+Each worker works on one project at a time and returns the packages built for
+it. Before a worker starts on a project, it is sent the packages of all the
+project's dependencies it doesn't have yet. Projects preferably go to the worker
+that already has most of them. Right now, all workers run on the local machine,
+see mirbuild.worker for the protocol they use.
+
+To build several configurations of the whole tree in one go, list them using
+the -c option::
+
+  $ python -m mirbuild.walk -j 8 -c debug,release,coverage build test
+
+Each configuration is built out-of-source, in its own build directory. All
+configurations use the same dependency order and can be worked on at the same
+time, but the configurations of a single project are still run one after the
+other. Projects without build configurations are only run once.
+
+In large trees, projects high up in the dependency graph end up with lots of
+include and library paths, one for each dependency. With the -S option, the
+includes and libraries of each project are staged in a single directory once
+it's done, and dependent projects get just one include and one library path::
+
+  $ python -m mirbuild.walk -S /tmp/stage build
+
+The staged files are hard links to the originals, and a manifest keeps track of
+which files belong to which project.
+
+When the same sources get built over and over again, e.g. by CI machines, the
+--artifact-cache option keeps the outputs of building each project in a cache::
+
+  $ python -m mirbuild.walk --artifact-cache -j 8 build
+
+The outputs are stored by a key covering the project's sources, the commands
+and configuration, the toolchain and the keys of all its dependencies. If that
+key has been built before, the outputs (lib, bin, generated headers and python
+modules) are restored from ~/.cache/mirbuild/artifacts instead of building the
+project. Restored files are reflinks or hard links to the cache, so they should
+be replaced rather than written to. The cache keeps the most recently used
+outputs up to --artifact-cache-size. Only walks that do no more than configure
+and build use the cache. See mirbuild.artifacts for details.
+
+To share outputs between machines, point all of them at the same server::
+
+  $ python -m mirbuild.artifactserver --port 8321 /srv/artifacts
+  $ python -m mirbuild.walk --artifact-server http://buildcache:8321 build
+
+Outputs a machine doesn't have in its own cache are then downloaded from the
+server, and everything it builds is uploaded there. Files are checked against
+their SHA-1 in both directions, and the first outputs uploaded for a key are
+never replaced. The server has no authentication, though, and anyone who can
+reach it can store outputs that end up in other people's builds. It only
+listens on 127.0.0.1 unless --bind tells it otherwise, so only make it
+reachable from machines you trust.
+
+Using mirbuild.server
+---------------------
+
+For quick edit-build-test cycles, you can start a build server that keeps
+mirbuild imported and the meta information of all projects in memory::
+
+  $ python -m mirbuild.server
+
+Commands are then sent to the server using the thin client, which is just a
+replacement for running build.py or mirbuild.walk::
+
+  $ python /path/to/mirbuild/client.py build
+  $ python /path/to/mirbuild/client.py --walk -j 4 build
+
+The server runs everything in the client's working directory and environment.
+When no server is running, the client simply runs the command locally. Use the
+--stop option of the client to shut down the server.
+
+For repeated walks, the -i option skips all projects that haven't changed since
+the same commands were last run successfully on them::
+
+  $ python -m mirbuild.walk -i -j 8 build test
+
+A project is considered changed if any of its (non-hidden) files, its .mirbuildrc
+files, the commands or any of its dependencies have changed.
+
+With --interfaces, a change to a dependency only counts if it changes what
+dependent projects use from it: its headers, its thrift files, the symbols
+exported by its shared libraries or the contents of its static libraries. If
+only the implementation of a shared library has changed, projects using it are
+left alone. Dependencies without any of these are still taken as a whole.
+
+If a long walk gets interrupted or fails, the -t option lets you pick it up
+where it stopped::
+
+  $ python -m mirbuild.walk -t /tmp/walk.track -j 8 build test
+
+Each command run for a project is appended to the given file as it finishes.
+Running the same walk again skips all projects that are done, and for the rest,
+all commands that have already succeeded with the same arguments. The file is
+removed once the walk completes without errors.
+
+To only work on projects affected by a set of changes, pass the changed paths
+using -a or a git revision range using -g::
+
+  $ python -m mirbuild.walk -a libfoo/src/foo.cpp,libbar build test
+  $ python -m mirbuild.walk -g origin/master..HEAD build test
+
+This will run the commands for all projects owning any of the changed paths
+as well as all projects depending on them, in dependency order.
+
+Build history
+-------------
+
+All walks and all build.py commands are recorded in ~/.cache/mirbuild/history.db,
+along with how long they took, whether they succeeded and the CPU time and memory
+used. This makes it easy to find out where build time goes::
+
+  $ python -m mirbuild.history slowest
+  $ python -m mirbuild.history -c build regressions
+  $ python -m mirbuild.history -c test flaky
+  $ python -m mirbuild.history --walks runs
+
+See mirbuild.history for details, e.g. how to turn this off.
+
 Debian Packaging
 ----------------
 
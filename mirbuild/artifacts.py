@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+r"""
+Content-addressed cache of build outputs
+
+mirbuild.walk can keep the outputs of building each project in a cache, keyed
+by everything that goes into the build: the project's sources, the commands,
+the options it was configured with (as saved in configure.json), the toolchain
+and the keys of all its dependencies.
+When the same key comes up again, e.g. when building the same commit in another
+checkout, the outputs are put in place instead of building the project again.
+
+The outputs of a project are the contents of its lib and bin directories
+(in-source or out-of-source), python modules in build/lib* and all files in
+include that aren't sources. The cache directory looks like this::
+
+  artifacts/objects/3f/3f786850e387550fdab836ed7e6dc881de23001b
+  artifacts/objects/89/89e6c98d92887913cadf06b2adb97f26cde4849b.x
+  artifacts/entries/0a1bd7e1b7ab4fc4b1e79dd3e5e6b49f0d8a0e21.json
+
+Each file is stored once under its SHA-1, executables get a .x suffix, and an
+entry lists the files stored for one key. The cache keeps a running total of
+the size of all objects in size.json, and once that grows beyond the size
+limit, the least recently used entries are evicted. Only then is the whole
+cache scanned, which also cleans up whatever interrupted stores left behind. Files are checked
+against their SHA-1 before they are restored, and are restored as reflinks or
+hard links to the objects where possible. Objects are read-only, so a build
+that writes to a restored file in place fails instead of silently changing
+the file in every checkout that shares the hard link.
+
+A shared tier can be put behind the local cache using a RemoteCache, which
+talks to a server like the one in mirbuild.artifactserver. Keys that aren't
+in the local cache are looked up on the server, and their files downloaded
+into the local cache. Whatever is stored locally is uploaded as well. Objects
+are transferred over several connections at the same time and checked against
+their SHA-1 on both ends. An entry is only uploaded once all its objects are
+on the server, and the server keeps the first entry uploaded for a key.
+
+"""
+
+__all__ = 'ArtifactCache RemoteCache'.split()
+
+import os, sys, re, json, glob, errno, shutil, stat, hashlib, platform, subprocess, time, tempfile
+import urllib2, httplib, multiprocessing.pool
+import mirbuild.tools, mirbuild.worker
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# top-level directories of a project that never contain sources
+output_dirs = set('lib bin build'.split())
+# directories of generated files that aren't outputs either
+generated_dirs = set('CMakeFiles _CPack_Packages gen-cpp gen-py'.split())
+
+def source_files(path):
+    """
+    Relative paths of the source files of the project in path
+
+    In a git work tree, these are all files git doesn't ignore. Otherwise,
+    hidden files and directories of generated files are skipped. Either way,
+    nothing in the output directories counts as a source.
+    """
+    files = None
+    try:
+        p = subprocess.Popen(['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard'], cwd = path,
+                             env = mirbuild.tools.child_environ(), stdout = subprocess.PIPE, stderr = open(os.devnull, 'w'))
+        out = p.communicate()[0]
+        if p.returncode == 0:
+            files = [f for f in out.split('\0') if f]
+    except OSError:
+        pass
+    if files is None:
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs[:] = [d for d in dirs if not d.startswith('.') and d not in generated_dirs]
+            files.extend(os.path.relpath(os.path.join(root, n), path) for n in names if not n.startswith('.'))
+    return sorted(set(f for f in files if f.split(os.sep)[0] not in output_dirs and os.path.lexists(os.path.join(path, f))))
+
+def files_fingerprint(path, files, hash = None):
+    h = hashlib.sha1() if hash is None else hash
+    for f in files:
+        name = os.path.join(path, f)
+        h.update(f + '\0')
+        if os.path.islink(name):
+            h.update('-> ' + os.readlink(name) + '\0')
+        else:
+            h.update('{0}\0'.format(mirbuild.worker.file_digest(name)))
+    return h.hexdigest()
+
+def toolchain_fingerprint(environ = None):
+    """
+    Fingerprint of the platform and the tools used for building
+
+    This covers python and the versions of the C and C++ compilers (as
+    selected by CC and CXX) and of cmake.
+    """
+    environ = mirbuild.tools.child_environ() if environ is None else environ
+    h = hashlib.sha1()
+    h.update('{0} {1} {2}\0'.format(sys.platform, platform.machine(), sys.version))
+    for tool in [environ.get('CC', 'cc'), environ.get('CXX', 'c++'), 'cmake']:
+        try:
+            p = subprocess.Popen(tool.split() + ['--version'], env = environ, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+            out = p.communicate()[0]
+        except OSError:
+            out = 'not found'
+        h.update('{0}\0{1}\0'.format(tool, out))
+    return h.hexdigest()
+
+def configured_options(path, config = None):
+    """
+    The general options the project in path has been configured with
+
+    That's what build.py saved in configure.json last, or for the given
+    build configuration. Returns None if the project hasn't been configured.
+    """
+    try:
+        state = json.load(open(os.path.join(path, 'configure.json'), 'r'))
+    except (IOError, ValueError):
+        return None
+    general = state.get(sys.platform, {}).get('general', {})
+    if config is not None:
+        partition = '{0}:{1}:{2}'.format(sys.platform, config, general.get('build_mode', 'in'))
+        general = state.get(partition, {}).get('general', general)
+    return general
+
+def _object_mode(obj):
+    # objects may be hard linked into many checkouts, nobody must write to them
+    return 0555 if obj.endswith('.x') else 0444
+
+def build_outputs(path, config = None, sources = ()):
+    """
+    Relative paths of the build outputs of the project in path
+    """
+    dirs = ['include', 'lib', 'bin']
+    for pattern in [os.path.join('build', 'lib*'), os.path.join('build', 'build', 'lib*'),
+                    os.path.join('build', sys.platform, '*' if config is None else config, 'lib'),
+                    os.path.join('build', sys.platform, '*' if config is None else config, 'bin')]:
+        dirs.extend(sorted(os.path.relpath(d, path) for d in glob.glob(os.path.join(path, pattern))))
+    sources = set(sources)
+    files = []
+    for d in dirs:
+        top = os.path.join(path, d)
+        if os.path.islink(top) or not os.path.isdir(top):
+            continue
+        for root, subdirs, names in os.walk(top):
+            subdirs.sort()
+            for n in sorted(names) + [s for s in subdirs if os.path.islink(os.path.join(root, s))]:
+                f = os.path.relpath(os.path.join(root, n), path)
+                if f not in sources:
+                    files.append(f)
+    return files
+
+def _parallel(func, items, jobs):
+    if not items:
+        return []
+    pool = multiprocessing.pool.ThreadPool(min(jobs, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+
+def _reflink(src, dst):
+    # FICLONE, copy-on-write clones on btrfs, xfs and the like
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    sfh = open(src, 'rb')
+    dfh = open(dst, 'wb')
+    try:
+        fcntl.ioctl(dfh.fileno(), 0x40049409, sfh.fileno())
+        return True
+    except IOError:
+        return False
+    finally:
+        sfh.close()
+        dfh.close()
+
+def _place(src, dst):
+    # never write to what's there, it might be a hard link to an object
+    _remove(dst)
+    # reflinks first, as writing to a hard link would change the object as well
+    if _reflink(src, dst):
+        # a clone is a file of its own, so it can be writable
+        os.chmod(dst, stat.S_IMODE(os.stat(src).st_mode) | stat.S_IWUSR)
+        return
+    _remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError as ex:
+        if ex.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dst)
+        os.chmod(dst, stat.S_IMODE(os.stat(src).st_mode) | stat.S_IWUSR)
+
+class ArtifactCache(object):
+    """
+    Local store of the build outputs of projects, by key
+    """
+
+    version = 1
+    default_max_size = 10 << 30
+
+    def __init__(self, path = None, max_size = None, remote = None):
+        if path is None:
+            path = self.default_path()
+        self.path = os.path.abspath(path)
+        self.max_size = self.default_max_size if max_size is None else max_size
+        self.remote = remote
+
+    @staticmethod
+    def default_path():
+        return os.path.join(mirbuild.tools.cache_dir(), 'artifacts')
+
+    def __object(self, obj):
+        return os.path.join(self.path, 'objects', obj[:2], obj)
+
+    @property
+    def __entries(self):
+        return os.path.join(self.path, 'entries')
+
+    def __entry(self, key):
+        return os.path.join(self.__entries, key + '.json')
+
+    @property
+    def __size_file(self):
+        return os.path.join(self.path, 'size.json')
+
+    def __locked(self):
+        # one lock for all processes (and threads) using the cache
+        _makedirs(self.path)
+        return mirbuild.tools.FileLock(os.path.join(self.path, 'lock'))
+
+    def __read(self, key):
+        try:
+            entry = json.load(open(self.__entry(key), 'r'))
+            if self.__valid(entry):
+                return entry
+        except (IOError, ValueError):
+            pass
+        return None
+
+    def __valid(self, entry):
+        # entries may come from elsewhere, so make sure they only refer to objects
+        # and don't put anything outside the project
+        try:
+            if entry.get('version') != self.version:
+                return False
+            for f in entry['files'].keys() + entry['links'].keys():
+                if os.path.isabs(f) or os.pardir in f.split(os.sep):
+                    return False
+            return all(re.match(r'^[0-9a-f]{40}(\.x)?$', obj) for obj in entry['files'].itervalues())
+        except (AttributeError, KeyError, TypeError):
+            return False
+
+    def __intact(self, obj):
+        return mirbuild.worker.file_digest(self.__object(obj)) == obj.split('.')[0]
+
+    def restore(self, key, path):
+        """
+        Put the files stored for key in place below path
+
+        Returns the number of files restored, or None if nothing (intact) has
+        been stored for key, neither locally nor remotely.
+        """
+        num = self.__restore(key, path)
+        if num is None and self.remote is not None and self.__fetch(key):
+            num = self.__restore(key, path)
+        return num
+
+    def __restore(self, key, path):
+        with self.__locked():
+            entry = self.__read(key)
+            if entry is None:
+                return None
+            if not all(self.__intact(obj) for obj in set(entry['files'].itervalues())):
+                # the objects are evicted along with the entry
+                _remove(self.__entry(key))
+                return None
+            for f, obj in sorted(entry['files'].iteritems()):
+                dst = os.path.join(path, f)
+                _makedirs(os.path.dirname(dst))
+                # objects stored by older versions may still be writable
+                os.chmod(self.__object(obj), _object_mode(obj))
+                _place(self.__object(obj), dst)
+            for f, target in sorted(entry['links'].iteritems()):
+                dst = os.path.join(path, f)
+                _makedirs(os.path.dirname(dst))
+                _remove(dst)
+                os.symlink(target, dst)
+            # this is what makes the entry recently used
+            os.utime(self.__entry(key), None)
+        return len(entry['files']) + len(entry['links'])
+
+    def store(self, key, path, files):
+        """
+        Store the given files below path for key
+
+        Returns the number of files stored, or None if a file has changed
+        while it was stored.
+        """
+        num = self.__store(key, path, files)
+        if num is not None and self.remote is not None:
+            self.__upload(key)
+        return num
+
+    def __store(self, key, path, files):
+        entry = { 'version': self.version, 'files': {}, 'links': {}, 'created': time.time() }
+        added = 0
+        with self.__locked():
+            for f in files:
+                src = os.path.join(path, f)
+                if os.path.islink(src):
+                    entry['links'][f] = os.readlink(src)
+                    continue
+                executable = bool(os.stat(src).st_mode & stat.S_IXUSR)
+                obj = mirbuild.worker.file_digest(src) + ('.x' if executable else '')
+                dst = self.__object(obj)
+                if not self.__intact(obj):
+                    _makedirs(os.path.dirname(dst))
+                    temp = '{0}.{1}.new'.format(dst, os.getpid())
+                    shutil.copyfile(src, temp)
+                    os.chmod(temp, _object_mode(obj))
+                    if mirbuild.worker.file_digest(temp) != obj.split('.')[0]:
+                        os.remove(temp)
+                        return None
+                    os.rename(temp, dst)
+                    added += os.path.getsize(dst)
+                entry['files'][f] = obj
+            mirbuild.tools.write_json(self.__entry(key), entry)
+            self.__grow(added)
+        return len(entry['files']) + len(entry['links'])
+
+    def __fetch(self, key):
+        entry = self.remote.get_entry(key)
+        if entry is None or not self.__valid(entry):
+            return False
+        # the objects only become part of the cache along with the entry,
+        # so they are downloaded somewhere eviction doesn't look
+        tmp = os.path.join(self.path, 'tmp')
+        _makedirs(tmp)
+        missing = sorted(obj for obj in set(entry['files'].itervalues()) if not self.__intact(obj))
+        temps = {}
+        for obj in missing:
+            (fd, temps[obj]) = tempfile.mkstemp(prefix = obj + '.', dir = tmp)
+            os.close(fd)
+        def fetch(obj):
+            if not self.remote.get_object(obj, temps[obj]):
+                return False
+            if mirbuild.worker.file_digest(temps[obj]) != obj.split('.')[0]:
+                raise IOError('object {0} from {1} is corrupt'.format(obj, self.remote.url))
+            return True
+        try:
+            if not all(_parallel(fetch, missing, self.remote.connections)):
+                return False
+            with self.__locked():
+                added = 0
+                for obj in missing:
+                    if not self.__intact(obj):
+                        _makedirs(os.path.dirname(self.__object(obj)))
+                        os.chmod(temps[obj], _object_mode(obj))
+                        os.rename(temps[obj], self.__object(obj))
+                        added += os.path.getsize(self.__object(obj))
+                entry['created'] = time.time()
+                mirbuild.tools.write_json(self.__entry(key), entry)
+                self.__grow(added)
+            return True
+        finally:
+            for temp in temps.itervalues():
+                _remove(temp)
+
+    def __upload(self, key):
+        entry = self.__read(key)
+        if entry is None or self.remote.has_entry(key):
+            return
+        def upload(obj):
+            if not self.remote.has_object(obj):
+                self.remote.put_object(obj, self.__object(obj))
+        _parallel(upload, sorted(set(entry['files'].itervalues())), self.remote.connections)
+        self.remote.put_entry(key, entry)
+
+    def __grow(self, added):
+        # only scan the whole cache when the running total says it's too big;
+        # the total never shrinks in between, so it can only overestimate
+        try:
+            total = json.load(open(self.__size_file, 'r'))['objects'] + added
+        except (IOError, ValueError, KeyError, TypeError):
+            total = None
+        if total is None or total > self.max_size:
+            self.__evict()
+        else:
+            mirbuild.tools.write_json(self.__size_file, { 'objects': total })
+
+    def __evict(self):
+        entries = []
+        for name in sorted(os.listdir(self.__entries)):
+            filename = os.path.join(self.__entries, name)
+            if not name.endswith('.json'):
+                # left over from an interrupted store
+                _remove(filename)
+                continue
+            try:
+                entries.append((os.stat(filename).st_mtime, filename, json.load(open(filename, 'r'))['files']))
+            except (IOError, OSError, ValueError, KeyError):
+                _remove(filename)
+        sizes = {}
+        for root, dirs, names in os.walk(os.path.join(self.path, 'objects')):
+            for n in names:
+                sizes[n] = os.path.getsize(os.path.join(root, n))
+        refs = {}
+        for (mtime, filename, files) in entries:
+            for obj in set(files.itervalues()):
+                refs[obj] = refs.get(obj, 0) + 1
+        total = 0
+        for obj, size in sizes.iteritems():
+            # left over from broken entries or interrupted stores
+            if obj not in refs:
+                _remove(self.__object(obj))
+            else:
+                total += size
+        for (mtime, filename, files) in sorted(entries):
+            if total <= self.max_size:
+                break
+            _remove(filename)
+            for obj in set(files.itervalues()):
+                refs[obj] -= 1
+                if refs[obj] == 0 and obj in sizes:
+                    _remove(self.__object(obj))
+                    total -= sizes[obj]
+        mirbuild.tools.write_json(self.__size_file, { 'objects': total })
+
+class RemoteCache(object):
+    """
+    Client for a shared artifact cache served over HTTP
+
+    Errors talking to the server are raised as IOError.
+    """
+
+    connections = 4
+    timeout = 60
+    chunk_size = 1 << 16
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def __open(self, method, path, data = None, size = None):
+        request = urllib2.Request(self.url + path, data)
+        request.get_method = lambda: method
+        if data is not None:
+            request.add_header('Content-Type', 'application/octet-stream')
+            request.add_header('Content-Length', str(size))
+        try:
+            return urllib2.urlopen(request, timeout = self.timeout)
+        except urllib2.HTTPError as ex:
+            if ex.code == 404:
+                return None
+            if ex.code == 409 and method == 'PUT':
+                return False
+            raise IOError('{0} {1}{2} failed: {3}'.format(method, self.url, path, ex))
+        except httplib.HTTPException as ex:
+            raise IOError('{0} {1}{2} failed: {3}'.format(method, self.url, path, ex.__class__.__name__))
+
+    def __has(self, path):
+        response = self.__open('HEAD', path)
+        if response is None:
+            return False
+        response.close()
+        return True
+
+    def __put(self, path, data, size):
+        response = self.__open('PUT', path, data, size)
+        if response is None:
+            raise IOError('PUT {0}{1} failed: not found'.format(self.url, path))
+        if response is False:
+            # someone else has stored it first
+            return
+        response.close()
+
+    def has_object(self, obj):
+        return self.__has('/objects/' + obj)
+
+    def get_object(self, obj, filename):
+        response = self.__open('GET', '/objects/' + obj)
+        if response is None:
+            return False
+        fh = open(filename, 'wb')
+        try:
+            for chunk in iter(lambda: response.read(self.chunk_size), ''):
+                fh.write(chunk)
+        finally:
+            fh.close()
+            response.close()
+        return True
+
+    def put_object(self, obj, filename):
+        fh = open(filename, 'rb')
+        try:
+            self.__put('/objects/' + obj, fh, os.fstat(fh.fileno()).st_size)
+        finally:
+            fh.close()
+
+    def has_entry(self, key):
+        return self.__has('/entries/' + key)
+
+    def get_entry(self, key):
+        response = self.__open('GET', '/entries/' + key)
+        if response is None:
+            return None
+        try:
+            return json.loads(response.read())
+        except ValueError:
+            raise IOError('entry {0} from {1} is corrupt'.format(key, self.url))
+        finally:
+            response.close()
+
+    def put_entry(self, key, entry):
+        data = json.dumps(entry)
+        self.__put('/entries/' + key, data, len(data))
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+r"""
+Reference server for shared artifact caches
+
+A shared artifact cache lets all machines reuse the build outputs any of them
+have stored, see mirbuild.artifacts. Running ::
+
+  $ python -m mirbuild.artifactserver --port 8321 /srv/artifacts
+
+serves the given directory over HTTP. It has the same layout as a local
+artifact cache. The protocol is plain GET, HEAD and PUT requests for two
+kinds of resources::
+
+  /objects/<sha1>[.x]    the contents of a file, by SHA-1
+  /entries/<key>         the JSON list of files stored for a key
+
+The server checks uploaded objects against their SHA-1 and uploaded entries
+for being valid JSON before it accepts them. Uploads are written to a
+temporary file first, so readers never see partial files. An entry that
+exists is never replaced, the first upload for a key wins and later ones are
+rejected with 409 Conflict. The server doesn't evict anything, so the
+directory keeps growing until it is cleaned up.
+
+There is no authentication. Anyone who can reach the server can read all
+stored files and store outputs for keys that nobody has stored yet, which
+then get restored into everybody else's builds. So the server only listens
+on 127.0.0.1 by default, and --bind should only make it reachable for
+machines that are trusted with the builds, e.g. on a private network or
+through SSH tunnels.
+
+"""
+
+__all__ = 'ArtifactServer'.split()
+
+import os, sys, re, json, errno, hashlib, BaseHTTPServer, SocketServer
+from optparse import OptionParser
+
+class ArtifactRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    chunk_size = 1 << 16
+
+    def __resource(self):
+        m = re.match(r'^/(objects/[0-9a-f]{40}(?:\.x)?|entries/[0-9a-f]{40})$', self.path)
+        if m is None:
+            self.send_error(404)
+            return None
+        (kind, name) = m.group(1).split('/')
+        if kind == 'objects':
+            return (kind, name, os.path.join(self.server.path, kind, name[:2], name))
+        return (kind, name, os.path.join(self.server.path, kind, name + '.json'))
+
+    def __send(self, body):
+        resource = self.__resource()
+        if resource is None:
+            return
+        try:
+            fh = open(resource[2], 'rb')
+        except IOError:
+            self.send_error(404)
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json' if resource[0] == 'entries' else 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(fh.fileno()).st_size))
+            self.end_headers()
+            if body:
+                for chunk in iter(lambda: fh.read(self.chunk_size), ''):
+                    self.wfile.write(chunk)
+        finally:
+            fh.close()
+
+    def do_GET(self):
+        self.__send(True)
+
+    def do_HEAD(self):
+        self.__send(False)
+
+    def do_PUT(self):
+        resource = self.__resource()
+        if resource is None:
+            return
+        (kind, name, filename) = resource
+        try:
+            size = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+        temp = os.path.join(self.server.path, 'tmp', '{0}.{1}'.format(name, id(self)))
+        h = hashlib.sha1()
+        data = []
+        fh = open(temp, 'wb')
+        try:
+            while size > 0:
+                chunk = self.rfile.read(min(size, self.chunk_size))
+                if not chunk:
+                    break
+                size -= len(chunk)
+                h.update(chunk)
+                fh.write(chunk)
+                if kind == 'entries':
+                    data.append(chunk)
+            fh.close()
+            error = None
+            if size > 0:
+                error = 'incomplete upload'
+            elif kind == 'objects' and h.hexdigest() != name.split('.')[0]:
+                error = 'SHA-1 mismatch'
+            elif kind == 'entries':
+                try:
+                    json.loads(''.join(data))
+                except ValueError:
+                    error = 'invalid JSON'
+            if error is not None:
+                self.send_error(400, error)
+                return
+            if not os.path.isdir(os.path.dirname(filename)):
+                try:
+                    os.makedirs(os.path.dirname(filename))
+                except OSError as ex:
+                    if ex.errno != errno.EEXIST:
+                        raise
+            try:
+                # unlike rename, this never replaces an existing file
+                os.link(temp, filename)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+                if kind == 'entries':
+                    self.send_error(409, 'entry exists')
+                    return
+                # objects are named by their contents, so it's the same file
+        finally:
+            fh.close()
+            if os.path.exists(temp):
+                os.remove(temp)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ArtifactServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, path, address = ('127.0.0.1', 8321), verbose = False):
+        self.path = os.path.abspath(path)
+        self.verbose = verbose
+        tmp = os.path.join(self.path, 'tmp')
+        if not os.path.isdir(tmp):
+            os.makedirs(tmp)
+        BaseHTTPServer.HTTPServer.__init__(self, address, ArtifactRequestHandler)
+
+    @property
+    def url(self):
+        (host, port) = self.server_address[:2]
+        return 'http://{0}:{1}'.format('localhost' if host in ('', '0.0.0.0') else host, port)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage = '{0} -m mirbuild.artifactserver [options] DIR'.format(sys.executable))
+    parser.add_option('-b', '--bind', dest = 'bind', type = 'string', default = '127.0.0.1',
+                      metavar = 'ADDR', help = 'listen on this address, there is no authentication [default: %default]')
+    parser.add_option('-p', '--port', dest = 'port', type = 'int', default = 8321,
+                      metavar = 'PORT', help = 'listen on this port, 0 picks a free one [default: %default]')
+    parser.add_option('-v', '--verbose', dest = 'verbose', default = False, action = 'store_true',
+                      help = 'log all requests')
+    (opt, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected the directory to serve')
+    try:
+        server = ArtifactServer(args[0], (opt.bind, opt.port), opt.verbose)
+        sys.stderr.write("listening on {0}\n".format(server.url))
+        sys.stderr.flush()
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
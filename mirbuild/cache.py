@@ -44,6 +44,11 @@ a cache tree might look like:
   |
   `---- Cacheable Object('c')
 
+The state is stored per platform, and can be split further into partitions
+by setting the partition name. The state of the partition saved last is also
+stored as the platform's state, so that's what is loaded when it's not yet
+known which partition to ask for.
+
 """
 
 __author__ = 'Marcus Holland-Moritz <marcus@last.fm>'
@@ -52,6 +57,7 @@ __all__ = 'Cacheable Cache'.split()
 import os
 import sys
 import json
+import mirbuild.tools
 
 class Cacheable(object):
     def __init__(self, key):
@@ -67,6 +73,7 @@ class Cache(Cacheable):
         self.__reg = {}
         self.__file = filename
         self.__state = None
+        self.partition = None
 
     @property
     def filename(self):
@@ -103,17 +110,41 @@ class Cache(Cacheable):
 
     def _save(self, filename, state):
         assert filename is not None
-        json.dump(state, open(filename, 'w'), indent = 4)
+        temp = '{0}.{1}.new'.format(filename, os.getpid())
+        fh = open(temp, 'w')
+        json.dump(state, fh, indent = 4)
+        fh.close()
+        mirbuild.tools.replace_file(temp, filename)
+
+    @property
+    def __partition_key(self):
+        return sys.platform if self.partition is None else sys.platform + ':' + self.partition
+
+    def load(self, filename = None, partition = None):
+        """
+        Load the state for this platform
 
-    def load(self, filename = None):
+        If given, partition is a function that gets passed the state saved last
+        and returns the name of the partition to load. If there's no state for
+        that partition yet, the state saved last is used instead.
+        """
         if filename is None:
             filename = self.__file
         state = self._load(filename)
-        self.state = state[sys.platform]
+        current = state[sys.platform]
+        if partition is not None:
+            self.partition = partition(current)
+            current = state.get(self.__partition_key, current)
+        self.state = current
 
     def save(self, filename = None):
         if filename is None:
             filename = self.__file
-        state = self._load(filename) if os.path.exists(filename) else {}
-        state[sys.platform] = self.state
-        self._save(filename, state)
+        # others may be saving their own partitions, so lock the file while
+        # merging our state into what's currently in it; locking creates it
+        with mirbuild.tools.FileLock(filename):
+            state = self._load(filename) if os.path.getsize(filename) > 0 else {}
+            state[sys.platform] = self.state
+            if self.partition is not None:
+                state[self.__partition_key] = state[sys.platform]
+            self._save(filename, state)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+r"""
+Thin client for mirbuild.server
+
+This file must not import mirbuild, as avoiding that is the whole point. Run
+it by path rather than with -m, which would import the mirbuild package::
+
+  $ python /path/to/mirbuild/client.py [command] [options]
+
+runs build.py in the current directory, the same as python build.py would.
+
+  $ python /path/to/mirbuild/client.py --walk [options] [commands]
+
+does the same for python -m mirbuild.walk, and
+
+  $ python /path/to/mirbuild/client.py --stop
+
+stops the server. If no server is running, commands are run locally.
+
+"""
+
+import os, sys, json, socket, uuid
+
+def socket_path():
+    # same as mirbuild.server.socket_path(), which we can't import
+    cache = os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache')))
+    return os.environ.get('MIRBUILD_SERVER') or os.path.join(cache, 'mirbuild', 'server.sock')
+
+def connect():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path())
+        return sock
+    except socket.error:
+        sock.close()
+        return None
+
+def request(sock, command, args = []):
+    token = uuid.uuid4().hex
+    sock.sendall(json.dumps({ 'command': command, 'args': args, 'token': token,
+                              'cwd': os.getcwd(), 'env': dict(os.environ) }) + '\n')
+    # everything up to the token is output, followed by the exit code
+    buf = ''
+    while True:
+        data = sock.recv(1 << 16)
+        if not data:
+            sys.stdout.write(buf)
+            sys.stderr.write('*** ERROR: lost connection to mirbuild server\n')
+            return 1
+        buf += data
+        pos = buf.find(token)
+        if pos >= 0:
+            sys.stdout.write(buf[:pos])
+            sys.stdout.flush()
+            rest = buf[pos + len(token):]
+            while not rest.endswith('\n'):
+                data = sock.recv(64)
+                if not data:
+                    break
+                rest += data
+            return int(rest.strip() or 1)
+        # hold back anything that could be the start of the token
+        keep = len(token) - 1
+        sys.stdout.write(buf[:-keep])
+        sys.stdout.flush()
+        buf = buf[-keep:]
+
+def main(args):
+    command = 'run'
+    if args and args[0] in ('--walk', '--stop'):
+        command = { '--walk': 'walk', '--stop': 'shutdown' }[args.pop(0)]
+    sock = connect()
+    if sock is None:
+        if command == 'shutdown':
+            return 0
+        if command == 'walk':
+            os.execv(sys.executable, [sys.executable, '-m', 'mirbuild.walk'] + args)
+        os.execv(sys.executable, [sys.executable, 'build.py'] + args)
+    try:
+        return request(sock, command, args)
+    finally:
+        sock.close()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -197,11 +197,17 @@ class CMakeEnvironment(mirbuild.environment.Environment):
         if target is not None:
             opts += ['--target', target]
         opts.append('--')
-        opts.append('-j{0}'.format(self.parallel_builds))
+        opts += self._make_jobs
         self.execute(self.tool('cmake'), *opts)
 
+    @property
+    def _make_jobs(self):
+        # make will pick up the jobserver from MAKEFLAGS, and an explicit
+        # -j would make it ignore the shared job slots
+        return [] if self.jobserver is not None else ['-j{0}'.format(self.parallel_builds)]
+
     def _make_build(self, target):
-        opts = ['-j{0}'.format(self.parallel_builds), '-C{0}'.format(self.build_dir)]
+        opts = self._make_jobs + ['-C{0}'.format(self.build_dir)]
         if target is not None:
             opts.append(target)
         self.execute(self.tool('make'), *opts)
@@ -464,10 +470,11 @@ class CMakeProject(mirbuild.project.Project, CMakeConfigPlatform):
             self.__defines.update(name)
 
     def add_include_path(self, *args):
-        self.__incpath += args
+        # dependencies staged in a sysroot all share the same paths
+        self.__incpath += tuple(a for a in args if a not in self.__incpath)
 
     def add_library_path(self, *args):
-        self.__libpath += args
+        self.__libpath += tuple(a for a in args if a not in self.__libpath)
 
     def add_thrifts_path(self, *args):
         self.__thriftspath += args
@@ -38,7 +38,7 @@ import os
 import re
 import sys
 import mirbuild.cache
-import mirbuild.walk
+import mirbuild.staging
 from mirbuild.options import LocalOptions
 from optparse import OptionGroup
 
@@ -50,6 +50,9 @@ class Dependency(object):
     def set_cache(self, cache):
         pass
 
+    def set_sysroot(self, path):
+        pass
+
     @property
     def name(self):
         return self.__name
@@ -118,6 +121,11 @@ class DependencyGroup(object):
     def add_group_options(self, parser, nomerge):
         pass
 
+    def set_sysroot(self, path, staged):
+        for dep in self.__deps:
+            if dep.name in staged:
+                dep.set_sysroot(path)
+
     def apply(self, obj):
         for dep in self.__deps:
             dep.apply(obj)
@@ -142,6 +150,7 @@ class CLibraryDependency(Dependency):
     def __init__(self, name):
         Dependency.__init__(self, name)
         self.__opt = LocalOptions(name)
+        self.__sysroot = None
 
     @staticmethod
     def isdir(basepath, env = None, *path):
@@ -179,6 +188,14 @@ class CLibraryDependency(Dependency):
     def set_cache(self, cache):
         cache.register(self.__opt)
 
+    def set_sysroot(self, path):
+        self.__sysroot = path
+
+    @property
+    def _root(self):
+        # includes and libraries come from the sysroot if they have been staged
+        return self.__sysroot if self.__sysroot is not None else self._path
+
     def add_options(self, parser):
         self.__opt.add_option(parser, '--with-{0}'.format(self.name), type = 'string', dest = 'path', metavar = 'PATH',
                               help = 'use {0} includes/libraries from this path'.format(self.name))
@@ -186,7 +203,7 @@ class CLibraryDependency(Dependency):
     def apply(self, obj):
         if self._path:
             # Adding includes is simple, in or out of source makes no difference
-            ipath = self._validated_path(obj.env, 'include')
+            ipath = CLibraryDependency.validated_path(self._root, obj.env, 'include')
             obj.add_include_path(ipath)
             obj.env.dbg('Added inc-path: {0}'.format(ipath))
 
@@ -196,11 +213,11 @@ class CLibraryDependency(Dependency):
 
             # This is the in-source library path
             path = 'lib'
-            path_exists = self._isdir(obj.env, path)
+            path_exists = CLibraryDependency.isdir(self._root, obj.env, path)
 
             # This is the out-of-source library path
             oospath = os.path.join(obj.env.oosbuild_dir, path)
-            oospath_exists = self._isdir(obj.env, oospath)
+            oospath_exists = CLibraryDependency.isdir(self._root, obj.env, oospath)
 
             # Ok, we now need to try and find the most suitable library path:
             # - If the most suitable library path exists use it
@@ -213,7 +230,7 @@ class CLibraryDependency(Dependency):
                 if not path_exists and oospath_exists:
                     path = oospath
 
-            vpath = self._validated_path(obj.env, path)
+            vpath = CLibraryDependency.validated_path(self._root, obj.env, path)
 
             # Add the verified path we decided to use (with a little bit of debug for good measure)
             obj.add_library_path(vpath)
@@ -338,6 +355,8 @@ class Dependencies(object):
             og = OptionGroup(parser, "General Dependency Options")
             self.__opt.add_option(og, '--with-deps-from', type = 'string', dest = 'deps_from', metavar = 'PATH',
                                   help = 'scan this path for dependencies')
+            self.__opt.add_option(og, '--with-sysroot', type = 'string', dest = 'sysroot', metavar = 'PATH',
+                                  help = 'use includes/libraries of dependencies staged in this path')
             parser.add_option_group(og)
             for cls in sorted(self.__groups, key=operator.attrgetter('__name__')):
                 self.__groups[cls].add_options(parser, nomerge)
@@ -350,6 +369,9 @@ class Dependencies(object):
             if path.startswith('slow:'):
                 path = path[5:]
                 fast = False
+            # only imported when needed, as importing the walker and all it
+            # depends on would slow down starting every build.py
+            import mirbuild.walk
             found = mirbuild.walk.Walker(path, fastscan = fast, env = self.__env).dependencies
             for group in self.__groups.itervalues():
                 group.set_unsatisfied_dependencies(found)
@@ -357,6 +379,10 @@ class Dependencies(object):
     def apply(self, obj):
         if self.__groups and self.__opt.deps_from:
             self.__autoresolve()
+        if self.__groups and self.__opt.sysroot:
+            staged = mirbuild.staging.Sysroot(self.__opt.sysroot).projects
+            for grp in self.__groups.itervalues():
+                grp.set_sysroot(self.__opt.sysroot, staged)
         for grp in self.__groups.itervalues():
             grp.apply(obj)
 
@@ -34,7 +34,8 @@ and random other stuff.
 
 __author__ = 'Marcus Holland-Moritz <marcus@last.fm>'
 
-import filecmp, os, re, sys, subprocess, shutil, errno
+import filecmp, os, re, sys, subprocess, shutil, errno, math, time
+import mirbuild.jobserver, mirbuild.tools, mirbuild.history
 
 try:
     import ConfigParser as configparser
@@ -44,11 +45,164 @@ except ImportError:
 
 _no_default_given = object()
 
+def config_files(dir, global_config = '/etc/mirbuildrc'):
+    # all config files that apply to dir, most specific one first
+    files = []
+    while dir:
+        path = os.path.join(dir, '.mirbuildrc')
+        if os.path.exists(path):
+            files.append(path)
+        (dir, ignore) = os.path.split(dir)
+        if not ignore:
+            break
+    if os.path.exists(global_config):
+        files.append(global_config)
+    return files
+
+# what we assume a job needs when there's no build history to tell
+default_job_memory = 512 * 1024 ** 2
+
+def _read(root, path):
+    # root is only ever set by the tests to fake /proc and /sys
+    try:
+        with open(root + path, 'r') as fh:
+            return fh.read()
+    except (IOError, OSError):
+        return None
+
+def _cgroup_dirs(controller, root = ''):
+    """
+    Directories of the cgroups of this process that a controller applies to
+
+    For each cgroup hierarchy (v1 hierarchies with the controller and the v2
+    unified hierarchy), this yields the process's own cgroup followed by all
+    its ancestors, as their limits apply as well.
+    """
+    cgroups = _read(root, '/proc/self/cgroup')
+    mounts = _read(root, '/proc/self/mountinfo')
+    if cgroups is None or mounts is None:
+        return
+    for line in mounts.splitlines():
+        fields = line.split()
+        if '-' not in fields:
+            continue
+        sep = fields.index('-')
+        (mount_root, mount_point, fstype) = (fields[3], fields[4], fields[sep + 1])
+        if fstype == 'cgroup2':
+            wanted = lambda c: c[0] == '0' and c[1] == ''
+        elif fstype == 'cgroup' and controller in fields[sep + 3].split(','):
+            wanted = lambda c: controller in c[1].split(',')
+        else:
+            continue
+        for cg in cgroups.splitlines():
+            cg = cg.split(':', 2)
+            if len(cg) != 3 or not wanted(cg):
+                continue
+            rel = os.path.relpath(cg[2], mount_root)
+            # not below the mount's root, e.g. in a container without its own cgroup namespace
+            dir = mount_point if rel.startswith('..') else os.path.normpath(os.path.join(mount_point, rel))
+            while True:
+                yield dir
+                if dir == mount_point or dir == '/':
+                    break
+                dir = os.path.dirname(dir)
+
+def available_cpus(root = ''):
+    """
+    Number of CPUs this process can make use of
+
+    That's the CPUs it may run on, further limited by any CPU quota of its
+    cgroups (cpu.max or cpu.cfs_quota_us).
+    """
+    cpus = None
+    if hasattr(os, 'sched_getaffinity') and not root:
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        m = re.search(r'^Cpus_allowed_list:\s*(\S+)', _read(root, '/proc/self/status') or '', re.M)
+        if m:
+            cpus = 0
+            for r in m.group(1).split(','):
+                (first, ignore, last) = r.partition('-')
+                cpus += int(last or first) - int(first) + 1
+    if not cpus:
+        cpus = len(re.findall(r'^processor\s*:\s*\d+', _read(root, '/proc/cpuinfo') or '', re.M)) or 1
+    for dir in _cgroup_dirs('cpu', root):
+        limit = (_read(root, dir + '/cpu.max') or '').split()
+        if len(limit) != 2:
+            limit = [_read(root, dir + '/cpu.cfs_quota_us'), _read(root, dir + '/cpu.cfs_period_us')]
+        try:
+            (quota, period) = (int(limit[0]), int(limit[1]))
+        except (TypeError, ValueError):
+            # no quota ("max" or -1), or not a cgroup with a cpu controller
+            continue
+        if quota > 0 and period > 0:
+            cpus = min(cpus, max(1, int(math.ceil(float(quota) / period))))
+    return cpus
+
+def available_memory(root = ''):
+    """
+    Number of bytes of memory available for starting new processes
+
+    That's MemAvailable from /proc/meminfo, or less if a memory limit of our
+    cgroups (memory.max or memory.limit_in_bytes) leaves less than that. Page
+    cache that's easily reclaimed doesn't count as being used. Returns None
+    if it's unknown.
+    """
+    available = None
+    m = re.search(r'^MemAvailable:\s*(\d+) kB', _read(root, '/proc/meminfo') or '', re.M)
+    if m:
+        available = int(m.group(1)) * 1024
+    for dir in _cgroup_dirs('memory', root):
+        for (limit, usage, inactive) in (('memory.max', 'memory.current', 'inactive_file'),
+                                         ('memory.limit_in_bytes', 'memory.usage_in_bytes', 'total_inactive_file')):
+            try:
+                (limit, usage) = (int(_read(root, dir + '/' + limit)), int(_read(root, dir + '/' + usage)))
+            except (TypeError, ValueError):
+                continue
+            m = re.search(r'^{0} (\d+)$'.format(inactive), _read(root, dir + '/memory.stat') or '', re.M)
+            free = max(0, limit - usage + (int(m.group(1)) if m else 0))
+            available = free if available is None else min(available, free)
+    return available
+
+def job_memory(configured = None, project = None):
+    """
+    Memory each job is expected to need, in bytes
+
+    That's the configured size (like 2G) if given, otherwise the peak memory
+    of a single process in the recent builds of the project (or any project)
+    recorded in the build history database, or default_job_memory if there's
+    no history.
+    """
+    if configured:
+        return mirbuild.tools.parse_size(configured)
+    db = mirbuild.history.HistoryDB.open()
+    if db is not None and os.path.exists(db.filename):
+        try:
+            peak = db.peak_memory(project)
+        finally:
+            db.close()
+        if peak:
+            return peak
+    return default_job_memory
+
+def auto_jobs(memory_per_job, root = ''):
+    """
+    Number of jobs to run in parallel for "--jobs auto"
+
+    One per CPU we can use, but only as many as there's memory for.
+    """
+    jobs = available_cpus(root)
+    memory = available_memory(root)
+    if memory is not None and memory_per_job:
+        jobs = min(jobs, memory // memory_per_job)
+    return max(1, int(jobs))
+
 class Environment(object):
     def __init__(self, project_name):
         self.__project_name = project_name
         self.__cfg = configparser.ConfigParser()
         self.__cached_num_processors = None
+        self.__jobserver = _no_default_given
         self.__opt = None
         self.__global_mirbuildrc = '/etc/mirbuildrc'
 
@@ -163,20 +317,7 @@ class Environment(object):
         return self.__get('getboolean', section, option, default)
 
     def read_config(self):
-        files = []
-
-        dir = self.getcwd()
-        while dir:
-            path = os.path.join(dir, '.mirbuildrc')
-            if os.path.exists(path):
-                files.append(path)
-            (dir, ignore) = os.path.split(dir)
-            if not ignore:
-                break
-
-        if os.path.exists(self.__global_mirbuildrc):
-            files.append(self.__global_mirbuildrc)
-
+        files = config_files(self.getcwd(), self.__global_mirbuildrc)
         if files:
             files.reverse()
             self.__cfg.read(files)
@@ -200,6 +341,48 @@ class Environment(object):
         if r != 0:
             raise RuntimeError('{0} failed ({1}).'.format(cmd, r))
 
+    def execute_parallel(self, commands, **options):
+        # Run independent commands concurrently. Under a jobserver, we take
+        # as many extra job slots as we can get without waiting; otherwise
+        # we run up to parallel_builds commands at a time.
+        pending = [list(c) for c in commands]
+        tokens = []
+        if self.jobserver is not None:
+            tokens = self.jobserver.acquire_available(len(pending) - 1)
+            slots = 1 + len(tokens)
+        else:
+            slots = self.parallel_builds if self.__opt is not None else 1
+        running = []
+        failed = []
+        try:
+            while pending or running:
+                while pending and len(running) < slots and not failed:
+                    cmd = pending.pop(0)
+                    self.dbg("child process [in {0}]: {1}".format(os.path.realpath(options.get('cwd', self.getcwd())), ' '.join(cmd)))
+                    try:
+                        running.append((cmd[0], subprocess.Popen(cmd, **options)))
+                    except OSError as ex:
+                        if ex.errno == errno.ENOENT:
+                            failed.append('Command "{0}" not found.'.format(cmd[0]))
+                        else:
+                            raise
+                if not running:
+                    break
+                # refill as soon as any command has finished, not just the oldest one;
+                # os.wait() could reap children of other threads, so poll instead
+                done = [(cmd, p) for (cmd, p) in running if p.poll() is not None]
+                if not done:
+                    time.sleep(0.02)
+                for (cmd, p) in done:
+                    running.remove((cmd, p))
+                    if p.returncode != 0:
+                        failed.append('{0} failed ({1}).'.format(cmd, p.returncode))
+        finally:
+            if tokens:
+                self.jobserver.release(tokens)
+        if failed:
+            raise RuntimeError(failed[0])
+
     def execute_tool(self, name, *args, **options):
         if not args and (isinstance(name, list) or isinstance(name, tuple)):
             args = tuple(name[1:])
@@ -275,16 +458,19 @@ class Environment(object):
     @property
     def __num_processors(self):
         if self.__cached_num_processors is None:
-            try:
-                self.__cached_num_processors = 0
-                fh = open('/proc/cpuinfo', 'r')
-                for line in fh:
-                    if re.match('processor\s*:\s*\d+', line):
-                        self.__cached_num_processors += 1
-            except Exception:
-                self.__cached_num_processors = 1
+            memory = job_memory(getattr(self.__opt, 'job_memory', None), self.project_name)
+            self.__cached_num_processors = auto_jobs(memory)
+            self.dbg('running {0} jobs in parallel, assuming {1} MiB of memory per job'.format(
+                     self.__cached_num_processors, memory // 1024 ** 2))
         return self.__cached_num_processors
 
+    @property
+    def jobserver(self):
+        # client for the jobserver we've been started under (if any)
+        if self.__jobserver is _no_default_given:
+            self.__jobserver = mirbuild.jobserver.JobClient.from_environ()
+        return self.__jobserver
+
     @property
     def parallel_builds(self):
         num = self.__opt.jobs
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+r"""
+Project dependency graph
+
+The DependencyGraph class models the dependencies between projects by name.
+It keeps adjacency lists in both directions, so forward and reverse closures
+can be computed without rescanning all projects, e.g.::
+
+  graph = DependencyGraph({ 'app': ['libfoo'], 'libfoo': ['libbar'], 'libbar': [] })
+  graph.closure(['app'])             # set(['app', 'libfoo', 'libbar'])
+  graph.reverse_closure(['libbar'])  # set(['libbar', 'libfoo', 'app'])
+  graph.sort().order                 # ['libbar', 'libfoo', 'app']
+
+Dependencies on projects that are not part of the graph are kept as unknown
+dependencies. Sorting reports them together with all dependency cycles.
+
+For analysing the graph, there's also the depth of each node and the
+transitive reduction, which only keeps the dependencies that aren't implied
+by other dependencies::
+
+  graph = DependencyGraph({ 'app': ['libfoo', 'libbar'], 'libfoo': ['libbar'], 'libbar': [] })
+  graph.depths()                                  # { 'libbar': 0, 'libfoo': 1, 'app': 2 }
+  graph.transitive_reduction().dependencies('app')  # ['libfoo']
+
+"""
+
+__all__ = 'DependencyGraph SortResult'.split()
+
+import heapq
+
+class SortResult(object):
+    def __init__(self, order, unresolved, unknown, cycles):
+        self.order = order
+        self.unresolved = unresolved
+        self.unknown = unknown
+        self.cycles = cycles
+
+    @property
+    def ok(self):
+        return not self.unresolved
+
+    def report(self):
+        lines = []
+        for node in sorted(self.unknown):
+            deps = self.unknown[node]
+            lines.append("project '{0}' depends on unknown project{1} {2}".format(
+                         node, '' if len(deps) == 1 else 's', ', '.join(deps)))
+        for cycle in self.cycles:
+            lines.append("dependency cycle: {0}".format(' -> '.join(cycle + cycle[:1])))
+        return lines
+
+class DependencyGraph(object):
+    def __init__(self, edges = None):
+        self.__edges = {}
+        self.__index = None
+        if edges is not None:
+            for node, deps in edges.iteritems():
+                self.add(node, deps)
+
+    def add(self, node, deps = ()):
+        assert node not in self.__edges
+        self.__edges[node] = list(deps)
+        self.__index = None
+
+    def __build_index(self):
+        if self.__index is None:
+            deps = dict((n, []) for n in self.__edges)
+            rdeps = dict((n, []) for n in self.__edges)
+            unknown = {}
+            for node, edges in self.__edges.iteritems():
+                for d in edges:
+                    if d in self.__edges:
+                        deps[node].append(d)
+                        rdeps[d].append(node)
+                    else:
+                        unknown.setdefault(node, []).append(d)
+            self.__index = (deps, rdeps, unknown)
+        return self.__index
+
+    def __contains__(self, node):
+        return node in self.__edges
+
+    def __len__(self):
+        return len(self.__edges)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    @property
+    def nodes(self):
+        return sorted(self.__edges)
+
+    def dependencies(self, node):
+        return list(self.__build_index()[0][node])
+
+    def dependents(self, node):
+        return list(self.__build_index()[1][node])
+
+    @property
+    def unknown(self):
+        return dict((n, list(d)) for n, d in self.__build_index()[2].iteritems())
+
+    def __traverse(self, nodes, adj):
+        seen = set()
+        todo = []
+        for n in nodes:
+            if n not in self.__edges:
+                raise KeyError(n)
+            if n not in seen:
+                seen.add(n)
+                todo.append(n)
+        while todo:
+            for n in adj[todo.pop()]:
+                if n not in seen:
+                    seen.add(n)
+                    todo.append(n)
+        return seen
+
+    def closure(self, nodes):
+        return self.__traverse(nodes, self.__build_index()[0])
+
+    def reverse_closure(self, nodes):
+        return self.__traverse(nodes, self.__build_index()[1])
+
+    def subgraph(self, nodes):
+        # dependencies on known nodes outside the subgraph are dropped, as
+        # opposed to dependencies on nodes that are unknown to this graph
+        nodes = set(nodes)
+        sub = DependencyGraph()
+        for n in nodes:
+            sub.add(n, [d for d in self.__edges[n] if d in nodes or d not in self.__edges])
+        return sub
+
+    def __kahn(self, indegree, rdeps):
+        ready = [n for n, i in indegree.iteritems() if i == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            n = heapq.heappop(ready)
+            order.append(n)
+            for r in rdeps[n]:
+                indegree[r] -= 1
+                if indegree[r] == 0:
+                    heapq.heappush(ready, r)
+        return order
+
+    def __acyclic_order(self):
+        # like sort(), but ignoring unknown dependencies
+        (deps, rdeps, unknown) = self.__build_index()
+        return self.__kahn(dict((n, len(deps[n])) for n in self.__edges), rdeps)
+
+    def depths(self):
+        """
+        Length of the longest chain of dependencies below each node
+
+        Nodes without dependencies have depth 0. Unknown dependencies are
+        ignored, nodes that are part of (or depend on) a cycle are left out.
+        """
+        deps = self.__build_index()[0]
+        depth = {}
+        for n in self.__acyclic_order():
+            depth[n] = 1 + max([depth[d] for d in deps[n]] or [-1])
+        return depth
+
+    def transitive_reduction(self):
+        """
+        Copy of the graph without dependencies that are implied by other dependencies
+
+        Unknown dependencies are always kept, and so are all dependencies of
+        nodes that are part of (or depend on) a cycle.
+        """
+        deps = self.__build_index()[0]
+        below = {}
+        for n in self.__acyclic_order():
+            below[n] = set(deps[n])
+            for d in deps[n]:
+                below[n] |= below[d]
+        reduced = DependencyGraph()
+        for n, edges in self.__edges.iteritems():
+            implied = set()
+            if n in below:
+                for d in deps[n]:
+                    implied |= below[d]
+            reduced.add(n, [d for d in edges if d not in implied])
+        return reduced
+
+    def sort(self):
+        """
+        Sort the graph topologically using Kahn's algorithm
+
+        Of all nodes that are ready at the same time, the one that sorts first
+        by name is picked. Nodes that cannot be sorted because they depend on
+        unknown nodes or are part of (or depend on) a cycle are returned in
+        the unresolved list, along with the unknown dependencies and cycles.
+        """
+        (deps, rdeps, unknown) = self.__build_index()
+        indegree = dict((n, len(deps[n]) + len(unknown.get(n, []))) for n in self.__edges)
+        order = self.__kahn(indegree, rdeps)
+        unresolved = sorted(n for n, i in indegree.iteritems() if i > 0)
+        return SortResult(order, unresolved, dict((n, list(unknown[n])) for n in unresolved if n in unknown),
+                          self.__cycles(unresolved, deps))
+
+    def __cycles(self, nodes, deps):
+        # Tarjan's algorithm (iterative) to find all strongly connected
+        # components, then one explicit cycle path for each of them
+        index = {}
+        low = {}
+        stack = []
+        onstack = set()
+        sccs = []
+        for root in nodes:
+            if root in index:
+                continue
+            work = [(root, iter(deps[root]))]
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            onstack.add(root)
+            while work:
+                (node, it) = work[-1]
+                pushed = False
+                for d in it:
+                    if d not in index:
+                        index[d] = low[d] = len(index)
+                        stack.append(d)
+                        onstack.add(d)
+                        work.append((d, iter(deps[d])))
+                        pushed = True
+                        break
+                    elif d in onstack:
+                        low[node] = min(low[node], index[d])
+                if pushed:
+                    continue
+                work.pop()
+                if work:
+                    low[work[-1][0]] = min(low[work[-1][0]], low[node])
+                if low[node] == index[node]:
+                    scc = []
+                    while True:
+                        n = stack.pop()
+                        onstack.discard(n)
+                        scc.append(n)
+                        if n == node:
+                            break
+                    if len(scc) > 1 or node in deps[node]:
+                        sccs.append(set(scc))
+        cycles = []
+        for scc in sccs:
+            # every node in the component has an edge back into it, so just
+            # follow those edges until we hit a node we've already visited
+            path = [min(scc)]
+            pos = { path[0]: 0 }
+            while True:
+                nxt = min(d for d in deps[path[-1]] if d in scc)
+                if nxt in pos:
+                    cycles.append(path[pos[nxt]:])
+                    break
+                pos[nxt] = len(path)
+                path.append(nxt)
+        cycles.sort()
+        return cycles
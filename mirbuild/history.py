@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+r"""
+Build history database
+
+Every walk and every build.py command is recorded in a local SQLite database,
+~/.cache/mirbuild/history.db by default. For each command, it keeps the
+project, configuration, start and end time, exit status, the resources used
+by build.py and its children, and whether the walk could skip it because the
+project was up to date. Set MIRBUILD_HISTORY_DB to use a different file, or
+to an empty string to disable recording.
+
+To find out where build time goes, query the database using ::
+
+  $ python -m mirbuild.history slowest
+  $ python -m mirbuild.history regressions
+  $ python -m mirbuild.history flaky
+  $ python -m mirbuild.history --walks runs
+
+"""
+
+__all__ = 'HistoryDB resource_usage usage_since'.split()
+
+import os, sys, time, sqlite3, threading
+import mirbuild.tools
+from optparse import OptionParser
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def resource_usage():
+    """
+    CPU time and peak memory used by this process and its finished children so far
+    """
+    if resource is None:
+        return None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return { 'utime': own.ru_utime + children.ru_utime,
+             'stime': own.ru_stime + children.ru_stime,
+             'maxrss': max(own.ru_maxrss, children.ru_maxrss) }
+
+def usage_since(before):
+    after = resource_usage()
+    if before is None or after is None:
+        return None
+    return { 'utime': after['utime'] - before['utime'],
+             'stime': after['stime'] - before['stime'],
+             'maxrss': after['maxrss'] }
+
+class HistoryDB(object):
+    """
+    Connection to the build history database
+
+    Writing to the database must never break a build, so any errors are
+    reported once and recording is disabled from then on.
+    """
+
+    version = 1
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tool TEXT NOT NULL,
+            args TEXT,
+            cwd TEXT,
+            start REAL NOT NULL,
+            end REAL,
+            status INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run INTEGER NOT NULL REFERENCES runs (id),
+            project TEXT NOT NULL,
+            path TEXT,
+            command TEXT NOT NULL,
+            config TEXT,
+            start REAL NOT NULL,
+            end REAL NOT NULL,
+            status INTEGER NOT NULL,
+            utime REAL,
+            stime REAL,
+            maxrss INTEGER,
+            cache_hit INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS commands_by_project ON commands (project, command, start);
+    """
+
+    def __init__(self, filename = None):
+        self.filename = self.default_filename() if filename is None else filename
+        self.__lock = threading.Lock()
+        self.__db = None
+
+    @staticmethod
+    def default_filename():
+        return os.environ.get('MIRBUILD_HISTORY_DB', os.path.join(mirbuild.tools.cache_dir(), 'history.db'))
+
+    @classmethod
+    def open(cls, filename = None):
+        # None if recording has been disabled
+        db = cls(filename)
+        return db if db.filename else None
+
+    def __connect(self):
+        if self.__db is None:
+            dir = os.path.dirname(self.filename)
+            if dir and not os.path.isdir(dir):
+                os.makedirs(dir)
+            # shared by the threads of a walk, access is serialised by our lock
+            self.__db = sqlite3.connect(self.filename, timeout = 30, check_same_thread = False)
+            self.__db.executescript(self.schema)
+            self.__db.execute('PRAGMA user_version = {0}'.format(self.version))
+        return self.__db
+
+    def __write(self, sql, args):
+        with self.__lock:
+            if self.filename is None:
+                return None
+            try:
+                db = self.__connect()
+                with db:
+                    return db.execute(sql, args).lastrowid
+            except (sqlite3.Error, OSError) as ex:
+                sys.stderr.write("WARNING: cannot write build history database {0}: {1}\n".format(self.filename, ex))
+                self.filename = None
+
+    def query(self, sql, args = ()):
+        with self.__lock:
+            return self.__connect().execute(sql, args).fetchall()
+
+    def close(self):
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.close()
+                self.__db = None
+
+    def begin_run(self, tool, args, cwd = None, start = None):
+        return self.__write('INSERT INTO runs (tool, args, cwd, start) VALUES (?, ?, ?, ?)',
+                            (tool, ' '.join(args), cwd or os.getcwd(), time.time() if start is None else start))
+
+    def end_run(self, run, status, end = None):
+        if run is not None:
+            self.__write('UPDATE runs SET end = ?, status = ? WHERE id = ?', (time.time() if end is None else end, status, run))
+
+    def add_command(self, run, project, path, command, start, end, status, config = None, usage = None, cache_hit = False):
+        if run is None:
+            return
+        usage = usage or {}
+        self.__write('INSERT INTO commands (run, project, path, command, config, start, end, status, utime, stime, maxrss, cache_hit) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (run, project, path, command, config, start, end, status,
+                      usage.get('utime'), usage.get('stime'), usage.get('maxrss'), 1 if cache_hit else 0))
+
+    def __commands(self, tool, command, since):
+        # successful commands that have actually been run, oldest first
+        return self.query('SELECT c.project, c.command, c.end - c.start, c.utime + c.stime, c.maxrss FROM commands c '
+                          'JOIN runs r ON c.run = r.id WHERE r.tool = ? AND c.status = 0 AND c.cache_hit = 0 '
+                          'AND (? IS NULL OR c.command = ?) AND c.start >= ? ORDER BY c.start, c.id',
+                          (tool, command, command, since))
+
+    def slowest(self, command = None, since = 0, limit = 10, tool = 'build.py'):
+        """
+        Projects sorted by the average time taken by a command, slowest first
+
+        Returns (project, command, runs, average time, maximum time, average
+        CPU time, peak memory) tuples.
+        """
+        stats = {}
+        for project, cmd, duration, cpu, rss in self.__commands(tool, command, since):
+            s = stats.setdefault((project, cmd), [0, 0.0, 0.0, [], 0])
+            s[0] += 1
+            s[1] += duration
+            s[2] = max(s[2], duration)
+            if cpu is not None:
+                s[3].append(cpu)
+            s[4] = max(s[4], rss or 0)
+        result = [(p, c, s[0], s[1] / s[0], s[2], sum(s[3]) / len(s[3]) if s[3] else None, s[4] or None)
+                  for (p, c), s in stats.iteritems()]
+        result.sort(key = lambda r: (-r[3], r[0], r[1]))
+        return result[:limit]
+
+    def regressions(self, command = 'build', recent = 5, threshold = 1.2, since = 0, tool = 'build.py'):
+        """
+        Projects whose recent runs of a command take longer than they used to
+
+        The average of the last few runs is compared to the average of all
+        runs before them. Returns (project, command, old average, new average,
+        ratio) tuples, biggest slowdown first.
+        """
+        durations = {}
+        for project, cmd, duration, cpu, rss in self.__commands(tool, command, since):
+            durations.setdefault((project, cmd), []).append(duration)
+        result = []
+        for (p, c), d in durations.iteritems():
+            if len(d) <= recent:
+                continue
+            old = sum(d[:-recent]) / len(d[:-recent])
+            new = sum(d[-recent:]) / recent
+            if old > 0 and new / old >= threshold:
+                result.append((p, c, old, new, new / old))
+        result.sort(key = lambda r: (-r[4], r[0], r[1]))
+        return result
+
+    def flaky(self, command = 'test', window = 20, tool = 'build.py'):
+        """
+        Projects whose command has both passed and failed in its last runs
+
+        Returns (project, command, runs, failures, flips) tuples, where flips
+        is the number of times the outcome changed from one run to the next.
+        """
+        outcomes = {}
+        for project, cmd, status in self.query(
+                'SELECT c.project, c.command, c.status FROM commands c JOIN runs r ON c.run = r.id '
+                'WHERE r.tool = ? AND c.cache_hit = 0 AND (? IS NULL OR c.command = ?) ORDER BY c.start, c.id',
+                (tool, command, command)):
+            outcomes.setdefault((project, cmd), []).append(status == 0)
+        result = []
+        for (p, c), o in outcomes.iteritems():
+            o = o[-window:]
+            flips = sum(1 for a, b in zip(o, o[1:]) if a != b)
+            if flips:
+                result.append((p, c, len(o), o.count(False), flips))
+        result.sort(key = lambda r: (-r[4], -r[3], r[0], r[1]))
+        return result
+
+    def runs(self, limit = 10, tool = 'walk'):
+        """
+        The most recent runs, newest first
+
+        Returns (id, start, duration, status, commands, cache hits, args) tuples.
+        Duration and status are None for runs that haven't finished (yet).
+        """
+        return self.query('SELECT r.id, r.start, r.end - r.start, r.status, COUNT(c.id), COALESCE(SUM(c.cache_hit), 0), r.args '
+                          'FROM runs r LEFT JOIN commands c ON c.run = r.id WHERE r.tool = ? '
+                          'GROUP BY r.id ORDER BY r.start DESC, r.id DESC LIMIT ?', (tool, limit))
+
+    def peak_memory(self, project = None, command = 'build', recent = 20, tool = 'build.py'):
+        """
+        Most memory used by a single process in the last runs of a command
+
+        As a command's children are accounted for separately, that's roughly
+        what each of the jobs it runs in parallel needs. Returns the number of
+        bytes, or None if there are no runs with known memory usage.
+        """
+        try:
+            rows = self.query('SELECT c.maxrss FROM commands c JOIN runs r ON c.run = r.id '
+                              'WHERE r.tool = ? AND c.status = 0 AND c.cache_hit = 0 AND c.command = ? '
+                              'AND (? IS NULL OR c.project = ?) AND c.maxrss IS NOT NULL '
+                              'ORDER BY c.start DESC, c.id DESC LIMIT ?', (tool, command, project, project, recent))
+        except (sqlite3.Error, OSError):
+            return None
+        peak = max([r[0] for r in rows] or [0])
+        # ru_maxrss is in kilobytes, except on Mac OS X
+        return peak * (1 if sys.platform == 'darwin' else 1024) if peak else None
+
+def format_table(header, rows):
+    rows = [header] + [['-' if v is None else v for v in r] for r in rows]
+    widths = [max(len(str(r[i])) for r in rows) for i in range(len(header))]
+    return '\n'.join('  '.join(str(v).ljust(w) for v, w in zip(r, widths)).rstrip() for r in rows)
+
+def main(argv):
+    parser = OptionParser(usage = '{0} -m mirbuild.history [options] slowest|regressions|flaky|runs'.format(sys.executable))
+    parser.add_option('--db', dest = 'db', type = 'string',
+                      metavar = 'FILE', help = 'history database [default: {0}]'.format(HistoryDB.default_filename() or 'none'))
+    parser.add_option('-c', '--command', dest = 'command', type = 'string',
+                      metavar = 'CMD', help = 'only look at this command [default: all for slowest, build for '
+                      'regressions, test for flaky]')
+    parser.add_option('-d', '--days', dest = 'days', type = 'float',
+                      metavar = 'NUM', help = 'only look at the last NUM days')
+    parser.add_option('-n', '--limit', dest = 'limit', type = 'int', default = 10,
+                      metavar = 'NUM', help = 'show at most NUM entries [default: %default]')
+    parser.add_option('--walks', dest = 'tool', action = 'store_const', const = 'walk', default = 'build.py',
+                      help = 'look at commands as run by mirbuild.walk instead of build.py')
+    (opt, args) = parser.parse_args(argv)
+    if len(args) != 1 or args[0] not in ('slowest', 'regressions', 'flaky', 'runs'):
+        parser.error('expected one of slowest, regressions, flaky or runs')
+    filename = opt.db or HistoryDB.default_filename()
+    if not filename or not os.path.exists(filename):
+        raise RuntimeError('no build history found')
+    db = HistoryDB(filename)
+    since = time.time() - opt.days * 86400 if opt.days is not None else 0
+    secs = lambda s: None if s is None else '{0:.1f}s'.format(s)
+    if args[0] == 'slowest':
+        rows = db.slowest(opt.command, since, opt.limit, opt.tool)
+        print format_table(['PROJECT', 'COMMAND', 'RUNS', 'AVERAGE', 'MAX', 'CPU', 'MAXRSS'],
+                           [(p, c, n, secs(avg), secs(mx), secs(cpu), rss) for p, c, n, avg, mx, cpu, rss in rows])
+    elif args[0] == 'regressions':
+        rows = db.regressions(opt.command or 'build', since = since, tool = opt.tool)[:opt.limit]
+        print format_table(['PROJECT', 'COMMAND', 'BEFORE', 'RECENTLY', 'SLOWDOWN'],
+                           [(p, c, secs(old), secs(new), '{0:.0f}%'.format(100 * (r - 1))) for p, c, old, new, r in rows])
+    elif args[0] == 'flaky':
+        rows = db.flaky(opt.command or 'test', tool = opt.tool)[:opt.limit]
+        print format_table(['PROJECT', 'COMMAND', 'RUNS', 'FAILED', 'FLIPS'], rows)
+    else:
+        rows = db.runs(opt.limit, opt.tool)
+        print format_table(['RUN', 'STARTED', 'DURATION', 'STATUS', 'COMMANDS', 'CACHED', 'ARGS'],
+                           [(i, time.strftime('%Y-%m-%d %H:%M', time.localtime(s)),
+                             None if d is None else mirbuild.tools.format_duration(d), st, n, h, a)
+                            for i, s, d, st, n, h, a in rows])
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except RuntimeError as ex:
+        sys.stderr.write("ERROR: {0}\n".format(ex))
+        exit(1)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+r"""
+GNU make compatible jobserver
+
+A JobServer hands out a fixed number of job slots (tokens) through a pipe,
+using the same protocol as GNU make. Child processes find the pipe through
+the MAKEFLAGS environment variable, so any make started by a child, however
+deeply nested, will take its job slots from the same pool::
+
+  js = JobServer(8)
+  subprocess.call(['python', 'build.py', 'build'], env = js.environ())
+
+Python code running in a child process can take job slots using a JobClient
+for tools that don't speak the protocol themselves::
+
+  client = JobClient.from_environ()
+  if client is not None:
+      extra = client.acquire_available(7)
+      try:
+          run_tool(jobs = 1 + len(extra))
+      finally:
+          client.release(extra)
+
+Every process implicitly owns one job slot, so it only needs to acquire
+tokens for any additional jobs it wants to run.
+
+"""
+
+__all__ = 'JobServer JobClient'.split()
+
+import os, re, select, errno
+
+_jobserver_flag = re.compile(r'^--jobserver-(?:fds|auth)=(.*)$')
+
+def _strip_makeflags(flags):
+    # remove all job related flags so they can be replaced by ours
+    return [f for f in flags.split() if not (f.startswith('-j') or _jobserver_flag.match(f))]
+
+class JobClient(object):
+    def __init__(self, rfd, wfd):
+        self.__rfd = rfd
+        self.__wfd = wfd
+
+    @classmethod
+    def from_environ(cls, environ = None):
+        """
+        Return a client for the jobserver announced in MAKEFLAGS, or None
+        """
+        flags = (os.environ if environ is None else environ).get('MAKEFLAGS', '')
+        for f in flags.split():
+            m = _jobserver_flag.match(f)
+            if m is None:
+                continue
+            try:
+                if m.group(1).startswith('fifo:'):
+                    fd = os.open(m.group(1)[5:], os.O_RDWR)
+                    return cls(fd, fd)
+                (r, w) = [int(x) for x in m.group(1).split(',')]
+                if r < 0 or w < 0:
+                    return None
+                os.fstat(r)
+                os.fstat(w)
+                return cls(r, w)
+            except (ValueError, OSError):
+                # the file descriptors haven't been passed on to us
+                return None
+        return None
+
+    def acquire(self):
+        # blocks until a job slot is available
+        while True:
+            try:
+                return os.read(self.__rfd, 1)
+            except OSError as ex:
+                if ex.errno not in (errno.EINTR, errno.EAGAIN):
+                    raise
+
+    def acquire_available(self, max):
+        """
+        Take up to max tokens without waiting for tokens to become available
+        """
+        tokens = []
+        while len(tokens) < max:
+            if not select.select([self.__rfd], [], [], 0)[0]:
+                break
+            tokens.append(self.acquire())
+        return tokens
+
+    def release(self, tokens):
+        if isinstance(tokens, basestring):
+            tokens = [tokens]
+        for t in tokens:
+            os.write(self.__wfd, t)
+
+class JobServer(JobClient):
+    token = '+'
+
+    def __init__(self, jobs):
+        (r, w) = os.pipe()
+        JobClient.__init__(self, r, w)
+        self.__fds = (r, w)
+        self.__jobs = jobs
+        self.release([self.token] * jobs)
+
+    @property
+    def jobs(self):
+        return self.__jobs
+
+    @property
+    def makeflags(self):
+        return '-j --jobserver-fds={0},{1}'.format(*self.__fds)
+
+    def environ(self, environ = None):
+        env = dict(os.environ if environ is None else environ)
+        env['MAKEFLAGS'] = ' ' + ' '.join(_strip_makeflags(env.get('MAKEFLAGS', '')) + [self.makeflags])
+        return env
+
+    def close(self):
+        for fd in self.__fds:
+            os.close(fd)
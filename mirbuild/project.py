@@ -34,10 +34,10 @@ This is where it all comes together.
 __author__ = 'Marcus Holland-Moritz <marcus@last.fm>'
 __all__ = 'Project'.split()
 
-import errno, os, sys, glob, re, json, shutil
+import errno, os, sys, glob, re, json, shutil, time
 import mirbuild.dependency, mirbuild.test, mirbuild.environment
 import mirbuild.version, mirbuild.packaging, mirbuild.cache
-import mirbuild.plugin
+import mirbuild.plugin, mirbuild.history
 from optparse import OptionParser, OptionGroup
 from mirbuild.options import LocalOptions
 
@@ -49,6 +49,23 @@ def rootrelpath(path):
     #   return os.path.relpath(path, '/')
     return path.lstrip('/')    # work around http://bugs.python.org/issue5117
 
+def peek_option(args, option):
+    # value of an option with an argument, e.g. '-c|--configuration',
+    # before the command line has actually been parsed
+    names = option.split('|')
+    value = None
+    for i, arg in enumerate(args):
+        if arg == '--':
+            break
+        for n in names:
+            if arg == n and i + 1 < len(args):
+                value = args[i + 1]
+            elif n.startswith('--') and arg.startswith(n + '='):
+                value = arg[len(n) + 1:]
+            elif not n.startswith('--') and arg.startswith(n) and len(arg) > len(n):
+                value = arg[len(n):]
+    return value
+
 class InstallRule(object):
     pass
 
@@ -70,7 +87,7 @@ class Project(object):
         self.__test_runners = {}
 
         try:
-            self.__configurecache.load()
+            self.__configurecache.load(partition = self.__selected_cache_partition)
         except Exception:
             # if we can't load the cache, so be it
             pass
@@ -114,6 +131,9 @@ class Project(object):
         self.opt.ensure_value('jobs', self.__env.get('build', 'parallel', 'auto'))
         self.add_option('-j|--jobs', dest = 'jobs', type = 'string', metavar = 'NUM', cache = False,
                         help = 'number of parallel jobs to execute if possible')
+        self.opt.ensure_value('job_memory', self.__env.get('build', 'job_memory', None))
+        self.add_option('--job-memory', dest = 'job_memory', type = 'string', metavar = 'SIZE', cache = False,
+                        help = 'memory each job needs, like 2G, to limit "--jobs auto" (learned from the build history if not given)')
 
         self.add_option('--prefix', dest = 'prefix', type = 'string', default = self.default_install_path,
                         metavar = 'PATH', help = 'install prefix for this project')
@@ -240,6 +260,20 @@ class Project(object):
             return 'release'
         return self.build_configurations[0]
 
+    def __cache_partition(self, config, build_mode):
+        # each build configuration and mode gets its own set of cached options
+        return build_mode if config is None else '{0}:{1}'.format(config, build_mode)
+
+    def __selected_cache_partition(self, last):
+        # the options haven't been parsed yet, so peek at the command line
+        # and fill in whatever isn't given from the state saved last
+        last = last.get('general', {})
+        config = None
+        if self.has_build_configs:
+            config = peek_option(sys.argv[1:], '-c|--configuration') or last.get('configuration')
+        build_mode = peek_option(sys.argv[1:], '-b|--build-mode') or last.get('build_mode', 'in')
+        return self.__cache_partition(config, build_mode)
+
     def methlist(self, match):
         list = []
         run = re.compile(match)
@@ -428,6 +462,7 @@ class Project(object):
                 self._deps.apply(self)
 
             if command not in self.nocache_commands:
+                self.__configurecache.partition = self.__cache_partition(self.build_config, self.opt.build_mode)
                 self.__configurecache.save()
 
             self.env.vsay('''******************************
@@ -435,7 +470,7 @@ class Project(object):
    Action : {1}
 ******************************'''.format(self.build_config if self.has_build_configs else '(none)', command))
 
-            command_method(*args[1:])
+            self.__run_recorded(command, command_method, *args[1:])
 
         except RuntimeError as ex:
             if self.opt.debug:
@@ -449,12 +484,37 @@ class Project(object):
             sys.stderr.write('*** INTERRUPTED\n')
             raise SystemExit(1)
 
+    def __run_recorded(self, command, method, *args):
+        # everything but meta goes into the build history database
+        db = mirbuild.history.HistoryDB.open() if command not in self.nocache_commands else None
+        if db is None:
+            return method(*args)
+        start = time.time()
+        usage = mirbuild.history.resource_usage()
+        status = 1
+        try:
+            method(*args)
+            status = 0
+        except SystemExit as ex:
+            status = ex.code if isinstance(ex.code, int) else 0 if ex.code is None else 1
+            raise
+        finally:
+            run = db.begin_run('build.py', sys.argv[1:], start = start)
+            db.add_command(run, self.project_name, os.path.realpath(os.getcwd()), command, start, time.time(), status,
+                           self.build_config, mirbuild.history.usage_since(usage))
+            db.end_run(run, status)
+            db.close()
+
     def run_meta(self):
         meta = {
             'project': self.project_name,
             'commands': self.commands,
             'dependencies': self._deps.meta,
         }
+        if not self.options.get('in_process', True):
+            meta['in_process'] = False
+        if self.has_build_configs:
+            meta['configurations'] = self.build_configurations
         if self.__packagers:
             meta['packaging'] = {}
             for name, p in self.__packagers.iteritems():
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+r"""
+Log files and live status for walks
+
+When mirbuild.walk works on several projects at once, the output of each
+command is written to a log file of its own instead of the terminal::
+
+  ~/.cache/mirbuild/runs/20130611-142301-4711/libfoo/build.log
+
+While the walk is in progress, a status line for each running project shows
+the last line of output it has produced, if the output goes to a terminal.
+
+"""
+
+__all__ = 'CommandLog RunLogs StatusDisplay'.split()
+
+import os, re, sys, time, shutil, threading
+
+class CommandLog(object):
+    """
+    Output of a single command run for a project
+    """
+
+    def __init__(self, project, command, filename):
+        self.project = project
+        self.command = command
+        self.filename = filename
+        self.start = time.time()
+        self.last_line = ''
+        self.__partial = ''
+        # a large buffer, so chatty compilers don't cause lots of small writes
+        self.__fh = open(filename, 'wb', 1 << 16)
+
+    def write(self, data):
+        self.__fh.write(data)
+        lines = (self.__partial + data).split('\n')
+        self.__partial = lines.pop()[-1024:]
+        for line in reversed(lines):
+            if line.strip():
+                self.last_line = line.strip()
+                break
+
+    def capture(self, fh):
+        # copy everything from fh until it's closed
+        fd = fh.fileno()
+        for data in iter(lambda: os.read(fd, 1 << 16), ''):
+            self.write(data)
+
+    def close(self):
+        self.__fh.close()
+
+    def tail(self, num = 20):
+        try:
+            fh = open(self.filename, 'rb')
+            fh.seek(0, os.SEEK_END)
+            fh.seek(max(0, fh.tell() - 256 * num))
+            return fh.read().splitlines()[-num:]
+        except IOError:
+            return []
+
+class StatusDisplay(object):
+    """
+    One line per running command at the bottom of the terminal
+
+    The display must only be drawn and cleared while holding the lock that
+    serialises all other output.
+    """
+
+    def __init__(self, stream = sys.stdout):
+        self.__stream = stream
+        self.__logs = []
+        self.__drawn = 0
+
+    def add(self, log):
+        self.__logs.append(log)
+
+    def remove(self, log):
+        self.__logs.remove(log)
+
+    def __width(self):
+        try:
+            import fcntl, termios, struct
+            return struct.unpack('hh', fcntl.ioctl(self.__stream.fileno(), termios.TIOCGWINSZ, '1234'))[1] or 80
+        except Exception:
+            return 80
+
+    def clear(self):
+        if self.__drawn:
+            self.__stream.write('\x1b[{0}A\x1b[J'.format(self.__drawn))
+            self.__drawn = 0
+
+    def draw(self):
+        width = self.__width() - 1
+        now = time.time()
+        for log in list(self.__logs):
+            secs = int(now - log.start)
+            line = '[{0} {1} {2}:{3:02d}] {4}'.format(log.project, log.command, secs // 60, secs % 60, log.last_line)
+            self.__stream.write(line[:width] + '\n')
+            self.__drawn += 1
+        self.__stream.flush()
+
+class RunLogs(object):
+    """
+    All log files of a single walk, in a directory of their own
+    """
+
+    keep_runs = 20
+
+    def __init__(self, base, lock, live = False):
+        self.__base = base
+        self.dir = os.path.join(base, '{0}-{1}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+        self.__lock = lock
+        self.display = StatusDisplay() if live else None
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        os.makedirs(self.dir)
+        self.__prune()
+        if self.display is not None:
+            self.__thread = threading.Thread(target = self.__refresh)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__stopped.set()
+            self.__thread.join()
+            with self.__lock:
+                self.display.clear()
+
+    def __refresh(self):
+        while not self.__stopped.wait(0.5):
+            with self.__lock:
+                self.display.clear()
+                self.display.draw()
+
+    def __prune(self):
+        # only keep the logs of the most recent walks, and never touch
+        # anything else that might live in the same directory
+        runs = sorted(d for d in os.listdir(self.__base) if re.match(r'^\d{8}-\d{6}-\d+$', d)
+                      and os.path.isdir(os.path.join(self.__base, d)))
+        for d in runs[:-self.keep_runs]:
+            if os.path.join(self.__base, d) != self.dir:
+                shutil.rmtree(os.path.join(self.__base, d), True)
+
+    def open(self, project, command):
+        dir = os.path.join(self.dir, project)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        log = CommandLog(project, command, os.path.join(dir, command + '.log'))
+        if self.display is not None:
+            with self.__lock:
+                self.display.add(log)
+        return log
+
+    def close(self, log):
+        log.close()
+        if self.display is not None:
+            with self.__lock:
+                self.display.remove(log)
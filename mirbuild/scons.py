@@ -53,7 +53,16 @@ class SConsWriter(LazyFileWriter):
 
 class SConsEnvironment(mirbuild.environment.Environment):
     def build(self, *args):
-        self.execute(self.tool('scons'), *args)
+        # scons doesn't know about make's jobserver, so take the job slots
+        # on its behalf for the duration of the build
+        if self.jobserver is None:
+            self.execute(self.tool('scons'), *args)
+            return
+        tokens = self.jobserver.acquire_available(self.parallel_builds - 1)
+        try:
+            self.execute(self.tool('scons'), '-j{0}'.format(1 + len(tokens)), *args)
+        finally:
+            self.jobserver.release(tokens)
 
     def install(self, *args):
         self.execute(self.tool('scons'), 'install', *args)
@@ -105,10 +114,11 @@ class SConsProject(mirbuild.project.Project):
             self.__defines.update(name)
 
     def add_include_path(self, *args):
-        self.__incpath.append(*args)
+        # dependencies staged in a sysroot all share the same paths
+        self.__incpath.extend(a for a in args if a not in self.__incpath)
 
     def add_library_path(self, *args):
-        self.__libpath.append(*args)
+        self.__libpath.extend(a for a in args if a not in self.__libpath)
 
     def configure_release(self, slc):
         slc['CCFLAGS'] += '-Wall -O2 -g -DNDEBUG -fPIC'.split() # `getconf LFS_CFLAGS`
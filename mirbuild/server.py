@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+r"""
+Build server that keeps project state warm between builds
+
+Running ::
+
+  $ python -m mirbuild.server
+
+starts a server listening on a local UNIX socket. It has mirbuild and all its
+dependencies imported, and it keeps the meta information of all projects and
+the index of project locations in memory. For each base directory, it also
+keeps the walker along with the dependency graph, which are reused as long as
+no project has been added or removed and none of the files the meta
+information depends on (build.py, debian/control, debian/changelog and all
+.mirbuildrc files) has changed its size or modification time. Everything that
+depends on the contents of the projects, like fingerprints for incremental
+builds, is still worked out for each request. Commands are sent to the server
+using the thin client in mirbuild/client.py, which deliberately doesn't import
+mirbuild::
+
+  $ python /path/to/mirbuild/client.py build
+  $ python /path/to/mirbuild/client.py --walk -j 4 build test
+
+The first form runs build.py in the current directory, the second one runs
+mirbuild.walk with the given options. Both are run inside the server, in the
+client's working directory and environment, with all output sent back to the
+client. Projects that opted out of being run in-process are still run as a
+subprocess. The server handles one request at a time.
+
+"""
+
+__all__ = 'Server socket_path'.split()
+
+import os, sys, json, socket, subprocess, traceback
+from mirbuild.walk import Builder, Walker, MetaCache, ScanIndex, ProjectScanner, cache_dir, option_parser
+from mirbuild.environment import config_files
+from optparse import OptionParser
+
+# importing the mirbuild package pulls in everything build.py files need
+import mirbuild
+
+def socket_path():
+    # keep in sync with mirbuild/client.py
+    return os.environ.get('MIRBUILD_SERVER') or os.path.join(cache_dir(), 'server.sock')
+
+class Server(object):
+    def __init__(self, path = None):
+        self.__path = socket_path() if path is None else path
+        self.__metacache = MetaCache()
+        self.__scanindex = ScanIndex()
+        self.__walkers = {}
+        self.__running = False
+
+    @property
+    def path(self):
+        return self.__path
+
+    def __listen(self):
+        dir = os.path.dirname(self.__path)
+        if dir and not os.path.isdir(dir):
+            os.makedirs(dir)
+        if os.path.exists(self.__path):
+            # remove a stale socket, but don't take over from a running server
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.__path)
+                raise RuntimeError('server already running on {0}'.format(self.__path))
+            except socket.error:
+                os.remove(self.__path)
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.__path)
+        os.chmod(self.__path, 0600)
+        sock.listen(8)
+        return sock
+
+    def serve(self):
+        sock = self.__listen()
+        self.__running = True
+        try:
+            while self.__running:
+                conn = sock.accept()[0]
+                try:
+                    self.__handle(conn)
+                except socket.error:
+                    # the client has gone away
+                    pass
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    conn.close()
+        finally:
+            sock.close()
+            os.remove(self.__path)
+
+    def __handle(self, conn):
+        request = json.loads(conn.makefile('rb').readline())
+        command = request.get('command')
+        if command == 'shutdown':
+            self.__running = False
+            code = 0
+        elif command == 'ping':
+            code = 0
+        elif command in ('run', 'walk'):
+            code = self.__execute(conn, request)
+        else:
+            raise RuntimeError('invalid request "{0}"'.format(command))
+        # the token tells the client where the output ends
+        conn.sendall('{0} {1}\n'.format(request['token'], code))
+
+    def __execute(self, conn, request):
+        # The client's output goes to the socket for the duration of the request,
+        # this includes output from child processes.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = (os.dup(1), os.dup(2), os.getcwd(), dict(os.environ))
+        try:
+            os.dup2(conn.fileno(), 1)
+            os.dup2(conn.fileno(), 2)
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+            try:
+                if request['command'] == 'run':
+                    return self.__run(request['args'])
+                return self.__walk(request['args'])
+            except SystemExit as ex:
+                if ex.code is None or isinstance(ex.code, int):
+                    return ex.code or 0
+                sys.stderr.write('{0}\n'.format(ex.code))
+                return 1
+            except Exception:
+                traceback.print_exc()
+                return 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+            os.chdir(saved[2])
+            os.environ.clear()
+            os.environ.update(saved[3])
+            self.__metacache.save()
+
+    def __run(self, args):
+        if not os.path.exists(Builder.name):
+            raise RuntimeError('no {0} in {1}'.format(Builder.name, os.getcwd()))
+        try:
+            Builder(os.getcwd(), self.__metacache).execute(args, in_process = True)
+        except subprocess.CalledProcessError as ex:
+            return ex.returncode
+        return 0
+
+    def __walk(self, args):
+        parser = option_parser()
+        parser.set_defaults(in_process = True)
+        (opt, args) = parser.parse_args(args)
+        try:
+            if opt.nometacache:
+                metacache = False
+            elif opt.metacache or opt.refreshmeta:
+                metacache = MetaCache(opt.metacache, refresh = opt.refreshmeta)
+            else:
+                metacache = self.__metacache
+            scanindex = False if opt.noscanindex else self.__scanindex
+            if metacache is self.__metacache and scanindex is self.__scanindex:
+                walker = self.__walker(opt)
+            else:
+                walker = Walker(opt.base, metacache = metacache, metajobs = opt.metajobs, metatimeout = opt.metatimeout,
+                                scanindex = scanindex)
+            walker.walk(args, opt)
+        except RuntimeError as ex:
+            sys.stderr.write("ERROR: {0}\n".format(ex))
+            return 1
+        return 0
+
+    def __walker(self, opt):
+        # the walker of the last request for the same base, unless its graph might be out of date
+        base = os.path.realpath(opt.base)
+        stamp = self.__stamp(ProjectScanner(base, self.__scanindex).scan())
+        (old, walker) = self.__walkers.get(base, (None, None))
+        if walker is None or old != stamp:
+            self.__walkers.pop(base, None)
+            walker = Walker(base, metacache = self.__metacache, metajobs = opt.metajobs, metatimeout = opt.metatimeout,
+                            scanindex = self.__scanindex)
+            # a walker whose graph can't be built isn't kept
+            walker.graph
+            self.__walkers[base] = (stamp, walker)
+        return walker
+
+    def __stamp(self, projects):
+        # a cheap stand-in for the meta cache fingerprints of all projects
+        stamp = []
+        for path in projects:
+            for f in [os.path.join(path, n) for n in MetaCache.fingerprint_files] + config_files(path):
+                try:
+                    st = os.stat(f)
+                    stamp.append((f, st.st_size, st.st_mtime, st.st_ctime))
+                except OSError:
+                    stamp.append((f, None))
+        return stamp
+
+if __name__ == "__main__":
+    parser = OptionParser(usage = '{0} -m mirbuild.server [options]'.format(sys.executable))
+    parser.add_option('-s', '--socket', dest = 'socket', type = 'string',
+                      metavar = 'PATH', help = 'listen on this socket [default: {0}]'.format(socket_path()))
+    (opt, args) = parser.parse_args()
+    # don't let buffered output end up with the wrong client
+    sys.stdout = os.fdopen(1, 'w', 0)
+    try:
+        server = Server(opt.socket)
+        sys.stderr.write("listening on {0}\n".format(server.path))
+        server.serve()
+    except RuntimeError as ex:
+        sys.stderr.write("ERROR: {0}\n".format(ex))
+        exit(1)
+    except KeyboardInterrupt:
+        pass
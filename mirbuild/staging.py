@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+r"""
+Shared staging sysroot for walks
+
+Instead of pointing each project at the source directories of all its
+dependencies, mirbuild.walk can stage the headers and libraries of each
+project into one directory shared by the whole walk::
+
+  stage/include/foo/foo.h    -> src/libfoo/include/foo/foo.h
+  stage/lib/libfoo.so        -> src/libfoo/build/linux2/release/lib/libfoo.so
+
+Files are hard links to the originals where possible, so staging is cheap.
+A manifest records which files belong to which project, so files a project
+doesn't provide any more are removed when it's staged again, and two projects
+providing the same file are caught.
+
+"""
+
+__all__ = 'Sysroot'.split()
+
+import os, sys, glob, json, shutil, errno, threading
+
+class Sysroot(object):
+    """
+    Directory with the staged includes and libraries of a set of projects
+    """
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.__lock = threading.Lock()
+
+    @property
+    def manifest_file(self):
+        return os.path.join(self.path, self.manifest_name)
+
+    def __load(self):
+        try:
+            return json.load(open(self.manifest_file, 'r'))
+        except (IOError, ValueError):
+            return {}
+
+    def __save(self, manifest):
+        temp = '{0}.{1}.new'.format(self.manifest_file, os.getpid())
+        json.dump(manifest, open(temp, 'w'), indent = 4, sort_keys = True)
+        os.rename(temp, self.manifest_file)
+
+    @property
+    def projects(self):
+        # names of all projects with files in the sysroot
+        return sorted(p for p, files in self.__load().iteritems() if files)
+
+    @staticmethod
+    def library_dir(path, config = None):
+        """
+        Library directory of the project in path, or None
+
+        Projects build their libraries either in-source or out-of-source,
+        and possibly for more than one configuration. Unless a configuration
+        is given, the directory that has been written to last is the one the
+        latest build has used.
+        """
+        oos = os.path.join(path, 'build', sys.platform, '*' if config is None else config, 'lib')
+        dirs = [d for d in [os.path.join(path, 'lib')] + glob.glob(oos) if os.path.isdir(d)]
+        if config is not None and len(dirs) > 1:
+            # the configuration's own directory wins over the in-source one
+            dirs = dirs[1:]
+        return max(dirs, key = lambda d: os.stat(d).st_mtime) if dirs else None
+
+    @staticmethod
+    def __files(top):
+        files = []
+        for dir, dirs, names in os.walk(top):
+            dirs.sort()
+            for name in sorted(names) + [d for d in dirs if os.path.islink(os.path.join(dir, d))]:
+                files.append(os.path.relpath(os.path.join(dir, name), top))
+        return files
+
+    def __link(self, src, dst):
+        if os.path.islink(src):
+            # keep relative symlinks like libfoo.so -> libfoo.so.1 as they are
+            target = os.readlink(src)
+            if os.path.islink(dst) and os.readlink(dst) == target:
+                return
+            self.__remove(dst)
+            os.symlink(target, dst)
+            return
+        if os.path.exists(dst) and not os.path.islink(dst):
+            (s, d) = (os.stat(src), os.stat(dst))
+            if (s.st_dev, s.st_ino) == (d.st_dev, d.st_ino):
+                return
+        self.__remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError as ex:
+            if ex.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copy2(src, dst)
+
+    def __remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def __prune(self, path):
+        # remove directories that have become empty, but keep include and lib
+        dir = os.path.dirname(path)
+        while os.path.dirname(dir) != self.path:
+            try:
+                os.rmdir(dir)
+            except OSError:
+                break
+            dir = os.path.dirname(dir)
+
+    def stage(self, project, path, config = None):
+        """
+        Stage the includes and libraries of the project in path
+
+        Returns the number of files the project has in the sysroot.
+        """
+        files = {}
+        for (src, dst) in [(os.path.join(path, 'include'), 'include'), (self.library_dir(path, config), 'lib')]:
+            if src is not None and os.path.isdir(src):
+                for f in self.__files(src):
+                    files[os.path.join(dst, f)] = os.path.join(src, f)
+        with self.__lock:
+            for dir in ('include', 'lib'):
+                if not os.path.isdir(os.path.join(self.path, dir)):
+                    os.makedirs(os.path.join(self.path, dir))
+            manifest = self.__load()
+            owner = {}
+            for p, staged in manifest.iteritems():
+                if p != project:
+                    for f in staged:
+                        owner[f] = p
+            clashes = sorted(f for f in files if f in owner)
+            if clashes:
+                raise RuntimeError('cannot stage {0}, {1} already staged by {2}'.format(project, clashes[0], owner[clashes[0]]))
+            for f in manifest.get(project, []):
+                if f not in files:
+                    self.__remove(os.path.join(self.path, f))
+                    self.__prune(os.path.join(self.path, f))
+            for f in sorted(files):
+                dst = os.path.join(self.path, f)
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                self.__link(files[f], dst)
+            manifest[project] = sorted(files)
+            self.__save(manifest)
+        return len(files)
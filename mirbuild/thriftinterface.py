@@ -68,6 +68,16 @@ transport/TSimpleFileTransport.h transport/TSocket.h transport/TSocketPool.h
 transport/TTransport.h transport/TTransportException.h
 transport/TTransportUtils.h transport/TZlibTransport.h""".split())
 
+def _disjoint_namespaces(namespaces):
+    # Thrift writes the modules of a python namespace into the package named
+    # by it (plus empty __init__.py files for the packages above), so two
+    # namespaces clash if one is the same as or a parent of the other.
+    namespaces = sorted(namespaces)
+    for a, b in zip(namespaces, namespaces[1:]):
+        if b == a or b.startswith(a + '.'):
+            return False
+    return True
+
 class ThriftDependency(mirbuild.dependency.CLibraryDependency):
     def __init__(self, name):
         super(ThriftDependency, self).__init__(name)
@@ -298,8 +308,8 @@ class ThriftCompiler(object):
     def include(self, *args):
         self.__include += args
 
-    def run(self, generator, source, output_dir = None):
-        cmd = ['thrift']
+    def __command(self, generator, source, output_dir):
+        cmd = [self.__env.tool('thrift')]
         for i in self.__include:
             cmd += ['-I', os.path.realpath(i)]
         cmd += ['-I', '/usr/share/thrifts']    # add default include path (fixes MIR-2587)
@@ -308,7 +318,14 @@ class ThriftCompiler(object):
             if ('twisted' in generator) or ('tornado' in generator):
                 self.__env.execute_tool(['mkdir', '-p',  os.path.join(os.path.realpath(output_dir), 'gen-py')])
                 cmd += ['--out', os.path.join(os.path.realpath(output_dir), 'gen-py')]
-        self.__env.execute_tool(cmd + ['--gen', generator, os.path.relpath(source, self.__thrift_dir)], cwd = self.__thrift_dir)
+        return cmd + ['--gen', generator, os.path.relpath(source, self.__thrift_dir)]
+
+    def run(self, generator, source, output_dir = None):
+        self.__env.execute(self.__command(generator, source, output_dir), cwd = self.__thrift_dir)
+
+    def run_many(self, generator, sources, output_dir = None):
+        # only safe if the sources generate disjoint sets of output files
+        self.__env.execute_parallel([self.__command(generator, s, output_dir) for s in sources], cwd = self.__thrift_dir)
 
 
 
@@ -464,8 +481,14 @@ class ThriftInterface(mirbuild.cmake.CMakeProject, mirbuild.python.PythonSetupMi
                 thrift.include(os.path.join(self.opt.prefix, 'share', 'thrifts'), *self.__thriftspath)
                 twisted_ext = ',twisted' if self.__py_twisted else ''
                 generator = 'py:tornado' if self.__py_tornado else 'py:new_style=1' + twisted_ext
-                for i in self._py:
-                    thrift.run(generator = generator, output_dir = 'build', source = i)
+                # Without -r, thrift only generates the modules of the file it is given,
+                # not of included ones, so these can run concurrently if the namespaces
+                # don't overlap.
+                if _disjoint_namespaces(self._py.values()):
+                    thrift.run_many(generator = generator, output_dir = 'build', sources = self._py)
+                else:
+                    for i in self._py:
+                        thrift.run(generator = generator, output_dir = 'build', source = i)
 
         return self._py
 
@@ -31,7 +31,87 @@ Random collection of helper classes
 
 __author__ = 'Marcus Holland-Moritz <marcus@last.fm>'
 
-import os, filecmp, shutil, stat, errno
+import os, re, json, filecmp, shutil, stat, errno, threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# os.environ as it was before a build.py running in-process changed it
+_environ_lock = threading.Lock()
+_saved_environ = None
+
+def child_environ():
+    """
+    Environment for child processes
+
+    While a project runs in-process, os.environ is that project's environment,
+    so everything else started in the meantime must not simply inherit it.
+    """
+    with _environ_lock:
+        return dict(os.environ if _saved_environ is None else _saved_environ)
+
+def swap_environ(environ):
+    # replace os.environ, but keep handing out the old one from child_environ()
+    global _saved_environ
+    with _environ_lock:
+        _saved_environ = dict(os.environ)
+        os.environ.clear()
+        os.environ.update(environ)
+
+def restore_environ():
+    global _saved_environ
+    with _environ_lock:
+        if _saved_environ is not None:
+            os.environ.clear()
+            os.environ.update(_saved_environ)
+            _saved_environ = None
+
+def write_json(filename, data):
+    # write to a temporary file first, so readers never see a partial file
+    temp = '{0}.{1}.new'.format(filename, os.getpid())
+    dir = os.path.dirname(filename)
+    if dir and not os.path.isdir(dir):
+        os.makedirs(dir)
+    try:
+        json.dump(data, open(temp, 'w'))
+        os.rename(temp, filename)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+def cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))), 'mirbuild')
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '{0}s'.format(seconds)
+    if seconds < 3600:
+        return '{0}m{1:02d}s'.format(seconds // 60, seconds % 60)
+    return '{0}h{1:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+
+def parse_size(text):
+    # sizes like 512M or 10G, in bytes
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*$', text, re.IGNORECASE)
+    if m is None:
+        raise RuntimeError('invalid size "{0}"'.format(text))
+    return int(float(m.group(1)) * 1024 ** ['', 'k', 'm', 'g', 't'].index(m.group(2).lower()))
+
+def replace_file(src, dst):
+    try:
+        # try atomic rename first
+        os.rename(src, dst)
+    except OSError:
+        old = dst + '.old'
+        os.rename(dst, old)
+        try:
+            os.rename(src, dst)
+        except OSError:
+            os.rename(old, dst)
+            raise
+        os.remove(old)
 
 class ScopedChdir(object):
     def __init__(self, path):
@@ -74,18 +154,7 @@ class LazyFileWriter(object):
             mode = os.stat(self.__temp).st_mode
             mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
             os.chmod(self.__temp, mode)
-        try:
-            # try atomic rename first
-            os.rename(self.__temp, self.__name)
-        except OSError:
-            old = self.__name + '.old'
-            os.rename(self.__name, old)
-            try:
-                os.rename(self.__temp, self.__name)
-            except OSError:
-                os.rename(old, self.__name)
-                raise
-            os.remove(old)
+        replace_file(self.__temp, self.__name)
         return True
 
     def __del__(self):
@@ -97,6 +166,36 @@ class LazyFileWriter(object):
             except OSError:
                 pass
 
+class FileLock(object):
+    # Exclusive lock for use in a with statement. The lock file is never
+    # removed, as that would race with processes waiting for the lock. It
+    # may be replaced by renaming another file over it, though, so a data
+    # file can be its own lock.
+    # Without fcntl, i.e. on Windows, this doesn't actually lock anything.
+    def __init__(self, name):
+        self.__name = name
+        self.__fh = None
+
+    def __enter__(self):
+        while True:
+            self.__fh = open(self.__name, 'a')
+            if fcntl is None:
+                break
+            fcntl.flock(self.__fh.fileno(), fcntl.LOCK_EX)
+            try:
+                # we may have waited for a file that has been replaced since
+                if os.fstat(self.__fh.fileno()).st_ino == os.stat(self.__name).st_ino:
+                    break
+            except OSError:
+                pass
+            self.__fh.close()
+        return self
+
+    def __exit__(self, *args):
+        # closing the file releases the lock
+        self.__fh.close()
+        self.__fh = None
+
 class ScopedFileCopy(object):
     def __init__(self, name, backup = None, create = True):
         self.__name = name
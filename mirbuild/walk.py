@@ -24,50 +24,743 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
-import os, subprocess, json, sys, glob, errno
-from mirbuild.tools import ScopedChdir
+import os, re, subprocess, json, sys, glob, errno, heapq, threading, hashlib, fnmatch, time, traceback
+import mirbuild.environment, mirbuild.graph, mirbuild.jobserver, mirbuild.worker, mirbuild.runlog, mirbuild.staging
+import mirbuild.history, mirbuild.artifacts, mirbuild.tools
+from mirbuild.tools import cache_dir, format_duration, child_environ, write_json
 from optparse import OptionParser
 
-if hasattr(subprocess, 'check_output'):
-    my_check_output = subprocess.check_output
-else:
-    def my_check_output(*popenargs, **kwargs):
-        process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
-        output, unused_err = process.communicate()
-        retcode = process.poll()
-        if retcode:
-            cmd = kwargs.get("args")
-            if cmd is None:
-                cmd = popenargs[0]
-            raise subprocess.CalledProcessError(retcode, cmd)
-        return output
+try:
+    import Queue as queue
+except ImportError:
+    # called queue in python3
+    import queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # backport for python2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+_output_lock = threading.Lock()
+
+# live status of running projects, drawn below all other output
+_status = None
+
+# held while running a build.py in-process, as that changes process-wide state
+_in_process_lock = threading.Lock()
+
+def say(*args):
+    # whole lines only, so output from concurrent projects doesn't get garbled
+    with _output_lock:
+        if _status is not None:
+            _status.clear()
+        sys.stdout.write(''.join(args) + '\n')
+        if _status is not None:
+            _status.draw()
+        sys.stdout.flush()
+
+def git_changed_paths(path, revisions):
+    # paths changed in a revision range (or since a revision, including the working tree)
+    try:
+        top = subprocess.Popen(['git', 'rev-parse', '--show-toplevel'], cwd = path,
+                               stdout = subprocess.PIPE).communicate()[0].strip()
+        git = subprocess.Popen(['git', 'diff', '--name-only', revisions, '--'], cwd = path, stdout = subprocess.PIPE)
+        out = git.communicate()[0]
+    except OSError as ex:
+        raise RuntimeError('cannot run git: {0}'.format(ex))
+    if git.returncode != 0 or not top:
+        raise RuntimeError('cannot determine paths changed in {0}'.format(revisions))
+    return [os.path.join(top, f) for f in out.splitlines() if f]
+
+def changed_paths(opt):
+    paths = None
+    for arg in getattr(opt, 'changed', None) or []:
+        paths = (paths or []) + [p for p in arg.split(',') if p]
+    if getattr(opt, 'git_range', None) is not None:
+        paths = (paths or []) + git_changed_paths(opt.base, opt.git_range)
+    return paths
+
+class MetaCache(object):
+    """
+    Persistent cache for the meta information of build.py files
+
+    Entries are keyed by the real path of the project and are only valid as
+    long as the fingerprint of build.py, debian/control, debian/changelog and
+    all .mirbuildrc files applying to the project doesn't change. The cache is
+    shared by all walks of the current user, so it's merged with what's on disk
+    before it gets written back.
+    """
+
+    version = 2
+    fingerprint_files = ['build.py', os.path.join('debian', 'control'), os.path.join('debian', 'changelog')]
+
+    def __init__(self, filename = None, refresh = False):
+        if filename is None:
+            filename = os.path.join(cache_dir(), 'meta.json')
+        self.__file = filename
+        self.__refresh = refresh
+        self.__entries = None
+        self.__updated = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def filename(self):
+        return self.__file
+
+    def fingerprint(self, path):
+        h = hashlib.sha1()
+        files = [os.path.join(path, f) for f in self.fingerprint_files]
+        for f in files + mirbuild.environment.config_files(path):
+            h.update(f + '\0')
+            try:
+                h.update(open(f, 'rb').read())
+            except IOError:
+                h.update('\0')
+        return h.hexdigest()
+
+    def __read(self):
+        try:
+            data = json.load(open(self.__file, 'r'))
+            if data.get('version') == self.version:
+                return data['projects']
+        except Exception:
+            # missing or broken cache, start from scratch
+            pass
+        return {}
+
+    def get(self, path, fingerprint):
+        with self.__lock:
+            if self.__entries is None:
+                self.__entries = {} if self.__refresh else self.__read()
+            entry = self.__entries.get(path)
+        if entry is not None and entry['fingerprint'] == fingerprint:
+            return entry['meta']
+        return None
+
+    def put(self, path, fingerprint, meta):
+        with self.__lock:
+            entry = { 'fingerprint': fingerprint, 'meta': meta }
+            self.__updated[path] = entry
+            if self.__entries is not None:
+                self.__entries[path] = entry
+
+    def save(self):
+        with self.__lock:
+            if not self.__updated:
+                return
+            entries = self.__read()
+            entries.update(self.__updated)
+            for path in entries.keys():
+                if not os.path.exists(os.path.join(path, Builder.name)):
+                    del entries[path]
+            try:
+                write_json(self.__file, { 'version': self.version, 'projects': entries })
+                self.__updated = {}
+            except (IOError, OSError) as ex:
+                sys.stderr.write("WARNING: cannot write meta cache {0}: {1}\n".format(self.__file, ex))
+
+class ScanIndex(object):
+    """
+    Persistent index of the directories visited while scanning for projects
+
+    For each directory, the index stores its modification time along with the
+    subdirectories that need to be visited or the fact that it's a project or
+    pruned. As long as a directory's modification time doesn't change, it
+    doesn't need to be read again. Indexes for all base paths share one file,
+    which is only read once per ScanIndex object.
+    """
+
+    version = 1
+
+    def __init__(self, filename = None):
+        if filename is None:
+            filename = os.path.join(cache_dir(), 'scan.json')
+        self.__file = filename
+        self.__bases = None
+
+    def __read(self):
+        try:
+            data = json.load(open(self.__file, 'r'))
+            if data.get('version') == self.version:
+                return data['bases']
+        except Exception:
+            pass
+        return {}
+
+    def load(self, base):
+        if self.__bases is None:
+            self.__bases = self.__read()
+        return self.__bases.get(base, {})
+
+    def save(self, base, entries):
+        if self.__bases is not None:
+            self.__bases[base] = entries
+        bases = self.__read()
+        bases[base] = entries
+        try:
+            write_json(self.__file, { 'version': self.version, 'bases': bases })
+        except (IOError, OSError) as ex:
+            sys.stderr.write("WARNING: cannot write scan index {0}: {1}\n".format(self.__file, ex))
+
+class ProjectScanner(object):
+    """
+    Find all projects (i.e. directories containing a build.py) below a base path
+
+    The scanner never descends into hidden directories, project directories,
+    directories that typically only contain build output (prune_dirs) and
+    directories that look like out-of-source build trees (prune_markers).
+    Further directories can be excluded by listing shell patterns in an
+    ignore file in the base directory, one per line. Patterns containing a
+    slash are matched against the path relative to the base directory, all
+    other patterns against the directory name only, e.g.::
+
+      # third party code, never contains any projects
+      vendor
+      legacy/*/out
+    """
+
+    ignore_file = '.mirbuildignore'
+    prune_dirs = set('build CMakeFiles _CPack_Packages gen-cpp gen-py'.split())
+    prune_markers = set('CMakeCache.txt'.split())
+
+    def __init__(self, base, index = None):
+        self.__base = os.path.realpath(base)
+        self.__index = index
+        self.__ignore = self.__read_ignore_file()
+
+    def __read_ignore_file(self):
+        patterns = []
+        try:
+            for line in open(os.path.join(self.__base, self.ignore_file), 'r'):
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    patterns.append(line.strip('/'))
+        except IOError:
+            pass
+        return patterns
+
+    def __ignored(self, rel):
+        name = os.path.basename(rel)
+        for pat in self.__ignore:
+            if fnmatch.fnmatchcase(rel if '/' in pat else name, pat):
+                return True
+        return False
+
+    def __list(self, path):
+        dirs = []
+        files = set()
+        if scandir is not None:
+            # file types come with the directory entries, no need to stat each entry
+            for e in scandir(path):
+                if e.is_dir():
+                    dirs.append(e.name)
+                else:
+                    files.add(e.name)
+        else:
+            for e in os.listdir(path):
+                if os.path.isdir(os.path.join(path, e)):
+                    dirs.append(e)
+                else:
+                    files.add(e)
+        if Builder.name in files:
+            return ['project', []]
+        if files & self.prune_markers:
+            return ['pruned', []]
+        return ['dir', sorted(d for d in dirs if not d.startswith('.') and d not in self.prune_dirs)]
+
+    def scan(self):
+        old = self.__index.load(self.__base) if self.__index else {}
+        new = {}
+        found = []
+        todo = ['']
+        while todo:
+            rel = todo.pop()
+            path = os.path.join(self.__base, rel) if rel else self.__base
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            entry = old.get(rel)
+            if entry is None or entry[0] != mtime:
+                entry = [mtime] + self.__list(path)
+            new[rel] = entry
+            if entry[1] == 'project':
+                found.append(path)
+            else:
+                todo.extend(os.path.join(rel, d) for d in reversed(entry[2]) if not self.__ignored(os.path.join(rel, d)))
+        if self.__index and new != old:
+            self.__index.save(self.__base, new)
+        return found
+
+def tree_fingerprint(path, hash = None, prune = ProjectScanner.prune_dirs):
+    """
+    Fingerprint the contents of all files below path
+
+    Hidden files and directories as well as directories that only contain
+    build output are not taken into account.
+    """
+    h = hashlib.sha1() if hash is None else hash
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d not in prune)
+        for f in sorted(files):
+            if f.startswith('.'):
+                continue
+            name = os.path.join(root, f)
+            h.update(os.path.relpath(name, path) + '\0')
+            try:
+                fh = open(name, 'rb')
+                for chunk in iter(lambda: fh.read(1 << 16), ''):
+                    h.update(chunk)
+                fh.close()
+            except IOError:
+                h.update('\0')
+    return h.hexdigest()
+
+def exported_symbols(library, nm = 'nm'):
+    """
+    Sorted list of the dynamic symbols defined by a shared library
+
+    Returns None if nm isn't available or can't read the library.
+    """
+    try:
+        p = subprocess.Popen([nm, '-D', '--defined-only', '-P', library], env = child_environ(),
+                             stdout = subprocess.PIPE, stderr = open(os.devnull, 'w'))
+    except OSError:
+        return None
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        return None
+    # only name and type, addresses and sizes change with the implementation
+    return sorted(' '.join(line.split()[:2]) for line in out.splitlines() if line.strip())
+
+def interface_fingerprint(path, config = None, nm = 'nm'):
+    """
+    Fingerprint everything dependent projects use from the project in path
+
+    This covers the project's headers, its thrift files and the libraries
+    it has built. Shared libraries only contribute the symbols they export,
+    so changes to their implementation don't show up. Static libraries end up
+    in the binaries of dependent projects, so their contents are included.
+    Returns None if the project doesn't provide any of these.
+    """
+    h = hashlib.sha1()
+    found = False
+    for dir in ('include', 'thrifts', os.path.join('share', 'thrifts')):
+        if os.path.isdir(os.path.join(path, dir)):
+            h.update(dir + '\0' + tree_fingerprint(os.path.join(path, dir), prune = ()) + '\0')
+            found = True
+    libdir = mirbuild.staging.Sysroot.library_dir(path, config)
+    if libdir is not None:
+        for root, dirs, files in os.walk(libdir):
+            dirs.sort()
+            for f in sorted(files):
+                name = os.path.join(root, f)
+                if not re.search(r'\.(so(\.\d+)*|a|dylib)$', f):
+                    continue
+                found = True
+                h.update(os.path.relpath(name, libdir) + '\0')
+                if os.path.islink(name):
+                    h.update('-> ' + os.readlink(name) + '\0')
+                    continue
+                symbols = exported_symbols(name, nm) if not f.endswith('.a') else None
+                if symbols is not None:
+                    h.update('\n'.join(symbols) + '\0')
+                else:
+                    h.update('{0}\0'.format(mirbuild.worker.file_digest(name)))
+    return h.hexdigest() if found else None
+
+class BuildState(object):
+    """
+    Persistent record of the fingerprints of successfully processed projects
+
+    A project's fingerprint covers everything that determines the outcome of
+    running a set of commands on it: the commands and their arguments, the
+    project's files, its .mirbuildrc chain and the fingerprints of all its
+    dependencies. Only the fingerprint of the last successful run is kept. It
+    is recorded after the commands have run, so files they create are part of
+    it as well.
+
+    With interfaces = True, the interface fingerprint of each project is
+    recorded as well, and dependent projects only depend on that instead of
+    the full fingerprint. So if only the implementation of a library changes,
+    projects using it are considered up to date.
+    """
+
+    version = 1
+
+    def __init__(self, filename = None, interfaces = False):
+        if filename is None:
+            filename = os.path.join(cache_dir(), 'state.json')
+        self.__file = filename
+        self.__lock = threading.Lock()
+        self.__use_interfaces = interfaces
+        (self.__state, self.__interfaces) = self.__read()
+        self.__updated = {}
+        self.__updated_interfaces = {}
+
+    def __read(self):
+        try:
+            data = json.load(open(self.__file, 'r'))
+            if data.get('version') == self.version:
+                return (data['projects'], data.get('interfaces', {}))
+        except Exception:
+            pass
+        return ({}, {})
+
+    def __dependency(self, key):
+        if self.__use_interfaces:
+            interface = self.interface(key)
+            if interface is not None:
+                return 'interface:' + interface
+        return self.get(key)
+
+    def fingerprint(self, builder, args, deps):
+        h = hashlib.sha1()
+        h.update(json.dumps(list(args)) + '\0')
+        for d in sorted(deps, key = lambda d: d.key):
+            h.update('{0}={1}\0'.format(d.key, self.__dependency(d.key)))
+        for rc in mirbuild.environment.config_files(builder.path):
+            h.update(rc + '\0')
+            try:
+                h.update(open(rc, 'rb').read())
+            except IOError:
+                pass
+        return tree_fingerprint(builder.path, h)
+
+    def get(self, key):
+        with self.__lock:
+            return self.__state.get(key)
+
+    def interface(self, key):
+        with self.__lock:
+            return self.__interfaces.get(key)
+
+    def put(self, builder, fingerprint):
+        interface = interface_fingerprint(builder.path, builder.config) if self.__use_interfaces else None
+        with self.__lock:
+            self.__state[builder.key] = fingerprint
+            self.__updated[builder.key] = fingerprint
+            # always replaced, so an interface recorded earlier never outlives a change
+            self.__interfaces[builder.key] = interface
+            self.__updated_interfaces[builder.key] = interface
+
+    def save(self):
+        with self.__lock:
+            if not self.__updated:
+                return
+            (state, interfaces) = self.__read()
+            state.update(self.__updated)
+            interfaces.update(self.__updated_interfaces)
+            try:
+                write_json(self.__file, { 'version': self.version, 'projects': state, 'interfaces': interfaces })
+                self.__updated = {}
+                self.__updated_interfaces = {}
+            except (IOError, OSError) as ex:
+                sys.stderr.write("WARNING: cannot write build state {0}: {1}\n".format(self.__file, ex))
+
+class BuildHistory(object):
+    """
+    Persistent record of how long each command took to run for each project
+
+    Durations are keyed by the real path of the project and the command. Each
+    new measurement is averaged with the previous one, so estimates follow
+    changes in build times without jumping around too much. For projects or
+    commands that haven't been run before, the average over all projects is
+    used instead.
+    """
+
+    version = 1
+
+    def __init__(self, filename = None):
+        if filename is None:
+            filename = os.path.join(cache_dir(), 'history.json')
+        self.__file = filename
+        self.__lock = threading.Lock()
+        self.__history = self.__read()
+        self.__updated = {}
+
+    def __read(self):
+        try:
+            data = json.load(open(self.__file, 'r'))
+            return data['projects'] if data.get('version') == self.version else {}
+        except Exception:
+            return {}
+
+    def get(self, path, command):
+        with self.__lock:
+            return self.__history.get(path, {}).get(command)
+
+    def put(self, path, command, duration):
+        with self.__lock:
+            old = self.__history.get(path, {}).get(command)
+            new = duration if old is None else (old + duration) / 2.0
+            self.__history.setdefault(path, {})[command] = new
+            self.__updated.setdefault(path, {})[command] = new
+
+    def known(self, path, commands):
+        with self.__lock:
+            return any(c in self.__history.get(path, {}) for c in commands)
+
+    def estimate(self, path, commands):
+        """
+        Estimated time in seconds to run commands on the project at path
+        """
+        with self.__lock:
+            total = 0.0
+            for c in commands:
+                d = self.__history.get(path, {}).get(c)
+                if d is None:
+                    known = [h[c] for h in self.__history.itervalues() if c in h]
+                    d = sum(known) / len(known) if known else 0.0
+                total += d
+            return total
+
+    def save(self):
+        with self.__lock:
+            if not self.__updated:
+                return
+            history = self.__read()
+            for path, durations in self.__updated.iteritems():
+                history.setdefault(path, {}).update(durations)
+            try:
+                write_json(self.__file, { 'version': self.version, 'projects': history })
+                self.__updated = {}
+            except (IOError, OSError) as ex:
+                sys.stderr.write("WARNING: cannot write build history {0}: {1}\n".format(self.__file, ex))
+
+class WalkJournal(object):
+    """
+    Append-only record of the progress of a walk, used by --track
+
+    Each line is a JSON object for either a command that has been run on a
+    project, with its status, duration and fingerprint, or a project that is
+    done. Every entry is synced to disk before the walk moves on, so after an
+    interruption the walk can resume with the first command of each project
+    that hasn't succeeded yet. A partial line left by a crash is ignored, and
+    files written by older versions (a plain list of finished projects) can
+    still be read.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.__lock = threading.Lock()
+        self.__fh = None
+        self.__finished = set()
+        self.__succeeded = {}
+        self.__legacy = False
+        self.__read()
+
+    def __read(self):
+        try:
+            data = open(self.filename, 'r').read()
+        except IOError:
+            return
+        if data.lstrip().startswith('['):
+            try:
+                self.__finished = set(json.loads(data))
+                self.__legacy = True
+            except ValueError:
+                pass
+            return
+        for line in data.splitlines():
+            try:
+                self.__replay(json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                pass
+
+    def __replay(self, entry):
+        project = entry['project']
+        if 'command' not in entry:
+            self.__finished.add(project)
+        elif entry['status'] == 'ok':
+            self.__succeeded.setdefault(project, {})[entry['command']] = entry['fingerprint']
+        else:
+            self.__succeeded.get(project, {}).pop(entry['command'], None)
+
+    @staticmethod
+    def fingerprint(command, args):
+        return hashlib.sha1(json.dumps([command] + list(args))).hexdigest()
+
+    def finished(self, project):
+        with self.__lock:
+            return project in self.__finished
+
+    def succeeded(self, project, command, fingerprint):
+        with self.__lock:
+            return self.__succeeded.get(project, {}).get(command) == fingerprint
+
+    def __append(self, entry):
+        with self.__lock:
+            self.__replay(entry)
+            if self.__fh is None:
+                if self.__legacy:
+                    # rewrite files in the old format once, then only ever append
+                    self.__convert()
+                    self.__legacy = False
+                self.__fh = open(self.filename, 'a+')
+                self.__fh.seek(0, os.SEEK_END)
+                if self.__fh.tell() > 0:
+                    self.__fh.seek(-1, os.SEEK_END)
+                    if self.__fh.read(1) != '\n':
+                        # terminate a line left incomplete by a crash
+                        self.__fh.write('\n')
+            self.__fh.write(json.dumps(entry, sort_keys = True) + '\n')
+            self.__fh.flush()
+            os.fsync(self.__fh.fileno())
+
+    def __convert(self):
+        temp = '{0}.{1}.new'.format(self.filename, os.getpid())
+        fh = open(temp, 'w')
+        for project in sorted(self.__finished):
+            fh.write(json.dumps({ 'project': project }) + '\n')
+        fh.close()
+        os.rename(temp, self.filename)
+
+    def record(self, project, command, status, duration, fingerprint):
+        self.__append({ 'project': project, 'command': command, 'status': status,
+                        'duration': round(duration, 3), 'fingerprint': fingerprint, 'time': int(time.time()) })
+
+    def finish(self, project):
+        self.__append({ 'project': project, 'time': int(time.time()) })
+
+    def close(self):
+        with self.__lock:
+            if self.__fh is not None:
+                self.__fh.close()
+                self.__fh = None
+
+    def clear(self):
+        self.close()
+        try:
+            os.remove(self.filename)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
 
 class Builder(object):
     name = 'build.py'
+    config = None
 
-    def __init__(self, path):
+    def __init__(self, path, metacache = None):
         self.__path = os.path.realpath(path)
         self.__metacache = None
+        self.__store = metacache
 
-    def __getmeta(self):
-        cd = ScopedChdir(self.__path)
+    def __querymeta(self, timeout):
+        # no ScopedChdir here, meta information is fetched by multiple threads
+        p = subprocess.Popen([sys.executable, self.name, '-q', 'meta'], cwd = self.__path, env = child_environ(),
+                             stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        expired = []
+        def kill():
+            expired.append(True)
+            p.kill()
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer is not None:
+            timer.daemon = True
+            timer.start()
         try:
-            return json.loads(my_check_output([sys.executable, self.name, '-q', 'meta']))
-        except subprocess.CalledProcessError:
-            print 'failed to get meta information from {0} in {1}'.format(self.name, self.__path)
-            raise
+            (out, err) = p.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if expired:
+            raise RuntimeError('{0} in {1} timed out after {2} seconds'.format(self.name, self.__path, timeout))
+        if p.returncode != 0:
+            lines = [l for l in err.splitlines() if l.strip()]
+            raise RuntimeError('failed to get meta information from {0} in {1} ({2}){3}'.format(
+                               self.name, self.__path, p.returncode, ': ' + lines[-1] if lines else ''))
+        try:
+            return json.loads(out)
+        except ValueError:
+            raise RuntimeError('invalid meta information from {0} in {1}'.format(self.name, self.__path))
+
+    def __getmeta(self, timeout = None):
+        if self.__store:
+            fingerprint = self.__store.fingerprint(self.__path)
+            meta = self.__store.get(self.__path, fingerprint)
+            if meta is not None:
+                return meta
+        meta = self.__querymeta(timeout)
+        if self.__store:
+            self.__store.put(self.__path, fingerprint, meta)
+        return meta
+
+    def fetch_meta(self, timeout = None):
+        if self.__metacache is None:
+            self.__metacache = self.__getmeta(timeout)
 
     @property
     def __meta(self):
-        if self.__metacache is None:
-            self.__metacache = self.__getmeta()
+        self.fetch_meta()
         return self.__metacache
 
-    def run(self, args, opt):
-        print '##### [{0}] running {1} {2}'.format(self.path, self.name, ' '.join(args))
+    def run(self, args, opt, environ = None):
+        say('##### [{0}] running {1} {2}'.format(self.path, self.name, ' '.join(args)))
         if not opt.dryrun:
-            cd = ScopedChdir(self.__path)
-            subprocess.check_call([sys.executable, self.name] + list(args))
+            self.execute(args, environ, getattr(opt, 'in_process', False))
+
+    def execute(self, args, environ = None, in_process = False, log = None):
+        cmd = [sys.executable, self.name] + list(args)
+        if environ is None:
+            environ = child_environ()
+        if log is not None:
+            # output can't be captured per project when running in-process
+            proc = subprocess.Popen(cmd, cwd = self.__path, env = environ, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+            log.capture(proc.stdout)
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+        elif in_process and self.in_process:
+            self.__run_in_process(args, environ)
+        else:
+            # no ScopedChdir here, the working directory is shared by all threads
+            subprocess.check_call(cmd, cwd = self.__path, env = environ)
+
+    def __run_in_process(self, args, environ):
+        """
+        Run build.py as if it was the main script, but without starting a new interpreter
+
+        This saves importing mirbuild and everything it depends on for each command.
+        build.py is run in a namespace of its own; the working directory, sys.argv,
+        sys.path, the environment and modules imported from the project directory
+        are restored afterwards. As all of these are shared by all threads, only one
+        project can be run in-process at a time.
+        """
+        script = os.path.join(self.__path, self.name)
+        with _in_process_lock:
+            saved = (os.getcwd(), sys.argv, list(sys.path), set(sys.modules))
+            code = 0
+            try:
+                os.chdir(self.__path)
+                sys.argv = [self.name] + list(args)
+                sys.path.insert(0, self.__path)
+                mirbuild.tools.swap_environ(environ)
+                try:
+                    namespace = { '__name__': '__main__', '__file__': script, '__builtins__': __builtins__ }
+                    exec compile(open(script, 'r').read(), script, 'exec') in namespace
+                except SystemExit as ex:
+                    code = ex.code
+                except Exception:
+                    traceback.print_exc()
+                    code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os.chdir(saved[0])
+                sys.argv = saved[1]
+                sys.path[:] = saved[2]
+                mirbuild.tools.restore_environ()
+                for name in set(sys.modules) - saved[3]:
+                    if (getattr(sys.modules[name], '__file__', None) or '').startswith(self.__path + os.sep):
+                        del sys.modules[name]
+        if code is not None and not isinstance(code, int):
+            sys.stderr.write('{0}\n'.format(code))
+            code = 1
+        if code:
+            raise subprocess.CalledProcessError(code, self.name)
 
     def supports(self, command):
         return command in self.commands or sum((cmd.startswith(command)) for cmd in self.commands) == 1
@@ -76,14 +769,32 @@ class Builder(object):
     def path(self):
         return self.__path
 
+    @property
+    def key(self):
+        # identifies the project in persistent state
+        return self.__path
+
     @property
     def project(self):
         return self.__meta['project']
 
+    @property
+    def configurations(self):
+        # None if the project doesn't have build configurations
+        return self.__meta.get('configurations')
+
     @property
     def commands(self):
         return self.__meta['commands']
 
+    @property
+    def in_process(self):
+        # projects can opt out of being run in-process by the walker
+        try:
+            return self.__meta.get('in_process', True)
+        except AttributeError:
+            return True
+
     @property
     def version(self):
         try:
@@ -102,179 +813,1073 @@ class Builder(object):
         except (TypeError, KeyError):
             return []
 
+class ConfiguredBuilder(object):
+    """
+    A project in one of the build configurations of a matrix walk
+
+    Everything but the name and the key is taken from the project's builder.
+    """
+
+    def __init__(self, builder, config):
+        self.builder = builder
+        self.config = config
+
+    def __getattr__(self, name):
+        return getattr(self.builder, name)
+
+    @property
+    def project(self):
+        return '{0}:{1}'.format(self.builder.project, self.config)
+
+    @property
+    def key(self):
+        return '{0}:{1}'.format(self.builder.path, self.config)
+
+class Scheduler(object):
+    """
+    Run an action for each node of a dependency graph, using up to 'jobs' threads
+
+    A node is started as soon as the action has finished successfully for all its
+    dependencies. Nodes that are ready at the same time are started in the order
+    they were given in, so a single job reproduces a plain sequential walk, unless
+    priorities are given, in which case ready nodes with higher priority go first.
+
+    If the action raises, no further nodes are started unless keep_going is set,
+    in which case only nodes depending (directly or indirectly) on the failed node
+    are skipped. Nodes that are already running are always allowed to finish.
+    """
+
+    def __init__(self, jobs = 1, keep_going = False):
+        self.__jobs = max(1, jobs)
+        self.__keep_going = keep_going
+        self.succeeded = []
+        self.failed = []
+        self.skipped = []
+        self.cancelled = []
+
+    @property
+    def ok(self):
+        return not (self.failed or self.skipped or self.cancelled)
+
+    def __execute(self, action, node, results):
+        try:
+            action(node)
+            results.put((node, None))
+        except BaseException as ex:
+            results.put((node, ex))
+
+    def __wait(self, results):
+        # a blocking get() without timeout cannot be interrupted in python2
+        while True:
+            try:
+                return results.get(True, 1.0)
+            except queue.Empty:
+                pass
+
+    @staticmethod
+    def critical_path(nodes, deps, cost):
+        """
+        For each node, the total cost of the longest chain of nodes that starts with it
+
+        A chain is a node, a node waiting for it, a node waiting for that one, and so on.
+        The nodes must be given in an order where each node comes after its dependencies.
+        """
+        rdeps = dict((n, []) for n in nodes)
+        for n in nodes:
+            for d in deps[n]:
+                rdeps[d].append(n)
+        chain = {}
+        for n in reversed(nodes):
+            chain[n] = cost[n] + max([chain[r] for r in rdeps[n]] or [0])
+        return chain
+
+    def __key(self, index, priority, node):
+        return (-priority[node] if priority is not None else 0, index[node], node)
+
+    def estimate(self, nodes, deps, cost, priority = None):
+        """
+        Simulate a run using cost[node] as the duration of each node and return the total time
+        """
+        index = dict((n, i) for i, n in enumerate(nodes))
+        waiting = dict((n, len(deps[n])) for n in nodes)
+        rdeps = dict((n, []) for n in nodes)
+        for n in nodes:
+            for d in deps[n]:
+                rdeps[d].append(n)
+
+        ready = [self.__key(index, priority, n) for n in nodes if waiting[n] == 0]
+        heapq.heapify(ready)
+        running = []
+        now = 0.0
+
+        while ready or running:
+            while ready and len(running) < self.__jobs:
+                node = heapq.heappop(ready)[-1]
+                heapq.heappush(running, (now + cost[node], index[node], node))
+            (now, i, node) = heapq.heappop(running)
+            for r in rdeps[node]:
+                waiting[r] -= 1
+                if waiting[r] == 0:
+                    heapq.heappush(ready, self.__key(index, priority, r))
+
+        return now
+
+    def run(self, nodes, deps, action, done = None, priority = None):
+        """
+        Run action(node) for all nodes, deps maps each node to the nodes it depends on
+
+        The optional done(node) callback is called from the calling thread whenever
+        a node has been processed successfully. The optional priority maps each node
+        to a number; among the nodes that are ready, those with higher numbers are
+        started first.
+        """
+        index = dict((n, i) for i, n in enumerate(nodes))
+        waiting = dict((n, len(deps[n])) for n in nodes)
+        rdeps = dict((n, []) for n in nodes)
+        for n in nodes:
+            for d in deps[n]:
+                rdeps[d].append(n)
+
+        ready = [self.__key(index, priority, n) for n in nodes if waiting[n] == 0]
+        heapq.heapify(ready)
+        results = queue.Queue()
+        running = 0
+        stopped = False
+
+        while running or (ready and not stopped):
+            while ready and not stopped and running < self.__jobs:
+                node = heapq.heappop(ready)[-1]
+                t = threading.Thread(target = self.__execute, args = (action, node, results))
+                t.daemon = True
+                t.start()
+                running += 1
+
+            node, error = self.__wait(results)
+            running -= 1
+
+            if error is None:
+                self.succeeded.append(node)
+                if done is not None:
+                    done(node)
+                for r in rdeps[node]:
+                    waiting[r] -= 1
+                    if waiting[r] == 0:
+                        heapq.heappush(ready, self.__key(index, priority, r))
+            elif isinstance(error, Exception):
+                self.failed.append((node, error))
+                if not self.__keep_going:
+                    stopped = True
+            else:
+                # KeyboardInterrupt, SystemExit and friends
+                raise error
+
+        blocked = set()
+        todo = [n for n, e in self.failed]
+        while todo:
+            for r in rdeps[todo.pop()]:
+                if r not in blocked:
+                    blocked.add(r)
+                    todo.append(r)
+
+        finished = set(self.succeeded) | set(n for n, e in self.failed)
+        for n in nodes:
+            if n not in finished:
+                (self.skipped if n in blocked else self.cancelled).append(n)
+
+        return self.ok
+
+class DpkgBatch(object):
+    """
+    A group of projects whose dpkg commands are run in a single transaction
+    """
+
+    def __init__(self, level, projects):
+        self.level = level
+        self.projects = projects
+
+    @property
+    def project(self):
+        return 'dpkg batch {0}'.format(self.level + 1)
+
 class Walker(object):
-    def __init__(self, path, env = None, fastscan = False):
-        self.__bpy = {}
-        self.__tracked = set()
-        self.__scan(path, fastscan, env)
+    dpkg_commands = ('debinstall', 'debremove', 'debpurge')
+    # commands whose outputs can be taken from the artifact cache instead
+    cacheable_commands = ('configure', 'build')
 
-    def __scan(self, path, fast, env):
-        if os.path.exists(os.path.join(path, Builder.name)):
-            b = Builder(path)
-            pro = os.path.split(path)[1] if fast else b.project
+    def __init__(self, path, env = None, fastscan = False, metacache = None, metajobs = None, metatimeout = 120,
+                 scanindex = None):
+        self.__bpy = {}
+        self.__graph = None
+        self.__reset()
+        self.__artifact_lock = threading.Lock()
+        self.__auto = None
+        self.__dpkg_lock = threading.Lock()
+        # pass metacache = False to disable the persistent meta cache
+        self.__metacache = MetaCache() if metacache is None else metacache
+        self.__metajobs = mirbuild.environment.available_cpus() if metajobs is None else metajobs
+        self.__metatimeout = metatimeout
+        # pass scanindex = False to always scan the full tree
+        scanner = ProjectScanner(path, ScanIndex() if scanindex is None else scanindex)
+        found = [Builder(p, self.__metacache) for p in scanner.scan()]
+        if not fastscan:
+            self.__prefetch(found)
+        for b in found:
+            pro = os.path.split(b.path)[1] if fastscan else b.project
             self.__bpy[pro] = b
             if env:
                 env.dbg("found " + pro)
-        else:
-            for e in os.listdir(path):
-                if not e.startswith('.'):
-                    p = os.path.join(path, e)
-                    if os.path.isdir(p):
-                        self.__scan(p, fast, env)
+        self.__save_meta()
 
-    def __project_deps(self, project, rec = False):
-        s = set()
-        try:
-            s |= set([self.__bpy[project]])
-            for x in self.__bpy[project].dependencies:
-                s |= self.__project_deps(x, True)
-        except KeyError:
-            if not rec:
-                raise RuntimeError("no such project: {0}".format(project))
-        return s
-
-    def __sorted_bpy(self, projects = None, force = False):
-        if projects is None:
-            bpy = self.__bpy.values()
-        else:
-            s = set()
-            for p in projects.split(','):
-                s |= self.__project_deps(p.rstrip(os.sep))
-            bpy = list(s)
-        return self.__sort_by_deps(bpy, force if projects is None else False)
+    def __reset(self):
+        # everything that only lives for one walk, so a walker can be reused
+        self.__journal = None
+        self.__uptodate = []
+        self.__jobserver = None
+        self.__deferred = {}
+        self.__workers = None
+        self.__logs = None
+        self.__sysroots = {}
+        self.__configs = None
+        self.__db = None
+        self.__run = None
+        self.__artifact_cache = None
+        self.__artifact_keys = {}
+        self.__toolchain = None
+        self.__artifacts = {}
+        self.__transferred = 0
+
+    def __save_meta(self):
+        if self.__metacache:
+            self.__metacache.save()
+
+    def __prefetch(self, builders):
+        # query all projects at once instead of lazily one at a time
+        sched = Scheduler(self.__metajobs, keep_going = True)
+        sched.run(builders, dict((b, []) for b in builders), lambda b: b.fetch_meta(self.__metatimeout))
+        if sched.failed:
+            self.__save_meta()
+            errors = sorted(str(ex) for b, ex in sched.failed)
+            raise RuntimeError('failed to get meta information for {0} project{1}:\n  {2}'.format(
+                               len(errors), '' if len(errors) == 1 else 's', '\n  '.join(errors)))
+
+    @property
+    def graph(self):
+        if self.__graph is None:
+            self.__prefetch(self.__bpy.values())
+            self.__graph = mirbuild.graph.DependencyGraph(dict((name, b.dependencies) for name, b in self.__bpy.iteritems()))
+        return self.__graph
+
+    def owners(self, paths):
+        """
+        Return the names of all projects that own any of the given paths
+
+        A changed .mirbuildrc file is owned by all projects below it.
+        """
+        projects = dict((b.path, name) for name, b in self.__bpy.iteritems())
+        owners = set()
+        for path in paths:
+            path = os.path.realpath(path)
+            if os.path.basename(path) == '.mirbuildrc':
+                top = os.path.dirname(path)
+                owners |= set(n for p, n in projects.iteritems() if p == top or p.startswith(top + os.sep))
+            while path:
+                if path in projects:
+                    owners.add(projects[path])
+                    break
+                (path, tail) = os.path.split(path)
+                if not tail:
+                    break
+        return owners
+
+    def affected(self, paths):
+        # all projects owning any of the paths plus everything that depends on them
+        return self.graph.reverse_closure(self.owners(paths))
+
+    def __selected_graph(self, projects = None, changed = None):
+        if projects is None and changed is None:
+            return self.graph
+        names = set(self.graph.nodes)
+        if projects is not None:
+            sel = [p.rstrip(os.sep) for p in projects.split(',')]
+            for name in sel:
+                if name not in self.graph:
+                    raise RuntimeError("no such project: {0}".format(name))
+            names = self.graph.closure(sel)
+        if changed is not None:
+            names &= self.affected(changed)
+        return self.graph.subgraph(names)
+
+    def __sorted_bpy(self, graph, force = False):
+        result = graph.sort()
+        if not result.ok:
+            sys.stderr.write("WARNING: cannot resolve dependencies for: {0}\n".format(', '.join(result.unresolved)))
+            for line in result.report():
+                sys.stderr.write("  - {0}\n".format(line))
+            if not force:
+                raise RuntimeError("dependency resolver failed")
+        return [self.__bpy[name] for name in result.order]
 
     @property
     def dependencies(self):
         return dict((project, b.path) for project, b in self.__bpy.iteritems())
 
-    def __sort_by_deps(self, src, force):
-        src.sort(key = lambda p: p.project)
-        dst = []
-        tmp = []
-        rec = set(src)
-        while src:
-            p = src.pop(0)
-            if set(p.dependencies) <= set(map(lambda p: p.project, dst)):
-                dst.append(p)
-            else:
-                tmp.append(p)
-            if not src:
-                if set(tmp) != set(rec):
-                    src = tmp
-                    rec = set(src)
-                    tmp = []
-                else:
-                    sys.stderr.write("WARNING: cannot resolve dependencies for: {0}\n".format(', '.join([p.project for p in tmp])))
-                    resolved = set([p.project for p in dst])
-                    for u in tmp:
-                        deps = set(u.dependencies) - resolved
-                        sys.stderr.write("  - project '{0}' depends on unknown project{1} {2}\n".format(u.project, '' if len(deps) == 1 else 's', ', '.join(deps)))
-                    if not force:
-                        raise RuntimeError("dependency resolver failed")
-        return dst
-
-    def check_run(self, args, opt):
-        print '##### [{0}] running {1}'.format(os.getcwd(), ' '.join(args))
+    def check_run(self, args, opt, cwd = None):
+        say('##### [{0}] running {1}'.format(cwd or os.getcwd(), ' '.join(args)))
         if not opt.dryrun:
-            subprocess.check_call(args)
+            subprocess.check_call(args, cwd = cwd, env = child_environ())
 
-    def run(self, args, opt):
-        print '##### [{0}] running {1}'.format(os.getcwd(), ' '.join(args))
+    def run(self, args, opt, cwd = None):
+        say('##### [{0}] running {1}'.format(cwd or os.getcwd(), ' '.join(args)))
         if not opt.dryrun:
-            subprocess.call(args)
+            subprocess.call(args, cwd = cwd, env = child_environ())
 
-    def debinstall(self, p, opt):
-        cd = ScopedChdir(os.path.split(p.path)[0])
+    def __deb_patterns(self, p):
+        cwd = os.path.split(p.path)[0]
+        return [os.path.join(cwd, "{0}_{1}*.deb".format(pkg, p.version)) for pkg in p.packages]
+
+    def __debs(self, p):
         debs = []
-        for pkg in p.packages:
-            deb = glob.glob("{0}_{1}*.deb".format(pkg, p.version))
+        for pattern in self.__deb_patterns(p):
+            deb = glob.glob(pattern)
             if len(deb) == 1:
                 debs.append(deb[0])
             elif len(deb) > 1:
-                print "*** WARNING"
+                say("*** WARNING")
+        return debs
+
+    def __dpkg_install(self, debs, opt, cwd = None):
         if debs:
             args = ['-i']
             if opt.force_install:
                 args = ['--force-depends'] + args
-            self.check_run(['/usr/bin/sudo', '/usr/bin/dpkg'] + args + debs, opt)
+            # dpkg can only be run once at a time
+            with self.__dpkg_lock:
+                self.check_run(['/usr/bin/sudo', '/usr/bin/dpkg'] + args + debs, opt, cwd)
+
+    def debinstall(self, p, opt):
+        cwd = os.path.split(p.path)[0]
+        self.__dpkg_install([os.path.basename(d) for d in self.__debs(p)], opt, cwd)
 
     def debremove(self, p, opt):
         if p.packages:
-            self.run(['/usr/bin/sudo', '/usr/bin/dpkg', '-r'] + p.packages, opt)
+            with self.__dpkg_lock:
+                self.run(['/usr/bin/sudo', '/usr/bin/dpkg', '-r'] + p.packages, opt)
 
     def debpurge(self, p, opt):
         if p.packages:
-            self.run(['/usr/bin/sudo', '/usr/bin/dpkg', '--purge'] + p.packages, opt)
+            with self.__dpkg_lock:
+                self.run(['/usr/bin/sudo', '/usr/bin/dpkg', '--purge'] + p.packages, opt)
+
+    def __batch(self, command, projects, opt):
+        # unlike their per-project counterparts, these raise if dpkg fails
+        if command == 'debinstall':
+            self.__dpkg_install(sum((self.__debs(p) for p in projects), []), opt)
+        else:
+            packages = sum((p.packages for p in projects), [])
+            if packages:
+                with self.__dpkg_lock:
+                    self.check_run(['/usr/bin/sudo', '/usr/bin/dpkg', '-r' if command == 'debremove' else '--purge'] + packages, opt)
+
+    def __split_dpkg(self, cmds):
+        # only trailing dpkg commands can be batched without changing the order of commands
+        i = len(cmds)
+        while i > 0 and cmds[i - 1] in self.dpkg_commands:
+            i -= 1
+        if any(c in self.dpkg_commands for c in cmds[:i]):
+            say('##### dpkg commands can only be batched at the end of the command list, not batching')
+            return (cmds, [])
+        return (cmds[:i], cmds[i:])
 
-    def __load_tracked(self, filename):
-        if filename is not None:
+    def __batches(self, bpy, deps, whole):
+        """
+        Add nodes for batched dpkg transactions to the list of projects
+
+        Projects are grouped by their level in the dependency graph. A project
+        can only be started once the batch of the level below it has finished,
+        so it will find its dependencies installed. If no commands need to be
+        run before the dpkg commands, all projects go into a single batch.
+        """
+        if whole:
+            batch = DpkgBatch(0, list(bpy))
+            deps = dict(deps)
+            deps[batch] = list(bpy)
+            return (list(bpy) + [batch], deps)
+        level = {}
+        for p in bpy:
+            level[p] = 1 + max([level[d] for d in deps[p]] or [-1])
+        batches = [DpkgBatch(l, [p for p in bpy if level[p] == l]) for l in range(max(level.values()) + 1)]
+        nodes = []
+        ndeps = {}
+        for b in batches:
+            for p in b.projects:
+                nodes.append(p)
+                ndeps[p] = deps[p] + ([batches[b.level - 1]] if b.level > 0 else [])
+            nodes.append(b)
+            ndeps[b] = list(b.projects)
+        return (nodes, ndeps)
+
+    def __run_batch(self, batch, cmds, opt, state, fdeps):
+        members = [p for p in batch.projects if p in self.__deferred]
+        if not members:
+            return
+        failed = {}
+        for c in cmds:
+            todo = [p for p in members if p not in failed]
+            if not todo:
+                break
             try:
-                self.__tracked = set(json.load(open(filename, 'r')))
-            except Exception:
-                pass
+                self.__batch(c, todo, opt)
+            except subprocess.CalledProcessError:
+                say('##### {0} of {1} projects failed, falling back to one project at a time'.format(c, len(todo)))
+                for p in todo:
+                    try:
+                        self.__batch(c, [p], opt)
+                    except subprocess.CalledProcessError:
+                        failed[p] = c
+        if state is not None and not opt.dryrun:
+            for p in members:
+                if p not in failed:
+                    state.put(p, state.fingerprint(p, self.__deferred[p], fdeps[p]))
+            if failed:
+                # the state is saved once a node is done, which a failed batch never is
+                state.save()
+        if failed:
+            raise RuntimeError('; '.join('command "{0}" failed for {1}'.format(c, ', '.join(p.project for p in members if failed.get(p) == c))
+                                         for c in cmds if c in failed.values()))
+
+    def __tracked(self, p):
+        return self.__journal is not None and self.__journal.finished(p.project)
 
-    def __save_tracked(self, filename):
-        if filename is not None:
-            json.dump(list(self.__tracked), open(filename, 'w'), indent = 4)
+    def __auto_jobs(self, opt):
+        # one per CPU we can use, as long as there's enough memory
+        if self.__auto is None:
+            memory = mirbuild.environment.job_memory(getattr(opt, 'job_memory', None))
+            self.__auto = mirbuild.environment.auto_jobs(memory)
+        return self.__auto
 
-    def __clear_tracked(self, filename):
-        if filename is not None:
+    def __jobs(self, opt):
+        num = getattr(opt, 'jobs', 1)
+        if num == 'auto':
+            return self.__auto_jobs(opt)
+        try:
+            return max(1, int(num))
+        except ValueError:
+            raise RuntimeError('Invalid value for number of parallel jobs ("{0}")'.format(num))
+
+    def __start_logs(self, opt, jobs):
+        # capture output per project once it would otherwise get mixed up
+        global _status
+        in_process = getattr(opt, 'in_process', False)
+        if opt.dryrun or getattr(opt, 'nologs', False) or (getattr(opt, 'logs', None) is None and (jobs == 1 or in_process)):
+            return
+        if in_process:
+            # output can't be captured per project when running in-process
+            sys.stderr.write("WARNING: writing log files, so --in-process is ignored\n")
+        base = opt.logs or os.path.join(cache_dir(), 'runs')
+        self.__logs = mirbuild.runlog.RunLogs(base, _output_lock, live = sys.stdout.isatty())
+        self.__logs.start()
+        say('##### logs in {0}'.format(self.__logs.dir))
+        _status = self.__logs.display
+
+    def __stop_logs(self):
+        global _status
+        if self.__logs is not None:
+            self.__logs.stop()
+            _status = None
+
+    def __num_workers(self, opt):
+        num = getattr(opt, 'workers', None)
+        if num is None or opt.dryrun:
+            return None
+        if num == 'auto':
+            return self.__auto_jobs(opt)
+        try:
+            return max(1, int(num))
+        except ValueError:
+            raise RuntimeError('Invalid value for number of workers ("{0}")'.format(num))
+
+    def __job_slots(self, opt):
+        # total number of jobs across all projects, or None to let each project decide
+        num = getattr(opt, 'jobslots', None)
+        if getattr(opt, 'nojobserver', False) or opt.dryrun:
+            return None
+        if num is None:
+            return self.__auto_jobs(opt) if (self.__num_workers(opt) or self.__jobs(opt)) > 1 else None
+        if num == 'auto':
+            return self.__auto_jobs(opt)
+        try:
+            return max(1, int(num))
+        except ValueError:
+            raise RuntimeError('Invalid value for number of job slots ("{0}")'.format(num))
+
+    def __inputs(self, deps):
+        with self.__artifact_lock:
+            return set(a for d in deps for a in self.__artifacts.get(d, []))
+
+    def __transfer(self, worker, deps):
+        # send the artifacts of all dependencies the worker doesn't have yet,
+        # unless it already has them in place, e.g. on a shared filesystem
+        missing = []
+        for path, sha1 in sorted(self.__inputs(deps) - worker.holds):
+            if not worker.has(path, sha1):
+                missing.append((path, sha1))
+            else:
+                worker.holds.add((path, sha1))
+        if missing:
+            say('##### sending {0} artifact{1} to {2}'.format(len(missing), '' if len(missing) == 1 else 's', worker.name))
+            for path, sha1 in missing:
+                worker.put(path, sha1, open(path, 'rb').read())
+                worker.holds.add((path, sha1))
+            with self.__artifact_lock:
+                self.__transferred += len(missing)
+
+    def __collect(self, worker, artifacts):
+        # fetch artifacts we don't have ourselves, unless we share a filesystem with the worker
+        for path, sha1 in artifacts:
+            if mirbuild.worker.file_digest(path) != sha1:
+                data = worker.get(path)
+                temp = '{0}.{1}.new'.format(path, os.getpid())
+                open(temp, 'wb').write(data)
+                os.rename(temp, path)
+
+    def __run_remote(self, worker, p, command, args):
+        say('##### [{0}] running {1} {2} on {3}'.format(p.path, p.name, ' '.join([command] + args), worker.name))
+        response = worker.run(p.path, [command], args, self.__deb_patterns(p))
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        produced = [(a['path'], a['sha1']) for a in response['artifacts']]
+        self.__collect(worker, produced)
+        worker.holds.update(produced)
+        with self.__artifact_lock:
+            self.__artifacts[p] = produced
+
+    def __run_logged(self, p, command, args, environ):
+        say('##### [{0}] running {1} {2}'.format(p.path, p.name, ' '.join([command] + args)))
+        log = self.__logs.open(p.project, command)
+        try:
             try:
-                os.remove(filename)
-            except OSError as ex:
-                if ex.errno != errno.ENOENT:
+                p.execute([command] + args, environ, log = log)
+            finally:
+                self.__logs.close(log)
+        except subprocess.CalledProcessError:
+            lines = log.tail()
+            say('\n'.join(['##### [{0}] last {1} lines of {2}:'.format(p.project, len(lines), log.filename)] +
+                           ['    ' + l for l in lines]))
+            raise
+
+    def __run_project(self, p, cmds, opt, state, deps, history, batched = []):
+        if self.__tracked(p):
+            say('project "{0}" is already tracked, skipping...'.format(p.project))
+            return
+        args = []
+        if not opt.nodeps:
+            args = map(lambda d: '--with-{0}={1}'.format(d, self.__bpy[d].path), p.dependencies)
+            if p.config in self.__sysroots and args:
+                args.append('--with-sysroot={0}'.format(self.__sysroots[p.config].path))
+        if p.config is not None:
+            # each configuration needs a build directory of its own
+            args.append('--configuration={0}'.format(p.config))
+            if len(self.__configs) > 1:
+                args.append('--build-mode=out')
+        key = list(cmds) + list(batched) + args
+        (akey, sources) = (None, None)
+        if self.__artifact_cache is not None and not batched and self.__cacheable(cmds):
+            (akey, sources) = self.__artifact_key(p, cmds, args, deps)
+            self.__artifact_keys[p] = akey
+        if state is not None:
+            if state.get(p.key) == state.fingerprint(p, key, deps):
+                say('project "{0}" is up to date, skipping...'.format(p.project))
+                self.__uptodate.append(p)
+                self.__cache_hit(p, cmds, opt)
+                return
+        if akey is not None:
+            num = self.__restore(p, akey)
+            if num is not None:
+                say('project "{0}" restored {1} file{2} from the artifact cache, skipping...'.format(
+                    p.project, num, '' if num == 1 else 's'))
+                self.__cache_hit(p, cmds, opt)
+                if state is not None:
+                    state.put(p, state.fingerprint(p, key, deps))
+                return
+        # The token we hold stands in for the implicit job slot of the
+        # project's build; any further jobs it runs take tokens of their own.
+        js = self.__jobserver
+        token = js.acquire() if js is not None else None
+        # all commands of a project go to the same worker
+        worker = self.__workers.acquire(self.__inputs(deps)) if self.__workers is not None else None
+        try:
+            environ = js.environ(child_environ()) if js is not None else None
+            if worker is not None:
+                self.__transfer(worker, deps)
+            resuming = self.__journal is not None
+            for c in cmds:
+                fingerprint = WalkJournal.fingerprint(c, args)
+                if resuming and self.__journal.succeeded(p.project, c, fingerprint):
+                    say('project "{0}" has already run "{1}", skipping...'.format(p.project, c))
+                    continue
+                # once a command is run again, all commands after it have to be run as well
+                resuming = False
+                start = time.time()
+                try:
+                    if hasattr(self, c):
+                        getattr(self, c)(p, opt)
+                    elif p.supports(c):
+                        if worker is not None:
+                            self.__run_remote(worker, p, c, args)
+                        elif self.__logs is not None:
+                            self.__run_logged(p, c, args, environ)
+                        else:
+                            p.run([c] + args, opt, environ)
+                    else:
+                        say('project "{0}" does not support "{1}" command, skipping...'.format(p.project, c))
+                        continue
+                except Exception as ex:
+                    self.__record(p, c, start, getattr(ex, 'returncode', 1))
+                    if self.__journal is not None and not opt.dryrun:
+                        self.__journal.record(p.project, c, 'failed', time.time() - start, fingerprint)
+                    if isinstance(ex, subprocess.CalledProcessError):
+                        raise RuntimeError('command "{0}" failed ({1})'.format(c, ex.returncode))
                     raise
+                self.__record(p, c, start, 0)
+                if not opt.dryrun:
+                    history.put(p.key, c, time.time() - start)
+                    if self.__journal is not None:
+                        self.__journal.record(p.project, c, 'ok', time.time() - start, fingerprint)
+        finally:
+            if worker is not None:
+                self.__workers.release(worker)
+            if token is not None:
+                js.release(token)
+        if akey is not None and not opt.dryrun:
+            self.__store(p, akey, sources)
+        self.__stage(p, opt)
+        if batched:
+            # the rest is done by the batch this project belongs to
+            self.__deferred[p] = key
+        elif state is not None and not opt.dryrun:
+            state.put(p, state.fingerprint(p, key, deps))
+
+    def __cache_hit(self, p, cmds, opt):
+        for c in cmds:
+            self.__record(p, c, time.time(), 0, cache_hit = True)
+        self.__stage(p, opt)
+
+    def __cacheable(self, cmds):
+        return 'build' in cmds and set(cmds) <= set(self.cacheable_commands)
+
+    def __artifact_key(self, p, cmds, args, deps):
+        # Dependencies count by their own keys rather than their paths, so
+        # the same sources give the same key in any checkout. Without keys
+        # for all dependencies, the project can't use the cache.
+        h = hashlib.sha1()
+        h.update(self.__toolchain + '\0')
+        h.update(json.dumps(list(cmds) + [a for a in args if not a.startswith('--with-')]) + '\0')
+        for d in sorted(deps, key = lambda d: d.key):
+            if self.__artifact_keys.get(d) is None:
+                return (None, None)
+            h.update('{0}={1}\0'.format(d.project, self.__artifact_keys[d]))
+        for rc in mirbuild.environment.config_files(p.path):
+            try:
+                h.update(open(rc, 'rb').read() + '\0')
+            except IOError:
+                pass
+        # configure.json is usually ignored by git, so it's not among the sources
+        h.update(json.dumps(mirbuild.artifacts.configured_options(p.path, p.config), sort_keys = True) + '\0')
+        sources = mirbuild.artifacts.source_files(p.path)
+        return (mirbuild.artifacts.files_fingerprint(p.path, sources, h), sources)
+
+    def __restore(self, p, akey):
+        try:
+            return self.__artifact_cache.restore(akey, p.path)
+        except (IOError, OSError) as ex:
+            say('WARNING: cannot restore project "{0}" from the artifact cache: {1}'.format(p.project, ex))
+            return None
+
+    def __store(self, p, akey, sources):
+        try:
+            outputs = mirbuild.artifacts.build_outputs(p.path, p.config, sources)
+            if self.__artifact_cache.store(akey, p.path, outputs) is None:
+                say('WARNING: outputs of project "{0}" changed while storing them in the artifact cache'.format(p.project))
+        except (IOError, OSError) as ex:
+            say('WARNING: cannot store project "{0}" in the artifact cache: {1}'.format(p.project, ex))
+
+    def __record(self, p, command, start, status, cache_hit = False):
+        if self.__db is not None:
+            self.__db.add_command(self.__run, p.project, p.path, command, start, time.time(), status,
+                                  config = p.config, cache_hit = cache_hit)
+
+    def __stage(self, p, opt):
+        # make the project's includes and libraries available to its dependents
+        if opt.dryrun:
+            return
+        # projects without build configurations go into the sysroots of all configurations
+        sysroots = [self.__sysroots[p.config]] if p.config in self.__sysroots else self.__sysroots.values()
+        for sysroot in sysroots:
+            num = sysroot.stage(getattr(p, 'builder', p).project, p.path, p.config)
+            if num:
+                say('##### [{0}] staged {1} file{2} in {3}'.format(p.path, num, '' if num == 1 else 's', sysroot.path))
+
+    def __done(self, p, opt, state, history):
+        if isinstance(p, DpkgBatch):
+            for m in p.projects:
+                if m in self.__deferred:
+                    self.__track(m, opt)
+        elif p not in self.__deferred:
+            self.__track(p, opt)
+        if state is not None:
+            state.save()
+        history.save()
+
+    def __schedule(self, sched, bpy, deps, cmds, history):
+        # Projects on the longest remaining chain of work are started first, so the
+        # long builds deep down in the graph don't end up running on their own at
+        # the end of the walk.
+        projects = [p for p in bpy if not isinstance(p, DpkgBatch)]
+        cost = dict((p, 0.0 if isinstance(p, DpkgBatch) or self.__tracked(p) else history.estimate(p.key, cmds))
+                    for p in bpy)
+        priority = Scheduler.critical_path(bpy, deps, cost)
+        unknown = len([p for p in projects if not history.known(p.key, cmds)])
+        if unknown < len(projects):
+            eta = sched.estimate(bpy, deps, cost, priority)
+            say('##### estimated time: {0}, done at {1}{2}'.format(format_duration(eta),
+                time.strftime('%H:%M:%S', time.localtime(time.time() + eta)),
+                ' ({0} project{1} without history)'.format(unknown, '' if unknown == 1 else 's') if unknown else ''))
+        return priority
+
+    def __configurations(self, opt):
+        configs = getattr(opt, 'configurations', None)
+        if configs is None:
+            return None
+        configs = [c.strip() for c in configs.split(',') if c.strip()]
+        if not configs or len(set(configs)) != len(configs):
+            raise RuntimeError('Invalid list of build configurations ("{0}")'.format(opt.configurations))
+        return configs
+
+    def __matrix(self, bpy, deps, fdeps, configs):
+        """
+        Turn each project into one node per build configuration
+
+        The nodes of a configuration depend on the nodes of the same configuration
+        of the project's dependencies, so all configurations share the same order
+        and can be worked on at the same time. Projects without build configurations
+        are only run once, and everything depending on them waits for that.
+        """
+        unsupported = []
+        for p in bpy:
+            missing = [c for c in configs if p.configurations is not None and c not in p.configurations]
+            if missing:
+                unsupported.append('{0} ({1})'.format(p.project, ', '.join(missing)))
+        if unsupported:
+            raise RuntimeError('build configurations not supported by {0}'.format(', '.join(unsupported)))
+        node = {}
+        nodes = []
+        for p in bpy:
+            for c in configs if p.configurations is not None else [None]:
+                node[p, c] = ConfiguredBuilder(p, c) if c is not None else p
+                nodes.append(node[p, c])
+        of = lambda p, c: node[p, c if p.configurations is not None else None]
+        def expand(edges, chain):
+            result = {}
+            for p in bpy:
+                if p.configurations is None:
+                    result[p] = sorted(set(of(d, c) for d in edges[p] for c in configs), key = nodes.index)
+                    continue
+                for i, c in enumerate(configs):
+                    result[node[p, c]] = [of(d, c) for d in edges[p]]
+                    if chain and i > 0:
+                        # configure writes files shared by all configurations into the
+                        # source tree, e.g. config.cmake, so don't run them concurrently
+                        result[node[p, c]].append(node[p, configs[i - 1]])
+            return result
+        return (nodes, expand(deps, True), expand(fdeps, False))
+
+    def __track(self, p, opt):
+        if self.__journal is not None and not opt.dryrun and not self.__tracked(p):
+            self.__journal.finish(p.project)
+
+    def __summary(self, sched):
+        projects = lambda nodes: [p for p in nodes if not isinstance(p, DpkgBatch)]
+        say('##### {0} succeeded{1}, {2} failed, {3} skipped, {4} not started'.format(
+            len(projects(sched.succeeded)), ' ({0} up to date)'.format(len(self.__uptodate)) if self.__uptodate else '',
+            len(sched.failed), len(projects(sched.skipped)), len(projects(sched.cancelled))))
+        for p, ex in sched.failed:
+            say('#####   failed: {0} ({1})'.format(p.project, ex))
+        if sched.skipped:
+            say('#####   skipped due to failed dependencies: {0}'.format(', '.join(p.project for p in sched.skipped)))
+        if sched.cancelled:
+            say('#####   not started: {0}'.format(', '.join(p.project for p in sched.cancelled)))
+        if self.__workers is not None:
+            say('#####   {0} artifact{1} sent to workers'.format(self.__transferred, '' if self.__transferred == 1 else 's'))
+
+    def __analyse(self, graph, commands, history):
+        depth = graph.depths()
+        reduced = graph.transitive_reduction()
+        projects = {}
+        for n in graph.nodes:
+            projects[n] = {
+                'path': self.__bpy[n].path,
+                'dependencies': sorted(graph.dependencies(n)),
+                'reduced_dependencies': sorted(d for d in reduced.dependencies(n)),
+                'depth': depth.get(n),
+                'fan_in': len(graph.dependents(n)),
+                'fan_out': len(graph.dependencies(n)),
+                'dependents': len(graph.reverse_closure([n])) - 1,
+            }
+        result = { 'projects': projects, 'unknown': graph.unknown, 'cycles': graph.sort().cycles, 'critical_path': None }
+        order = sorted(depth, key = lambda n: (depth[n], n))
+        if any(history.known(self.__bpy[n].path, commands) for n in order):
+            # the longest chain of work from a project at the bottom up to the top
+            cost = dict((n, history.estimate(self.__bpy[n].path, commands)) for n in order)
+            chain = Scheduler.critical_path(order, dict((n, graph.dependencies(n)) for n in order), cost)
+            path = [max(order, key = lambda n: (chain[n], -depth[n]))]
+            while True:
+                up = [r for r in graph.dependents(path[-1]) if r in chain]
+                if not up:
+                    break
+                path.append(max(sorted(up), key = lambda n: chain[n]))
+            for n in order:
+                projects[n].update({ 'duration': cost[n], 'chain': chain[n], 'critical': n in path })
+            result['critical_path'] = { 'commands': commands, 'duration': chain[path[0]], 'projects': path }
+        return (result, reduced)
+
+    def __dot(self, result, reduced):
+        critical = (result['critical_path'] or {}).get('projects', [])
+        hot = set(zip(critical[1:], critical[:-1]))
+        lines = ['digraph projects {', '    node [shape = box];']
+        for n in sorted(result['projects']):
+            info = result['projects'][n]
+            label = '{0}\\ndepth {1}, in {2}, out {3}'.format(n, '?' if info['depth'] is None else info['depth'],
+                                                                info['fan_in'], info['fan_out'])
+            if 'duration' in info:
+                label += '\\n{0}'.format(format_duration(info['duration']))
+            lines.append('    "{0}" [label = "{1}"{2}];'.format(n, label, ', color = red' if info.get('critical') else ''))
+        for n in sorted(result['projects']):
+            for d in sorted(set(reduced.dependencies(n)) | set(d for (x, d) in hot if x == n)):
+                lines.append('    "{0}" -> "{1}"{2};'.format(n, d, ' [color = red]' if (n, d) in hot else ''))
+        for n, deps in sorted(result['unknown'].iteritems()):
+            for d in deps:
+                lines.append('    "{0}" -> "{1}" [style = dashed];'.format(n, d))
+                lines.append('    "{0}" [style = dashed];'.format(d))
+        lines.append('}')
+        return '\n'.join(lines)
+
+    def __export_graph(self, graph, commands, opt):
+        """
+        Print the project graph along with some numbers to find bottlenecks
+
+        For each project, this has its depth (longest chain of dependencies below
+        it), fan-in (direct dependents), fan-out (direct dependencies) and number
+        of (direct or indirect) dependents. Given a build history for the commands,
+        it also has the estimated duration, the length of the longest chain of work
+        starting with the project and whether it's on the critical path.
+        """
+        (result, reduced) = self.__analyse(graph, commands, BuildHistory(getattr(opt, 'history', None)))
+        fmt = getattr(opt, 'graph_format', 'json')
+        if fmt == 'json':
+            print json.dumps(result, indent = 4, sort_keys = True)
+        elif fmt == 'dot':
+            print self.__dot(result, reduced)
+        else:
+            raise RuntimeError('Invalid graph format "{0}"'.format(fmt))
 
     def walk(self, cmds, opt):
-        self.__load_tracked(opt.track)
-        bpy = self.__sorted_bpy(opt.projects, opt.force)
+        # a project running in-process changes the working directory, so
+        # anything written while walking needs an absolute path
+        for name in ('track', 'state', 'history', 'logs', 'stage', 'artifact_dir'):
+            if getattr(opt, name, None) is not None:
+                setattr(opt, name, os.path.abspath(getattr(opt, name)))
+        self.__reset()
+        self.__journal = WalkJournal(opt.track) if opt.track is not None else None
+        changed = changed_paths(opt)
+        graph = self.__selected_graph(opt.projects, changed)
+        if cmds and cmds[0] == 'graph':
+            # cycles and unknown dependencies are part of the output, not an error
+            self.__export_graph(graph, cmds[1:] or ['build'], opt)
+            return
+        bpy = self.__sorted_bpy(graph, opt.force if opt.projects is None else False)
+        self.__save_meta()
         if opt.reverse:
             bpy.reverse()
         if not cmds:
             for p in bpy:
                 print p.project
+        elif not bpy and changed is not None:
+            say('##### no projects affected by changes')
         else:
-            for p in bpy:
-                if p.project in self.__tracked:
-                    print 'project "{0}" is already tracked, skipping...'.format(p.project)
+            # unresolved projects have been dropped if the resolver was forced
+            selected = set(bpy)
+            name = dict((b, n) for n, b in self.__bpy.iteritems() if b in selected)
+            edges = graph.dependents if opt.reverse else graph.dependencies
+            deps = dict((p, [self.__bpy[d] for d in edges(name[p]) if self.__bpy[d] in selected]) for p in bpy)
+            workers = self.__num_workers(opt)
+            jobs = workers or self.__jobs(opt)
+            sched = Scheduler(jobs, keep_going = getattr(opt, 'keep_going', False))
+            state = BuildState(opt.state, getattr(opt, 'interfaces', False)) if getattr(opt, 'incremental', False) else None
+            # the fingerprint of a project depends on its dependencies, not its dependents
+            fdeps = dict((p, [self.__bpy[d] for d in graph.dependencies(name[p]) if self.__bpy[d] in selected]) for p in bpy)
+            history = BuildHistory(getattr(opt, 'history', None))
+            self.__configs = self.__configurations(opt)
+            if self.__configs:
+                (bpy, deps, fdeps) = self.__matrix(bpy, deps, fdeps, self.__configs)
+            (nodes, batched) = (bpy, [])
+            if getattr(opt, 'batch_dpkg', False):
+                (cmds, batched) = self.__split_dpkg(cmds)
+                if batched:
+                    (nodes, deps) = self.__batches(bpy, deps, not cmds)
+            def action(p):
+                if isinstance(p, DpkgBatch):
+                    self.__run_batch(p, batched, opt, state, fdeps)
                 else:
-                    args = []
-                    if not opt.nodeps:
-                        args = map(lambda d: '--with-{0}={1}'.format(d, self.__bpy[d].path), p.dependencies)
-                    for c in cmds:
-                        if hasattr(self, c):
-                            getattr(self, c)(p, opt)
-                        elif p.supports(c):
-                            p.run([c] + args, opt)
-                        else:
-                            print 'project "{0}" does not support "{1}" command, skipping...'.format(p.project, c)
-                    if not opt.dryrun:
-                        self.__tracked.add(p.project)
-                        self.__save_tracked(opt.track)
+                    self.__run_project(p, cmds, opt, state, fdeps[p], history, batched)
+            priority = self.__schedule(sched, nodes, deps, cmds, history)
+            if jobs == 1:
+                # the order doesn't matter for the total time, keep it predictable
+                priority = None
+            if getattr(opt, 'stage', None) is not None:
+                if self.__configs:
+                    self.__sysroots = dict((c, mirbuild.staging.Sysroot(os.path.join(opt.stage, c))) for c in self.__configs)
+                else:
+                    self.__sysroots = { None: mirbuild.staging.Sysroot(opt.stage) }
+            slots = self.__job_slots(opt)
+            self.__jobserver = mirbuild.jobserver.JobServer(slots) if slots is not None else None
+            if workers:
+                environ = self.__jobserver.environ(child_environ()) if self.__jobserver is not None else child_environ()
+                self.__workers = mirbuild.worker.WorkerPool(mirbuild.worker.LocalWorker('worker {0}'.format(i + 1), environ)
+                                                            for i in range(workers))
+            self.__start_logs(opt, jobs)
+            server = getattr(opt, 'artifact_server', None)
+            if (getattr(opt, 'artifact_cache', False) or server) and not opt.dryrun:
+                size = mirbuild.tools.parse_size(getattr(opt, 'artifact_cache_size', None) or '10G')
+                remote = mirbuild.artifacts.RemoteCache(server) if server else None
+                self.__artifact_cache = mirbuild.artifacts.ArtifactCache(getattr(opt, 'artifact_dir', None), size, remote)
+                self.__toolchain = mirbuild.artifacts.toolchain_fingerprint(child_environ())
             if not opt.dryrun:
-                self.__clear_tracked(opt.track);
+                self.__db = mirbuild.history.HistoryDB.open()
+                self.__run = self.__db.begin_run('walk', cmds) if self.__db is not None else None
+            completed = False
+            try:
+                sched.run(nodes, deps, action, lambda p: self.__done(p, opt, state, history), priority)
+                completed = True
+            finally:
+                if self.__db is not None:
+                    self.__db.end_run(self.__run, 0 if completed and sched.ok else 1)
+                    self.__db.close()
+                    self.__db = None
+                self.__stop_logs()
+                history.save()
+                if self.__workers is not None:
+                    self.__workers.close()
+                if self.__jobserver is not None:
+                    self.__jobserver.close()
+                    self.__jobserver = None
+                if self.__journal is not None:
+                    self.__journal.close()
+            if len(bpy) > 1 or not sched.ok:
+                self.__summary(sched)
+            if not sched.ok:
+                raise RuntimeError('{0} project{1} failed'.format(len(sched.failed), '' if len(sched.failed) == 1 else 's'))
+            if self.__journal is not None and not opt.dryrun:
+                self.__journal.clear()
 
-if __name__ == "__main__":
-    parser = OptionParser(usage = '{0} -m mirbuild.walk [options] [mirbuild commands]'.format(sys.executable))
+def option_parser():
+    parser = OptionParser(usage = '{0} -m mirbuild.walk [options] [mirbuild commands | graph [commands]]'.format(sys.executable))
     parser.add_option('-t', '--track', dest = 'track', type = 'string',
                       metavar = 'FILE', help = 'track projects that have already been worked on')
     parser.add_option('-p', '--projects', dest = 'projects', type = 'string',
                       metavar = 'NAME', help = 'run only for dependencies of comma-separated projects')
+    parser.add_option('-a', '--affected-by', dest = 'changed', type = 'string', action = 'append',
+                      metavar = 'PATHS', help = 'run only for projects affected by changes to comma-separated paths')
+    parser.add_option('-g', '--git-range', dest = 'git_range', type = 'string',
+                      metavar = 'REVS', help = 'run only for projects affected by changes in this git revision range')
     parser.add_option('-b', '--base', dest = 'base', type = 'string', default = '.',
                       metavar = 'PATH', help = 'base path to projects')
     parser.add_option('-r', '--reverse', dest = 'reverse', default = False, action = 'store_true',
                       help = 'reverse dependency order')
     parser.add_option('-n', '--no-deps', dest = 'nodeps', default = False, action = 'store_true',
                       help = 'do not set --with-xxx for dependent projects')
+    parser.add_option('-c', '--configurations', dest = 'configurations', type = 'string',
+                      metavar = 'CFGS', help = 'run the commands for each of these comma-separated build configurations')
+    parser.add_option('-S', '--stage', dest = 'stage', type = 'string',
+                      metavar = 'DIR', help = 'stage includes and libraries of all projects in DIR and '
+                      'let dependent projects use them from there')
     parser.add_option('-f', '--force', dest = 'force', default = False, action = 'store_true',
                       help = 'force action even if dependency resolver fails')
     parser.add_option('-F', '--force-install', dest = 'force_install', default = False, action = 'store_true',
                       help = 'force dpkg install even if dependency problems are reported')
+    parser.add_option('-j', '--jobs', dest = 'jobs', type = 'string', default = '1',
+                      metavar = 'NUM', help = 'number of projects to work on in parallel, or "auto"')
+    parser.add_option('-l', '--job-slots', dest = 'jobslots', type = 'string',
+                      metavar = 'NUM', help = 'total number of jobs shared by all projects, or "auto" '
+                      '[default: "auto" if working on projects in parallel]')
+    parser.add_option('--job-memory', dest = 'job_memory', type = 'string',
+                      metavar = 'SIZE', help = 'memory each job needs, like 2G, to limit "auto" numbers of projects, '
+                      'workers and job slots [default: learned from the build history]')
+    parser.add_option('--no-jobserver', dest = 'nojobserver', default = False, action = 'store_true',
+                      help = 'let each project decide on its own number of jobs')
+    parser.add_option('-w', '--workers', dest = 'workers', type = 'string',
+                      metavar = 'NUM', help = 'hand projects to this many local worker processes, or "auto"; implies -j NUM')
+    parser.add_option('--logs', dest = 'logs', type = 'string',
+                      metavar = 'DIR', help = 'write the output of each project to log files in a new directory in DIR '
+                      '[default: {0} if working on projects in parallel]'.format(os.path.join(cache_dir(), 'runs')))
+    parser.add_option('--no-logs', dest = 'nologs', default = False, action = 'store_true',
+                      help = 'do not write log files, send all output to the terminal')
+    parser.add_option('--graph-format', dest = 'graph_format', type = 'choice', choices = ['json', 'dot'], default = 'json',
+                      metavar = 'FORMAT', help = 'output format of the graph command, json or dot [default: %default]')
+    parser.add_option('-k', '--keep-going', dest = 'keep_going', default = False, action = 'store_true',
+                      help = 'keep going with independent projects if a project fails')
+    parser.add_option('--fail-fast', dest = 'keep_going', action = 'store_false',
+                      help = 'do not start any more projects once a project fails [default]')
+    parser.add_option('-B', '--batch-dpkg', dest = 'batch_dpkg', default = False, action = 'store_true',
+                      help = 'install or remove the packages of all projects on the same dependency level at once')
+    parser.add_option('-I', '--in-process', dest = 'in_process', default = False, action = 'store_true',
+                      help = 'run build.py commands in the walker process instead of starting a new python for each; '
+                      'implies --no-logs unless --logs is given, which turns this off')
+    parser.add_option('-i', '--incremental', dest = 'incremental', default = False, action = 'store_true',
+                      help = 'skip projects that have not changed since the commands last ran successfully')
+    parser.add_option('--interfaces', dest = 'interfaces', default = False, action = 'store_true',
+                      help = 'with --incremental, only rebuild projects if the interface of a dependency has '
+                      'changed (its headers, thrift files or exported symbols), not just its implementation')
+    parser.add_option('--artifact-cache', dest = 'artifact_cache', default = False, action = 'store_true',
+                      help = 'take the outputs of building projects from a cache if the same sources, configuration, '
+                      'toolchain and dependencies have been built before')
+    parser.add_option('--artifact-dir', dest = 'artifact_dir', type = 'string',
+                      metavar = 'DIR', help = 'keep the artifact cache in this directory [default: {0}]'.format(
+                      os.path.join(cache_dir(), 'artifacts')))
+    parser.add_option('--artifact-cache-size', dest = 'artifact_cache_size', type = 'string', default = '10G',
+                      metavar = 'SIZE', help = 'evict the least recently used outputs from the artifact cache '
+                      'beyond this size [default: %default]')
+    parser.add_option('--artifact-server', dest = 'artifact_server', type = 'string',
+                      metavar = 'URL', help = 'share the artifact cache with other machines through this server, '
+                      'see mirbuild.artifactserver; implies --artifact-cache')
+    parser.add_option('--state', dest = 'state', type = 'string',
+                      metavar = 'FILE', help = 'record project fingerprints for --incremental in this file [default: {0}]'.format(
+                      os.path.join(cache_dir(), 'state.json')))
+    parser.add_option('--history', dest = 'history', type = 'string',
+                      metavar = 'FILE', help = 'record how long commands take in this file [default: {0}]'.format(
+                      os.path.join(cache_dir(), 'history.json')))
     parser.add_option('--dry-run', dest = 'dryrun', default = False, action = 'store_true',
                       help = 'do not actually run the commands')
-    (opt, args) = parser.parse_args()
+    parser.add_option('--meta-cache', dest = 'metacache', type = 'string',
+                      metavar = 'FILE', help = 'cache project meta information in this file [default: {0}]'.format(MetaCache().filename))
+    parser.add_option('--no-meta-cache', dest = 'nometacache', default = False, action = 'store_true',
+                      help = 'do not use the persistent meta information cache')
+    parser.add_option('--refresh-meta', dest = 'refreshmeta', default = False, action = 'store_true',
+                      help = 'ignore cached meta information and query all projects again')
+    parser.add_option('--meta-jobs', dest = 'metajobs', type = 'int',
+                      metavar = 'NUM', help = 'number of projects to query for meta information in parallel [default: number of CPUs]')
+    parser.add_option('--meta-timeout', dest = 'metatimeout', type = 'float', default = 120,
+                      metavar = 'SECONDS', help = 'time limit for querying meta information from a project [default: %default]')
+    parser.add_option('--no-scan-index', dest = 'noscanindex', default = False, action = 'store_true',
+                      help = 'do not use the persistent index of project locations')
+    return parser
+
+if __name__ == "__main__":
+    (opt, args) = option_parser().parse_args()
     try:
-        Walker(opt.base).walk(args, opt)
+        metacache = False if opt.nometacache else MetaCache(opt.metacache, refresh = opt.refreshmeta)
+        scanindex = False if opt.noscanindex else None
+        Walker(opt.base, metacache = metacache, metajobs = opt.metajobs, metatimeout = opt.metatimeout,
+               scanindex = scanindex).walk(args, opt)
     except RuntimeError as ex:
         sys.stderr.write("ERROR: {0}\n".format(ex))
         exit(1)
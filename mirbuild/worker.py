@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+r"""
+Workers for distributed walks
+
+mirbuild.walk can hand projects to a pool of workers instead of running
+build.py itself. Workers speak a simple request/response protocol, one JSON
+object per line. A request to build a project looks like this::
+
+  { "op": "run", "path": "/src/libfoo", "commands": ["package"],
+    "args": ["--with-libbar=/src/libbar"], "artifacts": ["/src/libfoo_1.0*.deb"] }
+
+and the response lists the artifacts matching the given patterns once the
+commands have finished, along with how long each command took::
+
+  { "ok": true, "durations": { "package": 12.3 },
+    "artifacts": [{ "path": "/src/libfoo_1.0_amd64.deb", "sha1": "...", "size": 1234 }] }
+
+Artifacts are moved between workers using "get" and "put" requests. The walker
+keeps track of which worker holds which artifacts, so each artifact is only
+sent to each worker once. Before sending one, it asks the worker using a "has"
+request, as a worker sharing the filesystem with the walker already has it::
+
+  { "op": "has", "path": "/src/libfoo_1.0_amd64.deb", "sha1": "..." }
+
+The only kind of worker so far is a LocalWorker, which runs
+
+  $ python -m mirbuild.worker
+
+as a subprocess. Output of the commands goes to stderr, stdout is reserved for
+the protocol.
+
+"""
+
+__all__ = 'Worker LocalWorker WorkerPool'.split()
+
+import os, sys, json, glob, base64, hashlib, subprocess, threading, time
+
+def file_digest(path):
+    try:
+        h = hashlib.sha1()
+        fh = open(path, 'rb')
+        for chunk in iter(lambda: fh.read(1 << 16), ''):
+            h.update(chunk)
+        fh.close()
+        return h.hexdigest()
+    except IOError:
+        return None
+
+class Worker(object):
+    def __init__(self, name):
+        self.name = name
+        # (path, sha1) of all artifacts this worker has
+        self.holds = set()
+        self.__lock = threading.Lock()
+
+    def call(self, request):
+        with self.__lock:
+            return self._call(request)
+
+    def run(self, path, commands, args, artifacts):
+        return self.call({ 'op': 'run', 'path': path, 'commands': list(commands), 'args': list(args),
+                           'artifacts': list(artifacts) })
+
+    def get(self, path):
+        response = self.call({ 'op': 'get', 'path': path })
+        if not response['ok']:
+            raise RuntimeError('cannot get {0} from {1}: {2}'.format(path, self.name, response['error']))
+        return base64.b64decode(response['data'])
+
+    def has(self, path, sha1):
+        response = self.call({ 'op': 'has', 'path': path, 'sha1': sha1 })
+        if not response['ok']:
+            raise RuntimeError('cannot look for {0} on {1}: {2}'.format(path, self.name, response['error']))
+        return response['has']
+
+    def put(self, path, sha1, data):
+        response = self.call({ 'op': 'put', 'path': path, 'sha1': sha1, 'data': base64.b64encode(data) })
+        if not response['ok']:
+            raise RuntimeError('cannot put {0} to {1}: {2}'.format(path, self.name, response['error']))
+
+    def close(self):
+        pass
+
+class LocalWorker(Worker):
+    def __init__(self, name, environ = None):
+        Worker.__init__(self, name)
+        self.__proc = subprocess.Popen([sys.executable, '-m', 'mirbuild.worker'], env = environ,
+                                       stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+
+    def _call(self, request):
+        try:
+            self.__proc.stdin.write(json.dumps(request) + '\n')
+            self.__proc.stdin.flush()
+            line = self.__proc.stdout.readline()
+        except IOError:
+            line = ''
+        if not line:
+            raise RuntimeError('{0} has died'.format(self.name))
+        return json.loads(line)
+
+    def close(self):
+        self.__proc.stdin.close()
+        self.__proc.wait()
+
+class WorkerPool(object):
+    def __init__(self, workers):
+        self.__workers = list(workers)
+        self.__idle = list(self.__workers)
+        self.__cond = threading.Condition()
+
+    @property
+    def workers(self):
+        return self.__workers
+
+    def acquire(self, inputs = ()):
+        """
+        Take an idle worker, preferring the one that holds most of the given artifacts
+        """
+        inputs = set(inputs)
+        with self.__cond:
+            while not self.__idle:
+                self.__cond.wait()
+            worker = max(self.__idle, key = lambda w: (len(w.holds & inputs), -self.__idle.index(w)))
+            self.__idle.remove(worker)
+            return worker
+
+    def release(self, worker):
+        with self.__cond:
+            self.__idle.append(worker)
+            self.__cond.notify()
+
+    def close(self):
+        for w in self.__workers:
+            w.close()
+
+def _run(request):
+    durations = {}
+    for c in request['commands']:
+        start = time.time()
+        r = subprocess.call([sys.executable, 'build.py', c] + request['args'], cwd = request['path'])
+        durations[c] = time.time() - start
+        if r != 0:
+            return { 'ok': False, 'error': 'command "{0}" failed ({1})'.format(c, r), 'durations': durations }
+    artifacts = []
+    for pattern in request['artifacts']:
+        for path in sorted(glob.glob(pattern)):
+            artifacts.append({ 'path': path, 'sha1': file_digest(path), 'size': os.path.getsize(path) })
+    return { 'ok': True, 'durations': durations, 'artifacts': artifacts }
+
+def _get(request):
+    return { 'ok': True, 'data': base64.b64encode(open(request['path'], 'rb').read()) }
+
+def _has(request):
+    return { 'ok': True, 'has': file_digest(request['path']) == request['sha1'] }
+
+def _put(request):
+    # with a shared filesystem, we might have the file already
+    if file_digest(request['path']) != request['sha1']:
+        temp = '{0}.{1}.new'.format(request['path'], os.getpid())
+        fh = open(temp, 'wb')
+        fh.write(base64.b64decode(request['data']))
+        fh.close()
+        os.rename(temp, request['path'])
+    return { 'ok': True }
+
+def serve(input, output):
+    ops = { 'run': _run, 'has': _has, 'get': _get, 'put': _put }
+    for line in iter(input.readline, ''):
+        request = json.loads(line)
+        try:
+            response = ops[request['op']](request)
+        except Exception as ex:
+            response = { 'ok': False, 'error': str(ex) }
+        output.write(json.dumps(response) + '\n')
+        output.flush()
+
+if __name__ == "__main__":
+    # keep stdout for responses, everything else goes to stderr
+    output = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    serve(sys.stdin, output)
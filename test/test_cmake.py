@@ -25,7 +25,7 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
-import os, subprocess, sys, re, json, string, platform, glob, posixpath
+import os, subprocess, sys, re, json, string, platform, glob, posixpath, tempfile, shutil, atexit
 from mirbuild.tools import ScopedChdir, ScopedFile
 
 try:
@@ -245,6 +245,12 @@ class BPY(object):
                     o['default'] = re.sub('\n', '', m.group(1))
                     o['help'] = re.sub(rex, '', o['help'])
 
+# keep the history and other caches of all build.py runs out of the user's own
+CACHE_HOME = tempfile.mkdtemp(prefix = 'mirbuild-cmake-')
+atexit.register(shutil.rmtree, CACHE_HOME, True)
+os.environ['XDG_CACHE_HOME'] = CACHE_HOME
+os.environ.pop('MIRBUILD_HISTORY_DB', None)
+
 # ensure there are no packaging files lurking around from a previous failed run
 for path in glob.glob(posixpath.split(BPY.path)[0] + '/*') + [
               posixpath.join(BPY.path, 'debian', 'rules'),
@@ -417,6 +423,17 @@ def test_usage_with_deps():
     assert set(bpy.options.keys()) == set(['General', 'Boost Test', 'CMake Coverage', 'General Dependency', 'C Library Dependency'])
     assert set(bpy.options['C Library Dependency'].keys()) == set(['with-foo', 'with-oh-my'])
 
+def test_default_configuration_without_release():
+    BPY(BPY_std, 'realclean')
+    bpy = BPY("""import mirbuild
+project = mirbuild.CMakeProject('test')
+project.configure_release = None
+project.run()
+""", 'configure')
+    assert bpy.exitcode == 0
+    assert bpy.config['var']['CMAKE_BUILD_TYPE'] in ('coverage', 'debug')
+    bpy.run('realclean')
+
 def test_usage_rcfile():
     rc1 = ScopedFile('cmake/path/to/.mirbuildrc', """
 [build]
@@ -561,6 +578,58 @@ log_sink=/some/where
                == set([posixpath.join(LIB_a, 'lib'), posixpath.join(LIB_b, 'lib')])
     assert bpy.options['Boost Test']['boost-test-log-sink']['default'] == 'filename.out'
 
+def test_configuration_cache():
+    bpy = BPY(BPY_std, 'realclean')
+    bpy.run('configure', '-c', 'debug', '-b', 'out', '--prefix=/opt/debug')
+    assert bpy.exitcode == 0
+    bpy.run('configure', '-c', 'release', '--prefix=/opt/release')
+    assert bpy.exitcode == 0
+
+    cache = bpy.cache
+    assert set(cache.keys()) == set([sys.platform, sys.platform + ':debug:out', sys.platform + ':release:out'])
+    assert cache[sys.platform] == cache[sys.platform + ':release:out']
+    assert cache[sys.platform + ':debug:out']['general']['prefix'] == '/opt/debug'
+    assert cache[sys.platform + ':release:out']['general']['prefix'] == '/opt/release'
+
+    bpy.run('configure', '--configuration=debug')
+    assert bpy.exitcode == 0
+    assert bpy.config['var']['CMAKE_BUILD_TYPE'] == 'debug'
+    assert bpy.config['var']['CMAKE_INSTALL_PREFIX'] == '/opt/debug'
+
+    bpy.run('configure')
+    assert bpy.exitcode == 0
+    assert bpy.config['var']['CMAKE_BUILD_TYPE'] == 'debug'
+
+    bpy.run('configure', '-crelease')
+    assert bpy.exitcode == 0
+    assert bpy.config['var']['CMAKE_INSTALL_PREFIX'] == '/opt/release'
+
+    bpy.run('configure', '-b', 'in')
+    assert bpy.exitcode == 0
+    assert bpy.config['var']['CMAKE_INSTALL_PREFIX'] == '/opt/release'
+    assert set(bpy.cache.keys()) == set([sys.platform, sys.platform + ':debug:out',
+                                         sys.platform + ':release:out', sys.platform + ':release:in'])
+
+def test_concurrent_cache_writes():
+    configs = ['coverage', 'debug', 'release']
+    bpy = BPY(BPY_std, 'realclean')
+    scd = ScopedChdir(bpy.path)
+    procs = []
+    for i in range(5):
+        for c in configs:
+            procs.append(subprocess.Popen([sys.executable, bpy.name, '-c', c, '-b', 'out', '--prefix=/opt/' + c,
+                                           'has', 'command', 'build'], stdout = subprocess.PIPE, stderr = subprocess.PIPE))
+    assert [p.communicate() and p.returncode for p in procs] == [0] * len(procs)
+    assert glob.glob('configure.json.*.new') == []
+    # configure.json is its own lock, so there's nothing else to ignore
+    assert glob.glob('*.lock') == []
+    del scd
+
+    cache = bpy.cache
+    assert set(cache.keys()) == set([sys.platform] + [sys.platform + ':' + c + ':out' for c in configs])
+    for c in configs:
+        assert cache[sys.platform + ':' + c + ':out']['general']['prefix'] == '/opt/' + c
+
 def test_invalid_command():
     bpy = BPY(BPY_std, 'woot')
     assert re.search('ERROR: Invalid command "woot"', bpy.err)
@@ -580,6 +649,7 @@ def test_meta():
     assert bpy.exitcode == 0
     meta = json.loads(bpy.out)
     assert meta == { 'project': 'test', 'dependencies': [], 'version': '2.0.18',
+                     'configurations': 'coverage debug release'.split(),
                      'commands': 'build clean configure coverage distclean has install meta realclean test uninstall'.split() }
     (ed, ef, md, mf) = tw.diff(relative = True)
     assert not (md or mf or ed)
@@ -591,6 +661,7 @@ def test_meta_dep():
     assert bpy.exitcode == 0
     meta = json.loads(bpy.out)
     assert meta == { 'project': 'test', 'dependencies': ['foo', 'oh-my'], 'version': '2.0.18',
+                     'configurations': 'coverage debug release'.split(),
                      'commands': 'build clean configure coverage distclean has install meta realclean test uninstall'.split() }
 
 def test_meta_control():
@@ -600,6 +671,7 @@ def test_meta_control():
     assert bpy.exitcode == 0
     meta = json.loads(bpy.out)
     assert meta == { 'project': 'test', 'dependencies': ['foo', 'oh-my'], 'version': '2.0.18',
+                     'configurations': 'coverage debug release'.split(),
                      'packaging': { 'debian': { 'source': 'test', 'package': [ 'libtest-dev' ] } },
                      'commands': 'build clean configure coverage distclean has install meta package realclean test uninstall'.split() }
 
@@ -612,6 +684,7 @@ def test_build():
     assert not (md or mf)
     assert set(['lib/libtest.a', 'configure.json', 'config.cmake']) <= ef
     assert set(['test/a/bin/test', 'test/b/bin/test', 'test/e/bin/test']).isdisjoint(ef)
+    assert posixpath.exists(posixpath.join(CACHE_HOME, 'mirbuild', 'history.db'))
     bpy.run('realclean')
     assert bpy.exitcode == 0
     (ed, ef, md, mf) = tw.diff(relative = True)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import os, subprocess, sys, re, sqlite3, shutil, tempfile, posixpath
+
+try:
+    import py.test as pytest
+except ImportError:
+    import pytest
+
+from test_walk import Tree, DEPS
+
+sys.path.insert(0, posixpath.realpath('..'))
+from mirbuild.history import HistoryDB
+
+def history(tree, *args):
+    env = dict(os.environ)
+    env['XDG_CACHE_HOME'] = posixpath.join(tree.base, 'cache')
+    env['PYTHONPATH'] = posixpath.realpath('..')
+    p = subprocess.Popen([sys.executable, '-m', 'mirbuild.history'] + list(args), env = env,
+                         stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    out = p.communicate()[0]
+    print "=================\n{0}\n------------\n{1}------------\nexitcode: {2}\n------------".format(' '.join(args), out, p.returncode)
+    return (p.returncode, out)
+
+def test_walks_are_recorded():
+    t = Tree(DEPS)
+    t.fail('libd')
+    t.walk('-i', '-k', 'build')
+    os.remove(posixpath.join(t.path('libd'), 'fail'))
+    t.walk('-i', 'build')
+    db = sqlite3.connect(posixpath.join(t.base, 'cache', 'mirbuild', 'history.db'))
+    assert db.execute('SELECT tool, args, status FROM runs ORDER BY id').fetchall() == [('walk', 'build', 1), ('walk', 'build', 0)]
+    rows = db.execute('SELECT run, project, command, status, cache_hit, end - start FROM commands ORDER BY id').fetchall()
+    assert sorted((r[0], r[1], r[3], r[4]) for r in rows) == [
+        (1, 'liba', 0, 0), (1, 'libb', 0, 0), (1, 'libc', 0, 0), (1, 'libd', 1, 0),
+        (2, 'app', 0, 0), (2, 'liba', 0, 1), (2, 'libb', 0, 1), (2, 'libc', 0, 1), (2, 'libd', 0, 0)]
+    assert all(r[5] >= 0.1 for r in rows if not r[4])
+    (code, out) = history(t, '--walks', 'runs')
+    assert code == 0
+    assert re.search(r'^2 .* 0 +5 +3 +build$', out, re.M)
+    assert re.search(r'^1 .* 1 +4 +0 +build$', out, re.M)
+    # the fake build.py doesn't record anything itself
+    (code, out) = history(t, 'runs')
+    assert code == 0
+    assert len(out.splitlines()) == 1
+    (code, out) = history(t, '--walks', '-c', 'build', 'slowest')
+    assert code == 0
+    assert len(out.splitlines()) == 6
+    (code, out) = history(t, '--walks', 'flaky', '-c', 'build')
+    assert re.search(r'^libd +build +2 +1 +1$', out, re.M)
+
+def test_queries():
+    base = tempfile.mkdtemp(prefix = 'mirbuild-history-')
+    try:
+        db = HistoryDB(posixpath.join(base, 'history.db'))
+        start = 1000000.0
+        for i in range(8):
+            run = db.begin_run('build.py', ['build'], start = start)
+            slow = 2.0 if i >= 5 else 1.0
+            db.add_command(run, 'libfoo', '/src/libfoo', 'build', start, start + slow, 0, 'release',
+                           { 'utime': 0.5, 'stime': 0.25, 'maxrss': 1000 + i })
+            db.add_command(run, 'libbar', '/src/libbar', 'build', start, start + 1.5, 0, 'release')
+            db.add_command(run, 'libbar', '/src/libbar', 'test', start, start + 0.5, i % 3 == 0)
+            db.add_command(run, 'libfoo', '/src/libfoo', 'test', start, start + 0.5, 0)
+            db.end_run(run, 0, start + 2)
+            start += 3600
+        slowest = db.slowest('build')
+        assert [r[0] for r in slowest] == ['libbar', 'libfoo']
+        assert slowest[1][2:] == (8, 1.375, 2.0, 0.75, 1007)
+        assert db.slowest('build', since = start - 2 * 3600)[0][:4] == ('libfoo', 'build', 2, 2.0)
+        assert db.regressions('build', recent = 3) == [('libfoo', 'build', 1.0, 2.0, 2.0)]
+        assert db.regressions('build', recent = 3, threshold = 2.5) == []
+        assert db.flaky('test') == [('libbar', 'test', 8, 3, 5)]
+        assert db.runs(tool = 'build.py')[0][2:6] == (2.0, 0, 4, 0)
+        unit = 1 if sys.platform == 'darwin' else 1024
+        assert db.peak_memory() == 1007 * unit
+        assert db.peak_memory('libfoo', recent = 3) == 1007 * unit
+        assert db.peak_memory('libbar') is None
+        db.close()
+        # errors are reported, but don't get in the way
+        bad = HistoryDB(posixpath.join(base, 'history.db', 'nope'))
+        assert bad.begin_run('walk', []) is None
+        assert bad.filename is None
+    finally:
+        shutil.rmtree(base, True)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import os, subprocess, sys, re, time, posixpath
+
+try:
+    import py.test as pytest
+except ImportError:
+    import pytest
+
+from test_walk import Tree, DEPS
+
+CLIENT = posixpath.realpath(posixpath.join('..', 'mirbuild', 'client.py'))
+
+class Server(object):
+    def __init__(self, tree):
+        self.env = dict(os.environ)
+        self.env['WALK_LOG'] = tree.log
+        self.env['XDG_CACHE_HOME'] = posixpath.join(tree.base, 'cache')
+        self.env['MIRBUILD_SERVER'] = posixpath.join(tree.base, 'server.sock')
+        self.env['PYTHONPATH'] = posixpath.realpath('..')
+        self.proc = subprocess.Popen([sys.executable, '-m', 'mirbuild.server'], env = self.env)
+        for i in range(100):
+            if os.path.exists(self.env['MIRBUILD_SERVER']):
+                break
+            time.sleep(0.1)
+
+    def client(self, *args, **kw):
+        p = subprocess.Popen([sys.executable, CLIENT] + list(args), cwd = kw.get('cwd'), env = self.env,
+                             stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        out = p.communicate()[0]
+        print "=================\n{0}\n------------\n{1}------------\nexitcode: {2}\n------------".format(' '.join(args), out, p.returncode)
+        return (p.returncode, out)
+
+    def stop(self):
+        self.client('--stop')
+        self.proc.wait()
+
+def pids(tree):
+    return [l.split()[3] for l in open(tree.log) if l.startswith('start')]
+
+def test_client_without_server():
+    t = Tree(DEPS)
+    s = Server.__new__(Server)
+    s.env = dict(os.environ, WALK_LOG = t.log, MIRBUILD_SERVER = posixpath.join(t.base, 'nothing.sock'),
+                 PYTHONPATH = posixpath.realpath('..'), XDG_CACHE_HOME = posixpath.join(t.base, 'cache'))
+    (code, out) = s.client('build', cwd = t.path('liba'))
+    assert code == 0
+    assert t.finished() == ['liba']
+    (code, out) = s.client('--walk', '-b', t.base, 'build')
+    assert code == 0
+    assert t.finished() == ['liba', 'liba', 'libb', 'libc', 'libd', 'app']
+
+def test_server():
+    t = Tree(DEPS)
+    s = Server(t)
+    try:
+        (code, out) = s.client('build', '--with-foo=bar', cwd = t.path('libb'))
+        assert code == 0
+        assert t.finished() == ['libb']
+        assert pids(t) == [str(s.proc.pid)]
+        t.fail('libc')
+        (code, out) = s.client('test', cwd = t.path('libc'))
+        assert code == 1
+        t.clear_log()
+        (code, out) = s.client('--walk', '-b', t.base, '-k', 'build')
+        assert code == 1
+        assert re.search('failed: libc', out)
+        assert t.finished() == ['liba', 'libb', 'libd']
+        assert set(pids(t)) == set([str(s.proc.pid)])
+        (code, out) = s.client('--walk', '--bad-option')
+        assert code == 2
+        (code, out) = s.client('--walk', '-b', t.base)
+        assert code == 0
+        assert out.split() == ['liba', 'libb', 'libc', 'libd', 'app']
+        # the graph is kept between requests, but not once projects change
+        t.add('libe', [])
+        bpy = posixpath.join(t.path('libd'), 'build.py')
+        content = open(bpy).read().replace("'dependencies': []", "'dependencies': ['libe']")
+        open(bpy, 'w').write(content)
+        (code, out) = s.client('--walk', '-b', t.base)
+        assert code == 0
+        assert out.split() == ['liba', 'libb', 'libc', 'libe', 'libd', 'app']
+    finally:
+        s.stop()
+    assert s.proc.returncode == 0
+    assert not os.path.exists(s.env['MIRBUILD_SERVER'])
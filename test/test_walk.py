@@ -0,0 +1,1042 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2011-2013 Last.fm Limited
+#
+# This file is part of python-mirbuild.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import os, subprocess, sys, re, json, shutil, tempfile, posixpath, glob, hashlib
+
+try:
+    import py.test as pytest
+except ImportError:
+    import pytest
+
+# A fake build.py that doesn't need mirbuild. It logs each command it runs
+# to the file given in $WALK_LOG and fails if a file called 'fail' (or 'fail-'
+# followed by the command) exists. Building creates the files listed in
+# 'outputs', if there is one.
+# Querying meta information fails or hangs if 'badmeta' or 'slowmeta' exist.
+FAKE_BPY = """import json, os, sys, time
+meta = {meta}
+cmd = [a for a in sys.argv[1:] if not a.startswith('-')][0]
+def log(what):
+    fh = open(os.environ['WALK_LOG'], 'a')
+    fh.write('{{0}} {{1}} {{2}} {{3}} {{4}}\\n'.format(what, meta['project'], cmd, os.getpid(), ' '.join(sys.argv[2:])))
+    fh.close()
+if cmd == 'meta':
+    log('meta')
+    if os.path.exists('slowmeta'):
+        time.sleep(30)
+    if os.path.exists('badmeta'):
+        sys.stderr.write('this is broken\\n')
+        sys.exit(1)
+    sys.stdout.write(json.dumps(meta))
+    sys.exit(0)
+log('start')
+sys.stdout.write('output of {{0}} {{1}}\\n'.format(meta['project'], cmd))
+sys.stdout.flush()
+time.sleep({sleep})
+if os.path.exists('fail') or os.path.exists('fail-' + cmd):
+    sys.stderr.write('{{0}} has failed\\n'.format(meta['project']))
+    sys.exit(1)
+if cmd == 'build' and os.path.exists('outputs'):
+    for name in open('outputs').read().split():
+        if not os.path.isdir(os.path.dirname(name)):
+            os.makedirs(os.path.dirname(name))
+        open(name, 'w').write('{{0}} built by {{1}}\\n'.format(name, meta['project']))
+log('end')
+"""
+
+class Tree(object):
+    def __init__(self, projects):
+        self.base = tempfile.mkdtemp(prefix = 'mirbuild-walk-')
+        self.log = posixpath.join(self.base, 'walk.log')
+        for name, deps in projects.items():
+            self.add(name, deps)
+
+    def __del__(self):
+        shutil.rmtree(self.base, True)
+
+    def path(self, name):
+        return posixpath.join(self.base, 'src', name)
+
+    def add(self, name, deps, sleep = 0.1, **extra):
+        os.makedirs(self.path(name))
+        meta = { 'project': name, 'commands': ['build', 'test'], 'dependencies': deps }
+        meta.update(extra)
+        fh = open(posixpath.join(self.path(name), 'build.py'), 'w')
+        fh.write(FAKE_BPY.format(meta = repr(meta), sleep = sleep))
+        fh.close()
+
+    def fail(self, name):
+        open(posixpath.join(self.path(name), 'fail'), 'w').close()
+
+    def walk(self, *args, **kw):
+        env = dict(os.environ)
+        env['WALK_LOG'] = self.log
+        env['XDG_CACHE_HOME'] = posixpath.join(self.base, 'cache')
+        env['PYTHONPATH'] = posixpath.realpath('..')
+        walk = subprocess.Popen([sys.executable, '-m', 'mirbuild.walk', '-b', self.base] + list(args),
+                                stdout = subprocess.PIPE, stderr = subprocess.PIPE, env = env, cwd = kw.get('cwd'))
+        (self.out, self.err) = walk.communicate()
+        self.exitcode = walk.returncode
+        print "=================\n{0}\n------------\n{1}------------\n{2}------------\nexitcode: {3}\n------------" \
+              .format(' '.join(args), self.out, self.err, self.exitcode)
+
+    @property
+    def events(self):
+        try:
+            return [line.split()[:3] for line in open(self.log) if line.strip()]
+        except IOError:
+            return []
+
+    def clear_log(self):
+        os.remove(self.log)
+
+    def touch(self, name, file, content = ''):
+        fh = open(posixpath.join(self.path(name), file), 'a')
+        fh.write(content)
+        fh.close()
+
+    def started(self, cmd = 'build'):
+        return [e[1] for e in self.events if e[0] == 'start' and e[2] == cmd]
+
+    def finished(self, cmd = 'build'):
+        return [e[1] for e in self.events if e[0] == 'end' and e[2] == cmd]
+
+    def assert_order(self, deps, cmd = 'build'):
+        # each project must only be started after all its dependencies have finished
+        ev = self.events
+        for i, e in enumerate(ev):
+            if e[0] == 'start' and e[2] == cmd:
+                done = set(x[1] for x in ev[:i] if x[0] == 'end' and x[2] == cmd)
+                assert set(deps[e[1]]) <= done
+
+DEPS = {
+    'liba': [],
+    'libb': ['liba'],
+    'libc': ['liba'],
+    'libd': [],
+    'app':  ['libb', 'libc', 'libd'],
+}
+
+def test_sequential_walk():
+    t = Tree(DEPS)
+    t.walk('build')
+    assert t.exitcode == 0
+    assert t.finished() == ['liba', 'libb', 'libc', 'libd', 'app']
+    assert re.search('5 succeeded, 0 failed', t.out)
+
+def test_parallel_walk():
+    t = Tree(DEPS)
+    t.walk('-j', '4', 'build', 'test')
+    assert t.exitcode == 0
+    assert sorted(t.finished('test')) == sorted(DEPS)
+    t.assert_order(DEPS, 'build')
+    t.assert_order(DEPS, 'test')
+    # build and test of a project run in sequence
+    for p in DEPS:
+        ev = [e[0] + e[2] for e in t.events if e[1] == p and e[0] != 'meta']
+        assert ev == ['startbuild', 'endbuild', 'starttest', 'endtest']
+
+def test_parallel_walk_passes_dependencies():
+    t = Tree(DEPS)
+    t.walk('-j', '3', 'build')
+    line = [l for l in open(t.log) if l.startswith('start app')][0]
+    for d in DEPS['app']:
+        assert '--with-{0}={1}'.format(d, t.path(d)) in line
+
+def test_parallel_walk_fail_fast():
+    t = Tree(DEPS)
+    t.fail('liba')
+    t.walk('-j', '2', 'build')
+    assert t.exitcode == 1
+    assert 'liba' not in t.finished()
+    assert not set(t.started()) & set(['libb', 'libc', 'app'])
+    assert re.search('failed: liba', t.out)
+    assert re.search('ERROR: 1 project failed', t.err)
+
+def test_parallel_walk_keep_going():
+    t = Tree(DEPS)
+    t.fail('libb')
+    t.walk('-j', '4', '-k', 'build')
+    assert t.exitcode == 1
+    assert sorted(t.finished()) == ['liba', 'libc', 'libd']
+    assert 'app' not in t.started()
+    assert re.search('3 succeeded, 1 failed, 1 skipped', t.out)
+    assert re.search('skipped due to failed dependencies: app', t.out)
+
+def test_parallel_walk_reverse():
+    t = Tree(DEPS)
+    t.walk('-j', '4', '-r', 'build')
+    assert t.exitcode == 0
+    rdeps = dict((p, [q for q in DEPS if p in DEPS[q]]) for p in DEPS)
+    t.assert_order(rdeps)
+
+def test_meta_cache():
+    t = Tree(DEPS)
+    t.walk('build')
+    assert sorted(e[1] for e in t.events if e[0] == 'meta') == sorted(DEPS)
+    assert os.path.exists(posixpath.join(t.base, 'cache', 'mirbuild', 'meta.json'))
+    t.clear_log()
+    t.walk('build')
+    assert t.exitcode == 0
+    assert not [e for e in t.events if e[0] == 'meta']
+    assert t.finished() == ['liba', 'libb', 'libc', 'libd', 'app']
+
+def test_meta_cache_invalidation():
+    t = Tree(DEPS)
+    t.walk()
+    t.clear_log()
+    t.touch('libb', 'build.py', '\n')
+    os.makedirs(posixpath.join(t.path('libc'), 'debian'))
+    t.touch('libc', 'debian/changelog', 'foo')
+    t.touch('libd', '.mirbuildrc', '[build]\n')
+    t.walk()
+    assert sorted(e[1] for e in t.events if e[0] == 'meta') == ['libb', 'libc', 'libd']
+    t.clear_log()
+    t.walk('--refresh-meta')
+    assert sorted(e[1] for e in t.events if e[0] == 'meta') == sorted(DEPS)
+    t.clear_log()
+    t.walk('--no-meta-cache')
+    assert sorted(e[1] for e in t.events if e[0] == 'meta') == sorted(DEPS)
+
+def test_meta_prefetch_errors():
+    t = Tree(DEPS)
+    t.touch('libb', 'badmeta')
+    t.touch('libd', 'badmeta')
+    t.touch('app', 'slowmeta')
+    t.walk('--meta-jobs', '5', '--meta-timeout', '2', 'build')
+    assert t.exitcode == 1
+    assert not t.started()
+    assert re.search('failed to get meta information for 3 projects', t.err)
+    assert re.search('{0}.*timed out after 2'.format(t.path('app')), t.err)
+    assert re.search('{0}.*\(1\): this is broken'.format(t.path('libb')), t.err)
+    assert re.search('{0}.*\(1\): this is broken'.format(t.path('libd')), t.err)
+    # the successful queries have been cached
+    t.clear_log()
+    os.remove(posixpath.join(t.path('libb'), 'badmeta'))
+    os.remove(posixpath.join(t.path('libd'), 'badmeta'))
+    os.remove(posixpath.join(t.path('app'), 'slowmeta'))
+    t.walk()
+    assert t.exitcode == 0
+    assert sorted(e[1] for e in t.events if e[0] == 'meta') == ['app', 'libb', 'libd']
+
+def test_dependency_graph():
+    from mirbuild.graph import DependencyGraph
+    g = DependencyGraph(DEPS)
+    assert g.nodes == sorted(DEPS)
+    assert sorted(g.dependents('liba')) == ['libb', 'libc']
+    assert g.closure(['libb']) == set(['liba', 'libb'])
+    assert g.reverse_closure(['libc']) == set(['libc', 'app'])
+    r = g.sort()
+    assert r.ok
+    assert r.order == ['liba', 'libb', 'libc', 'libd', 'app']
+    sub = g.subgraph(g.reverse_closure(['libc']))
+    assert sub.sort().order == ['libc', 'app']
+
+def test_dependency_graph_analysis():
+    from mirbuild.graph import DependencyGraph
+    g = DependencyGraph({ 'a': [], 'b': ['a'], 'c': ['a', 'b', 'x'], 'd': ['c', 'a'], 'e': ['f'], 'f': ['e'] })
+    assert g.depths() == { 'a': 0, 'b': 1, 'c': 2, 'd': 3 }
+    r = g.transitive_reduction()
+    assert r.dependencies('c') == ['b']
+    assert r.dependencies('d') == ['c']
+    assert r.unknown == { 'c': ['x'] }
+    assert r.dependencies('e') == ['f']
+
+def test_dependency_graph_problems():
+    from mirbuild.graph import DependencyGraph
+    g = DependencyGraph({
+        'a': ['b'], 'b': ['c'], 'c': ['a'],
+        'd': ['d'],
+        'e': ['a', 'f'], 'f': [],
+        'g': ['nope', 'f'],
+        'h': ['g'],
+    })
+    r = g.sort()
+    assert not r.ok
+    assert r.order == ['f']
+    assert r.unresolved == ['a', 'b', 'c', 'd', 'e', 'g', 'h']
+    assert r.unknown == { 'g': ['nope'] }
+    assert r.cycles == [['a', 'b', 'c'], ['d']]
+    assert r.report() == ["project 'g' depends on unknown project nope",
+                          "dependency cycle: a -> b -> c -> a",
+                          "dependency cycle: d -> d"]
+
+def test_walk_reports_cycles():
+    t = Tree({ 'liba': ['libc'], 'libb': ['liba'], 'libc': ['libb'], 'app': ['liba', 'foo'], 'libd': [] })
+    t.walk('build')
+    assert t.exitcode == 1
+    assert not t.started()
+    assert re.search('cannot resolve dependencies for: app, liba, libb, libc', t.err)
+    assert re.search("project 'app' depends on unknown project foo", t.err)
+    assert re.search('dependency cycle: liba -> libc -> libb -> liba', t.err)
+    t.walk('-f', 'build')
+    assert t.exitcode == 0
+    assert t.finished() == ['libd']
+
+def test_walk_projects():
+    t = Tree(DEPS)
+    t.walk('-j', '2', '-p', 'libb,libd', 'build')
+    assert t.exitcode == 0
+    assert sorted(t.finished()) == ['liba', 'libb', 'libd']
+    t.walk('-p', 'nope', 'build')
+    assert t.exitcode == 1
+    assert re.search('no such project: nope', t.err)
+
+def test_scan_pruning():
+    t = Tree(DEPS)
+    # none of these must be found
+    for d in ['src/libb/sub', 'src/build/x', 'out/CMakeFiles/y', 'oos/z', 'vendor/w', 'src/libd/.git/v', 'legacy/a/out/u']:
+        os.makedirs(posixpath.join(t.base, d))
+        open(posixpath.join(t.base, d, 'build.py'), 'w').close()
+    open(posixpath.join(t.base, 'oos', 'CMakeCache.txt'), 'w').close()
+    open(posixpath.join(t.base, '.mirbuildignore'), 'w').write('# comment\nvendor\nlegacy/*/out\n')
+    t.walk()
+    assert t.exitcode == 0
+    assert t.out.split() == ['liba', 'libb', 'libc', 'libd', 'app']
+
+def test_scan_index():
+    t = Tree(DEPS)
+    t.walk()
+    index = posixpath.join(t.base, 'cache', 'mirbuild', 'scan.json')
+    assert os.path.exists(index)
+    data = json.load(open(index))
+    assert sorted(data['bases'][posixpath.realpath(t.base)]) == ['', 'src'] + ['src/' + p for p in sorted(DEPS)]
+    t.add('libe', ['app'])
+    t.walk()
+    assert t.out.split() == ['liba', 'libb', 'libc', 'libd', 'app', 'libe']
+    shutil.rmtree(t.path('libe'))
+    t.walk()
+    assert t.out.split() == ['liba', 'libb', 'libc', 'libd', 'app']
+    t.walk('--no-scan-index')
+    assert t.out.split() == ['liba', 'libb', 'libc', 'libd', 'app']
+
+def test_incremental_walk():
+    t = Tree(DEPS)
+    t.walk('-i', '-j', '2', 'build')
+    assert t.exitcode == 0
+    assert sorted(t.finished()) == sorted(DEPS)
+    t.clear_log()
+    t.walk('-i', '-j', '2', 'build')
+    assert t.exitcode == 0
+    assert not t.started()
+    assert re.search('project "app" is up to date', t.out)
+    assert re.search('5 succeeded \\(5 up to date\\)', t.out)
+    # a change in libb must rebuild libb and app, but nothing else
+    t.touch('libb', 'foo.cpp', 'int x;')
+    t.walk('-i', '-j', '2', 'build')
+    assert sorted(t.finished()) == ['app', 'libb']
+    t.clear_log()
+    # build output and hidden files don't matter
+    os.makedirs(posixpath.join(t.path('libc'), 'build'))
+    t.touch('libc', 'build/foo.o', 'x')
+    t.touch('libc', '.swp', 'x')
+    t.walk('-i', 'build')
+    assert not t.started()
+    # running different commands is a change, too
+    t.walk('-i', 'build', 'test')
+    assert sorted(t.finished('test')) == sorted(DEPS)
+    t.walk('-i', 'build', 'test')
+    assert sorted(t.finished('test')) == sorted(DEPS)
+    t.clear_log()
+    # failed projects are never up to date
+    t.touch('libd', 'x.h')
+    t.fail('libd')
+    t.walk('-i', 'build', 'test')
+    assert t.exitcode == 1
+    t.walk('-i', 'build', 'test')
+    assert t.started() == ['libd', 'libd']
+    # without -i, everything gets built
+    os.remove(posixpath.join(t.path('libd'), 'fail'))
+    t.clear_log()
+    t.walk('build')
+    assert sorted(t.finished()) == sorted(DEPS)
+
+def test_affected_projects():
+    t = Tree(DEPS)
+    t.walk('-a', posixpath.join(t.path('libc'), 'src', 'foo.cpp'))
+    assert t.out.split() == ['libc', 'app']
+    t.walk('-a', t.path('libb') + ',' + posixpath.join(t.path('libd'), 'x.h'), '-a', posixpath.join(t.base, 'README'))
+    assert t.out.split() == ['libb', 'libd', 'app']
+    t.walk('-a', posixpath.join(t.base, 'src', '.mirbuildrc'))
+    assert t.out.split() == ['liba', 'libb', 'libc', 'libd', 'app']
+    t.walk('-a', posixpath.join(t.base, 'README'), 'build')
+    assert t.exitcode == 0
+    assert not t.started()
+    # combined with -p, only the intersection is used
+    t.walk('-j', '2', '-a', t.path('liba'), '-p', 'libb', 'build')
+    assert t.exitcode == 0
+    assert t.finished() == ['liba', 'libb']
+
+def test_affected_projects_git():
+    t = Tree(DEPS)
+    def git(*args):
+        subprocess.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args), cwd = t.base)
+    git('init', '-q')
+    git('add', 'src')
+    git('commit', '-q', '-m', 'initial')
+    t.touch('libc', 'foo.cpp', 'int x;')
+    git('add', 'src')
+    git('commit', '-q', '-m', 'change libc')
+    t.walk('-g', 'HEAD^..HEAD')
+    assert t.out.split() == ['libc', 'app']
+    t.touch('libd', 'build.py', '\n')
+    t.walk('-g', 'HEAD')
+    assert t.out.split() == ['libd', 'app']
+    t.walk('-g', 'nope..HEAD')
+    assert t.exitcode == 1
+
+def test_jobserver():
+    from mirbuild.jobserver import JobServer, JobClient
+    js = JobServer(3)
+    env = js.environ({ 'MAKEFLAGS': ' -k -j4 --jobserver-fds=7,8' })
+    assert env['MAKEFLAGS'].split()[:2] == ['-k', '-j']
+    assert len(re.findall('--jobserver', env['MAKEFLAGS'])) == 1
+    client = JobClient.from_environ(env)
+    tokens = client.acquire_available(5)
+    assert len(tokens) == 3
+    assert client.acquire_available(1) == []
+    client.release(tokens)
+    assert len(js.acquire_available(5)) == 3
+    js.close()
+    assert JobClient.from_environ({ 'MAKEFLAGS': ' -j4' }) is None
+    assert JobClient.from_environ(env) is None
+
+def test_job_slots_limit_concurrency():
+    t = Tree(dict((p, []) for p in ['a', 'b', 'c', 'd', 'e']))
+    t.walk('-j', '5', '-l', '2', 'build')
+    assert t.exitcode == 0
+    running = 0
+    for e in t.events:
+        running += { 'start': 1, 'end': -1 }.get(e[0], 0)
+        assert running <= 2
+    assert len(t.finished()) == 5
+
+def test_execute_parallel_refills_slots():
+    from optparse import Values
+    from mirbuild.environment import Environment
+    base = tempfile.mkdtemp(prefix = 'mirbuild-walk-')
+    try:
+        env = Environment('test')
+        env.set_options(Values({ 'jobs': 2, 'debug': False, 'trace': False, 'quiet': True }))
+        saved = os.environ.pop('MAKEFLAGS', None)
+        try:
+            # the short commands don't have to wait for the long one
+            env.execute_parallel([['sh', '-c', 'sleep 1.5; echo long >> log'],
+                                  ['sh', '-c', 'sleep 0.1; echo short1 >> log'],
+                                  ['sh', '-c', 'sleep 0.1; echo short2 >> log']], cwd = base)
+        finally:
+            if saved is not None:
+                os.environ['MAKEFLAGS'] = saved
+        assert open(posixpath.join(base, 'log')).read().split() == ['short1', 'short2', 'long']
+        with pytest.raises(RuntimeError):
+            env.execute_parallel([['sh', '-c', 'exit 3'], ['true']], cwd = base)
+    finally:
+        shutil.rmtree(base, True)
+
+def test_auto_jobs():
+    from mirbuild.environment import available_cpus, available_memory, auto_jobs
+    def fake(root, files):
+        for path, text in files.iteritems():
+            if not os.path.isdir(os.path.dirname(root + path)):
+                os.makedirs(os.path.dirname(root + path))
+            open(root + path, 'w').write(text)
+    base = tempfile.mkdtemp(prefix = 'mirbuild-walk-')
+    try:
+        # 64 CPUs, but only 48 of them allowed, and a cgroup v1 quota of 4.5 CPUs
+        v1 = posixpath.join(base, 'v1')
+        fake(v1, { '/proc/cpuinfo': ''.join('processor\t: {0}\n'.format(i) for i in range(64)),
+                   '/proc/self/status': 'Name:\tpython\nCpus_allowed_list:\t0-31,40-47,56-63\n',
+                   '/proc/meminfo': 'MemTotal:       67108864 kB\nMemAvailable:   33554432 kB\n',
+                   '/proc/self/cgroup': '4:memory:/docker/abc\n2:cpu,cpuacct:/docker/abc\n1:name=systemd:/docker/abc\n',
+                   '/proc/self/mountinfo': '30 25 0:26 / /sys/fs/cgroup rw - tmpfs tmpfs rw\n'
+                                           '33 30 0:29 / /sys/fs/cgroup/cpu,cpuacct rw - cgroup cgroup rw,cpu,cpuacct\n'
+                                           '36 30 0:32 / /sys/fs/cgroup/memory rw - cgroup cgroup rw,memory\n',
+                   '/sys/fs/cgroup/cpu,cpuacct/docker/abc/cpu.cfs_quota_us': '450000\n',
+                   '/sys/fs/cgroup/cpu,cpuacct/docker/abc/cpu.cfs_period_us': '100000\n',
+                   '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us': '-1\n',
+                   '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us': '100000\n',
+                   '/sys/fs/cgroup/memory/docker/abc/memory.limit_in_bytes': str(8 << 30) + '\n',
+                   '/sys/fs/cgroup/memory/docker/abc/memory.usage_in_bytes': str(3 << 30) + '\n',
+                   '/sys/fs/cgroup/memory/docker/abc/memory.stat': 'cache 0\ntotal_inactive_file {0}\n'.format(1 << 30),
+                   '/sys/fs/cgroup/memory/memory.limit_in_bytes': '9223372036854771712\n',
+                   '/sys/fs/cgroup/memory/memory.usage_in_bytes': str(40 << 30) + '\n' })
+        assert available_cpus(v1) == 5
+        assert available_memory(v1) == 6 << 30
+        assert auto_jobs(1 << 30, v1) == 5
+        assert auto_jobs(2 << 30, v1) == 3
+        assert auto_jobs(16 << 30, v1) == 1
+        # cgroup v2 in its own namespace, with a quota on the parent cgroup
+        v2 = posixpath.join(base, 'v2')
+        fake(v2, { '/proc/cpuinfo': ''.join('processor\t: {0}\n'.format(i) for i in range(64)),
+                   '/proc/meminfo': 'MemAvailable:   33554432 kB\n',
+                   '/proc/self/cgroup': '0::/build/job\n',
+                   '/proc/self/mountinfo': '40 25 0:35 / /sys/fs/cgroup rw - cgroup2 cgroup2 rw\n',
+                   '/sys/fs/cgroup/build/job/cpu.max': 'max 100000\n',
+                   '/sys/fs/cgroup/build/cpu.max': '400000 100000\n',
+                   '/sys/fs/cgroup/build/job/memory.max': 'max\n',
+                   '/sys/fs/cgroup/build/memory.max': str(2 << 30) + '\n',
+                   '/sys/fs/cgroup/build/memory.current': str(1 << 30) + '\n' })
+        assert available_cpus(v2) == 4
+        assert available_memory(v2) == 1 << 30
+        assert auto_jobs(256 << 20, v2) == 4
+        assert auto_jobs(512 << 20, v2) == 2
+        # nothing known at all
+        assert available_cpus(posixpath.join(base, 'none')) == 1
+        assert available_memory(posixpath.join(base, 'none')) is None
+        assert auto_jobs(1 << 30, posixpath.join(base, 'none')) == 1
+    finally:
+        shutil.rmtree(base, True)
+
+def test_critical_path_estimate():
+    from mirbuild.walk import Scheduler
+    deps = { 'a': [], 'b': ['a'], 'c': [], 'd': [] }
+    cost = { 'a': 5, 'b': 5, 'c': 1, 'd': 1 }
+    nodes = ['a', 'b', 'c', 'd']
+    chain = Scheduler.critical_path(nodes, deps, cost)
+    assert chain == { 'a': 10, 'b': 5, 'c': 1, 'd': 1 }
+    assert Scheduler(2).estimate(['c', 'd', 'a', 'b'], deps, cost) == 11
+    assert Scheduler(2).estimate(['c', 'd', 'a', 'b'], deps, cost, chain) == 10
+    assert Scheduler(1).estimate(nodes, deps, cost, chain) == 12
+
+def test_critical_path_scheduling():
+    t = Tree({})
+    for p in ['a1', 'a2', 'a3']:
+        t.add(p, [], sleep = 0.1)
+    t.add('z1', [], sleep = 0.5)
+    t.add('z2', ['z1'], sleep = 0.5)
+    t.walk('-j', '2', 'build')
+    assert t.exitcode == 0
+    assert 'estimated time' not in t.out
+    assert t.started()[:2] == ['a1', 'a2']
+    t.clear_log()
+    t.walk('-j', '2', '--dry-run', 'build')
+    assert re.search('estimated time: \d+s', t.out)
+    t.walk('-j', '2', 'build')
+    assert t.exitcode == 0
+    assert t.started()[0] == 'z1'
+    assert re.search('estimated time: \d+s, done at', t.out)
+
+def test_batched_dpkg():
+    t = Tree({})
+    for name, deps in DEPS.items():
+        t.add(name, deps, version = '1.0', packaging = { 'debian': { 'package': [name, name + '-dev'] } })
+        for pkg in [name, name + '-dev']:
+            t.touch('.', '{0}_1.0_all.deb'.format(pkg))
+    dpkg = lambda: [l.split('/usr/bin/dpkg ')[1].split() for l in t.out.splitlines() if '/usr/bin/dpkg' in l]
+    t.walk('--dry-run', '-j', '2', 'build', 'debinstall')
+    assert len(dpkg()) == 5
+    t.walk('--dry-run', '-j', '2', '-B', 'build', 'debinstall')
+    assert t.exitcode == 0
+    levels = [sorted(posixpath.basename(d).split('_')[0] for d in cmd[1:]) for cmd in dpkg()]
+    assert levels == [['liba', 'liba-dev', 'libd', 'libd-dev'], ['libb', 'libb-dev', 'libc', 'libc-dev'], ['app', 'app-dev']]
+    # build of the next level only starts after the previous batch
+    out = t.out.splitlines()
+    first = [i for i, l in enumerate(out) if '/usr/bin/dpkg' in l][0]
+    assert [i for i, l in enumerate(out) if 'running build.py build' in l and 'libb' in l][0] > first
+    assert re.search('5 succeeded, 0 failed', t.out)
+    t.walk('--dry-run', '-B', '-r', 'debremove')
+    assert dpkg() == [['-r', 'app', 'app-dev', 'libd', 'libd-dev', 'libc', 'libc-dev', 'libb', 'libb-dev', 'liba', 'liba-dev']]
+
+def test_batched_dpkg_fallback():
+    from mirbuild.walk import Walker, option_parser
+    class FakeDpkg(Walker):
+        # dpkg fails for every transaction that has libb in it
+        calls = []
+        def check_run(self, args, opt, cwd = None):
+            self.calls.append(args[2:])
+            if 'libb' in args:
+                raise subprocess.CalledProcessError(1, args)
+    t = Tree({})
+    for name in ['liba', 'libb']:
+        t.add(name, [], packaging = { 'debian': { 'package': [name] } })
+    state = posixpath.join(t.base, 'state.json')
+    saved = dict(os.environ)
+    try:
+        os.environ.update(WALK_LOG = t.log, XDG_CACHE_HOME = posixpath.join(t.base, 'cache'))
+        (opt, args) = option_parser().parse_args(['-b', t.base, '-B', '-i', '--state', state, 'debremove'])
+        with pytest.raises(RuntimeError) as ex:
+            FakeDpkg(opt.base, metacache = False).walk(args, opt)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+    assert str(ex.value) == '1 project failed'
+    assert FakeDpkg.calls == [['-r', 'liba', 'libb'], ['-r', 'liba'], ['-r', 'libb']]
+    # only the project that has been removed is up to date
+    assert sorted(json.load(open(state))['projects'].keys()) == [t.path('liba')]
+
+def test_in_process():
+    t = Tree(DEPS)
+    t.add('tool', [], in_process = False)
+    t.walk('-I', 'build', 'test')
+    assert t.exitcode == 0
+    assert t.finished('test') == ['liba', 'libb', 'libc', 'libd', 'app', 'tool']
+    pids = dict((e[1], e[3]) for e in (l.split() for l in open(t.log)) if e[0] == 'start')
+    assert len(set(pids[p] for p in DEPS)) == 1
+    assert pids['tool'] != pids['app']
+    line = [l for l in open(t.log) if l.startswith('start app build')][0]
+    assert '--with-libd={0}'.format(t.path('libd')) in line
+    t.fail('libc')
+    t.clear_log()
+    t.walk('-I', '-k', '-j', '3', 'build')
+    assert t.exitcode == 1
+    assert re.search('failed: libc \\(command "build" failed \\(1\\)\\)', t.out)
+    assert sorted(t.finished()) == ['liba', 'libb', 'libd', 'tool']
+    # running in parallel doesn't turn on logs, which would run everything in child processes
+    assert 'logs in' not in t.out
+    pids = dict((e[1], e[3]) for e in (l.split() for l in open(t.log)) if e[0] == 'start')
+    assert len(set(pids[p] for p in DEPS if p in pids)) == 1
+    assert pids['tool'] != pids['liba']
+    # unless logs are asked for explicitly
+    t.clear_log()
+    t.walk('-I', '-k', '-j', '3', '--logs', posixpath.join(t.base, 'runs'), 'build')
+    assert t.exitcode == 1
+    assert '--in-process is ignored' in t.err
+    pids = dict((e[1], e[3]) for e in (l.split() for l in open(t.log)) if e[0] == 'start')
+    assert len(set(pids[p] for p in DEPS if p in pids)) > 1
+
+def test_in_process_leaves_others_alone():
+    # the tool finishes while slow is running in-process in its own directory
+    t = Tree({})
+    t.add('slow', [], sleep = 2)
+    t.add('tool', [], in_process = False)
+    t.fail('tool')
+    t.walk('-I', '-k', '-j', '2', '-l', '2', '-t', 'track.json', 'build', cwd = t.base)
+    assert t.exitcode == 1
+    assert t.finished() == ['slow']
+    assert posixpath.exists(posixpath.join(t.base, 'track.json'))
+    assert not posixpath.exists(posixpath.join(t.path('slow'), 'track.json'))
+
+def test_worker_protocol():
+    from mirbuild.worker import LocalWorker, WorkerPool, file_digest
+    t = Tree({ 'liba': [] })
+    env = dict(os.environ, WALK_LOG = t.log, PYTHONPATH = posixpath.realpath('..'))
+    pool = WorkerPool([LocalWorker('worker 1', env), LocalWorker('worker 2', env)])
+    try:
+        deb = posixpath.join(t.base, 'src', 'liba_1.0_all.deb')
+        t.touch('.', 'liba_1.0_all.deb', 'debian binary')
+        w = pool.acquire()
+        r = w.run(t.path('liba'), ['build'], ['--with-foo=bar'], [posixpath.join(t.base, 'src', '*.deb')])
+        assert r['ok']
+        assert r['artifacts'] == [{ 'path': deb, 'sha1': file_digest(deb), 'size': 13 }]
+        assert t.finished() == ['liba']
+        w.holds.add((deb, file_digest(deb)))
+        pool.release(w)
+        # the worker holding most of the inputs is preferred
+        assert pool.acquire([(deb, file_digest(deb))]) is w
+        other = pool.acquire()
+        assert other is not w
+        assert other.get(deb) == 'debian binary'
+        assert other.has(deb, file_digest(deb))
+        assert not other.has(deb, 'x')
+        assert not other.has(deb + '.copy', 'x')
+        other.put(deb + '.copy', 'x', 'data')
+        assert open(deb + '.copy').read() == 'data'
+        t.fail('liba')
+        r = other.run(t.path('liba'), ['test'], [], [])
+        assert not r['ok']
+        assert r['error'] == 'command "test" failed (1)'
+    finally:
+        pool.close()
+
+def test_walk_with_workers():
+    t = Tree({})
+    for name, deps in DEPS.items():
+        t.add(name, deps, version = '1.0', packaging = { 'debian': { 'package': [name] } })
+        t.touch('.', '{0}_1.0_all.deb'.format(name), name)
+    t.walk('-w', '1', 'build')
+    assert t.exitcode == 0
+    assert len(re.findall('running build.py build.* on worker 1', t.out)) == 5
+    assert re.search('0 artifacts sent to workers', t.out)
+    t.clear_log()
+    t.walk('-w', '2', 'build')
+    assert t.exitcode == 0
+    t.assert_order(DEPS)
+    # the workers share our filesystem, so they have all artifacts already
+    assert 'sending' not in t.out
+    assert re.search('0 artifacts sent to workers', t.out)
+    assert len(set(e[3] for e in (l.split() for l in open(t.log)) if e[0] == 'start')) == 5
+    t.fail('libc')
+    t.walk('-w', '2', '-k', 'build')
+    assert t.exitcode == 1
+    assert re.search('failed: libc \\(command "build" failed \\(1\\)\\)', t.out)
+
+def test_log_files():
+    t = Tree(DEPS)
+    t.fail('libc')
+    logs = posixpath.join(t.base, 'logs')
+    t.walk('-j', '3', '-k', '--logs', logs, 'build')
+    assert t.exitcode == 1
+    run = os.listdir(logs)
+    assert len(run) == 1
+    assert re.search('logs in {0}'.format(posixpath.join(logs, run[0])), t.out)
+    assert sorted(os.listdir(posixpath.join(logs, run[0]))) == ['liba', 'libb', 'libc', 'libd']
+    assert open(posixpath.join(logs, run[0], 'libb', 'build.log')).read() == 'output of libb build\n'
+    assert 'output of liba' not in t.out
+    # the end of the log is shown for failed projects
+    assert re.search('last 2 lines of .*/libc/build.log:\n    output of libc build\n    libc has failed\n', t.out)
+    # sequential walks don't write logs unless asked to
+    t.walk('build')
+    assert len(os.listdir(logs)) == 1
+    assert 'output of liba build' in t.out
+
+def test_log_pruning():
+    import threading
+    from mirbuild.runlog import RunLogs
+    base = tempfile.mkdtemp(prefix = 'mirbuild-walk-')
+    try:
+        others = ['zzz-{0}'.format(i) for i in range(25)]
+        old = ['20000101-0000{0:02d}-1'.format(i) for i in range(25)]
+        for d in others + old:
+            os.mkdir(posixpath.join(base, d))
+        logs = RunLogs(base, threading.Lock())
+        logs.start()
+        logs.stop()
+        left = set(os.listdir(base))
+        # unrelated directories are left alone, and so is our own run
+        assert left >= set(others)
+        assert posixpath.basename(logs.dir) in left
+        assert len(left - set(others)) == RunLogs.keep_runs
+    finally:
+        shutil.rmtree(base, True)
+
+def test_graph_export():
+    t = Tree({})
+    for name, deps in DEPS.items():
+        t.add(name, deps + (['liba'] if name == 'app' else []), sleep = 0.5 if name == 'libc' else 0.1)
+    t.walk('graph')
+    assert t.exitcode == 0
+    g = json.loads(t.out)
+    assert g['critical_path'] is None
+    app = g['projects']['app']
+    assert app['dependencies'] == ['liba', 'libb', 'libc', 'libd']
+    assert app['reduced_dependencies'] == ['libb', 'libc', 'libd']
+    assert (app['depth'], app['fan_in'], app['fan_out']) == (2, 0, 4)
+    liba = g['projects']['liba']
+    assert (liba['depth'], liba['fan_in'], liba['fan_out'], liba['dependents']) == (0, 3, 0, 3)
+    t.walk('build')
+    t.walk('graph')
+    g = json.loads(t.out)
+    assert g['critical_path']['projects'] == ['liba', 'libc', 'app']
+    assert g['critical_path']['commands'] == ['build']
+    assert g['projects']['libc']['critical'] and not g['projects']['libb']['critical']
+    t.walk('--graph-format', 'dot', '-p', 'libc', 'graph')
+    assert t.exitcode == 0
+    assert t.out.startswith('digraph projects {')
+    assert '"libc" -> "liba" [color = red];' in t.out
+    assert '"app"' not in t.out
+
+def test_staging():
+    t = Tree(DEPS)
+    stage = posixpath.join(t.base, 'stage')
+    os.makedirs(posixpath.join(t.path('liba'), 'include', 'a'))
+    t.touch('liba', 'include/a/a.h', 'int a();\n')
+    os.makedirs(posixpath.join(t.path('liba'), 'build', sys.platform, 'release', 'lib'))
+    t.touch('liba', posixpath.join('build', sys.platform, 'release', 'lib', 'liba.so.1'))
+    os.symlink('liba.so.1', posixpath.join(t.path('liba'), 'build', sys.platform, 'release', 'lib', 'liba.so'))
+    os.makedirs(posixpath.join(t.path('libb'), 'lib'))
+    t.touch('libb', 'lib/libb.a')
+    t.walk('-S', stage, 'build')
+    assert t.exitcode == 0
+    assert 'staged 3 files in {0}'.format(stage) in t.out
+    assert os.stat(posixpath.join(stage, 'include', 'a', 'a.h')).st_ino == \
+           os.stat(posixpath.join(t.path('liba'), 'include', 'a', 'a.h')).st_ino
+    assert os.readlink(posixpath.join(stage, 'lib', 'liba.so')) == 'liba.so.1'
+    assert os.path.exists(posixpath.join(stage, 'lib', 'libb.a'))
+    manifest = json.load(open(posixpath.join(stage, 'manifest.json')))
+    assert manifest['libb'] == ['lib/libb.a']
+    line = [l for l in open(t.log) if l.startswith('start app')][0]
+    assert '--with-sysroot={0}'.format(stage) in line
+    assert '--with-libd={0}'.format(t.path('libd')) in line
+    line = [l for l in open(t.log) if l.startswith('start liba')][0]
+    assert '--with-sysroot' not in line
+    # files a project doesn't provide any more disappear from the sysroot
+    shutil.rmtree(posixpath.join(t.path('liba'), 'include'))
+    t.walk('-S', stage, '-p', 'liba', 'build')
+    assert os.listdir(posixpath.join(stage, 'include')) == []
+    assert json.load(open(posixpath.join(stage, 'manifest.json')))['liba'] == ['lib/liba.so', 'lib/liba.so.1']
+    # two projects can't provide the same file
+    os.makedirs(posixpath.join(t.path('libc'), 'lib'))
+    t.touch('libc', 'lib/libb.a')
+    t.walk('-S', stage, 'build')
+    assert t.exitcode == 1
+    assert 'cannot stage libc, lib/libb.a already staged by libb' in t.out
+
+def test_interface_fingerprints():
+    t = Tree(DEPS)
+    os.makedirs(posixpath.join(t.path('liba'), 'include'))
+    t.touch('liba', 'include/a.h', 'int a();\n')
+    t.walk('-i', '--interfaces', 'build')
+    assert sorted(t.finished()) == sorted(DEPS)
+    t.clear_log()
+    # only the implementation has changed, so nothing depending on liba needs to be rebuilt
+    t.touch('liba', 'a.cpp', 'int a() { return 1; }\n')
+    t.walk('-i', '--interfaces', 'build')
+    assert t.finished() == ['liba']
+    t.clear_log()
+    # libb and libc don't have an interface of their own, so any change to them counts
+    t.touch('liba', 'include/a.h', 'int b();\n')
+    t.walk('-i', '--interfaces', 'build')
+    assert sorted(t.finished()) == ['app', 'liba', 'libb', 'libc']
+    t.clear_log()
+    # without --interfaces, all changes count
+    t.touch('liba', 'a.cpp', 'int b() { return 2; }\n')
+    t.walk('-i', 'build')
+    assert sorted(t.finished()) == ['app', 'liba', 'libb', 'libc']
+
+def test_interface_of_shared_library():
+    from mirbuild.walk import interface_fingerprint
+    base = tempfile.mkdtemp(prefix = 'mirbuild-walk-')
+    try:
+        os.makedirs(posixpath.join(base, 'lib'))
+        def build(source):
+            open(posixpath.join(base, 'a.c'), 'w').write(source)
+            if subprocess.call(['gcc', '-shared', '-fPIC', '-o', posixpath.join(base, 'lib', 'liba.so'), posixpath.join(base, 'a.c')]):
+                pytest.skip('cannot build shared libraries')
+            return interface_fingerprint(base)
+        try:
+            first = build('int a(void) { return 1; }\n')
+        except OSError:
+            pytest.skip('no compiler')
+        assert build('int a(void) { return 2 + a(); }\nstatic int b(void) { return 3; }\n') == first
+        assert build('int a(void) { return 1; }\nint b(void) { return 3; }\n') != first
+        assert interface_fingerprint(posixpath.join(base, 'lib')) is None
+    finally:
+        shutil.rmtree(base, True)
+
+def test_track_journal():
+    t = Tree(DEPS)
+    track = posixpath.join(t.base, 'track')
+    t.touch('libc', 'fail-test')
+    t.walk('-t', track, 'build', 'test')
+    assert t.exitcode == 1
+    journal = [json.loads(l) for l in open(track)]
+    assert [(e['project'], e.get('command'), e.get('status')) for e in journal] == [
+        ('liba', 'build', 'ok'), ('liba', 'test', 'ok'), ('liba', None, None),
+        ('libb', 'build', 'ok'), ('libb', 'test', 'ok'), ('libb', None, None),
+        ('libc', 'build', 'ok'), ('libc', 'test', 'failed')]
+    assert all(e['duration'] >= 0.1 and len(e['fingerprint']) == 40 for e in journal if 'command' in e)
+    # pick up exactly where we left off
+    os.remove(posixpath.join(t.path('libc'), 'fail-test'))
+    t.clear_log()
+    open(track, 'a').write('{"project": "li')
+    t.walk('-t', track, 'build', 'test')
+    assert t.exitcode == 0
+    assert re.search('project "libb" is already tracked', t.out)
+    assert re.search('project "libc" has already run "build"', t.out)
+    assert t.finished('build') == ['libd', 'app']
+    assert t.finished('test') == ['libc', 'libd', 'app']
+    assert not os.path.exists(track)
+    # different arguments mean the command has to run again
+    t.touch('app', 'fail-test')
+    t.walk('-t', track, 'build', 'test')
+    t.clear_log()
+    t.walk('-t', track, '-n', 'build', 'test')
+    assert t.finished('build') == ['app']
+    # files from older versions only list finished projects
+    open(track, 'w').write(json.dumps(['liba', 'libb', 'libc', 'libd']))
+    t.clear_log()
+    t.walk('-t', track, 'build', 'test')
+    assert t.started() == ['app']
+    assert [(e['project'], e.get('command')) for e in (json.loads(l) for l in open(track))] == [
+        ('liba', None), ('libb', None), ('libc', None), ('libd', None), ('app', 'build'), ('app', 'test')]
+
+def test_configuration_matrix():
+    t = Tree({})
+    for name, deps in DEPS.items():
+        t.add(name, deps, configurations = ['debug', 'release', 'coverage'])
+    t.add('tool', ['liba'])
+    t.walk('-j', '3', '-c', 'debug,release', 'build')
+    assert t.exitcode == 0
+    runs = [l.split() for l in open(t.log) if l.startswith('end ')]
+    config = lambda r: [a.split('=')[1] for a in r[4:] if a.startswith('--configuration=')]
+    assert sorted((r[1], config(r)) for r in runs) == sorted([(p, [c]) for p in DEPS for c in ('debug', 'release')] + [('tool', [])])
+    assert all('--build-mode=out' in r for r in runs if config(r))
+    # each configuration is built in dependency order
+    for c in ('debug', 'release'):
+        order = [r[1] for r in runs if config(r) == [c]]
+        for p, deps in DEPS.items():
+            assert all(order.index(d) < order.index(p) for d in deps)
+    # configurations are tracked separately
+    t.walk('-i', '-c', 'debug,release', 'build')
+    t.walk('-i', '-c', 'debug,release', 'build')
+    assert re.search('project "liba:release" is up to date', t.out)
+    assert re.search(r'11 succeeded \(11 up to date\)', t.out)
+    t.walk('-i', '-c', 'debug,release,coverage', 'build')
+    assert re.search(r'16 succeeded \(10 up to date\)', t.out)
+    # a single configuration is built in-source as usual
+    t.clear_log()
+    t.walk('-c', 'coverage', '-p', 'libb', 'build')
+    assert [l.split()[4:] for l in open(t.log) if l.startswith('end ')] == [
+        ['--configuration=coverage'], ['--with-liba={0}'.format(t.path('liba')), '--configuration=coverage']]
+    t.walk('-c', 'debug,profile', 'build')
+    assert t.exitcode == 1
+    assert re.search(r'build configurations not supported by (\w+ \(profile\)(, )?){5}$', t.err, re.M)
+
+def test_artifact_cache():
+    t = Tree(DEPS)
+    outputs = ['lib/liba.a', 'bin/atool', 'include/a/version.h']
+    os.makedirs(posixpath.join(t.path('liba'), 'include', 'a'))
+    t.touch('liba', 'include/a/a.h', 'int a();\n')
+    t.touch('liba', 'outputs', ' '.join(outputs))
+    t.walk('--artifact-cache', 'build')
+    assert t.exitcode == 0
+    assert sorted(t.finished()) == sorted(DEPS)
+    # building the same sources again only restores the outputs
+    for f in outputs:
+        os.remove(posixpath.join(t.path('liba'), f))
+    t.clear_log()
+    t.walk('--artifact-cache', 'build')
+    assert t.exitcode == 0
+    assert t.started() == []
+    assert 'project "liba" restored 3 files from the artifact cache' in t.out
+    for f in outputs:
+        assert open(posixpath.join(t.path('liba'), f)).read() == '{0} built by liba\n'.format(f)
+        # hard links to the cached objects can't be written to
+        st = os.stat(posixpath.join(t.path('liba'), f))
+        assert st.st_nlink == 1 or not st.st_mode & 0222
+    # a change to liba's sources means it and everything depending on it gets built
+    t.touch('liba', 'a.cpp', 'int a() { return 1; }\n')
+    t.walk('--artifact-cache', 'build')
+    assert sorted(t.started()) == ['app', 'liba', 'libb', 'libc']
+    # walks doing more than building don't use the cache
+    t.clear_log()
+    t.walk('--artifact-cache', 'build', 'test')
+    assert sorted(t.started()) == sorted(DEPS)
+    # the configured options count, even if git ignores configure.json
+    subprocess.check_call(['git', 'init', '-q', posixpath.join(t.base, 'src')])
+    t.touch('.', '.gitignore', 'configure.json\n')
+    config = '{{"{0}": {{"general": {{"configuration": "{1}"}}}}}}'
+    t.touch('libd', 'configure.json', config.format(sys.platform, 'release'))
+    t.walk('--artifact-cache', 'build')
+    t.clear_log()
+    t.walk('--artifact-cache', 'build')
+    assert t.started() == []
+    os.remove(posixpath.join(t.path('libd'), 'configure.json'))
+    t.touch('libd', 'configure.json', config.format(sys.platform, 'debug'))
+    t.walk('--artifact-cache', 'build')
+    assert sorted(t.started()) == ['app', 'libd']
+
+def test_artifact_cache_without_walker():
+    # the walker uses the cache, not the other way round
+    env = dict(os.environ)
+    env['PYTHONPATH'] = posixpath.realpath('..')
+    assert subprocess.call([sys.executable, '-c', 'import sys, mirbuild.artifacts; sys.exit("mirbuild.walk" in sys.modules)'],
+                           env = env) == 0
+
+def test_artifact_cache_eviction():
+    from mirbuild.artifacts import ArtifactCache
+    base = tempfile.mkdtemp(prefix = 'mirbuild-walk-')
+    try:
+        cache = ArtifactCache(posixpath.join(base, 'cache'), max_size = 2500)
+        src = posixpath.join(base, 'src')
+        lib = posixpath.join(src, 'lib', 'lib.a')
+        os.makedirs(posixpath.dirname(lib))
+        for key in ['a', 'b', 'c']:
+            # replaced rather than written to, like linkers do
+            if os.path.exists(lib):
+                os.remove(lib)
+            open(lib, 'w').write(key * 1000)
+            assert cache.store(key, src, ['lib/lib.a']) == 1
+            if key == 'a':
+                # left over from an interrupted store
+                stray = posixpath.join(base, 'cache', 'objects', 'ff', 'f' * 40)
+                os.makedirs(posixpath.dirname(stray))
+                open(stray, 'w').write('x' * 100)
+            if key == 'b':
+                # the cache is only scanned once it is too big
+                assert os.path.exists(stray)
+                assert json.load(open(posixpath.join(base, 'cache', 'size.json')))['objects'] == 2000
+                # using a makes b the least recently used entry
+                assert cache.restore('a', src) == 1
+        assert not os.path.exists(stray)
+        assert json.load(open(posixpath.join(base, 'cache', 'size.json')))['objects'] == 2000
+        assert cache.restore('b', src) is None
+        assert cache.restore('a', src) == 1
+        assert open(lib).read() == 'a' * 1000
+        assert sorted(os.path.basename(f) for f in glob.glob(posixpath.join(base, 'cache', 'objects', '*', '*'))) == \
+               sorted(hashlib.sha1(k * 1000).hexdigest() for k in 'ac')
+        # corrupt objects are never restored
+        obj = glob.glob(posixpath.join(base, 'cache', 'objects', '*', hashlib.sha1('c' * 1000).hexdigest()))[0]
+        open(obj, 'w').write('x' * 1000)
+        assert cache.restore('c', src) is None
+        assert open(lib).read() == 'a' * 1000
+    finally:
+        shutil.rmtree(base, True)
+
+def test_shared_artifact_cache():
+    import urllib2
+    from mirbuild.artifacts import RemoteCache
+    shared = tempfile.mkdtemp(prefix = 'mirbuild-walk-')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = posixpath.realpath('..')
+    server = subprocess.Popen([sys.executable, '-m', 'mirbuild.artifactserver', '--port', '0', shared],
+                              stderr = subprocess.PIPE, env = env)
+    try:
+        url = re.search(r'listening on (\S+)', server.stderr.readline()).group(1)
+        trees = []
+        for i in range(2):
+            t = Tree(DEPS)
+            t.touch('liba', 'outputs', 'lib/liba.a bin/atool')
+            trees.append(t)
+        trees[0].walk('--artifact-server', url, 'build')
+        assert trees[0].exitcode == 0
+        assert sorted(trees[0].finished()) == sorted(DEPS)
+        assert len(glob.glob(posixpath.join(shared, 'entries', '*.json'))) == len(DEPS)
+        # another machine with an empty cache of its own only downloads the outputs
+        trees[1].walk('--artifact-server', url, 'build')
+        assert trees[1].exitcode == 0
+        assert trees[1].started() == []
+        assert open(posixpath.join(trees[1].path('liba'), 'lib', 'liba.a')).read() == 'lib/liba.a built by liba\n'
+        local = posixpath.join(trees[1].base, 'cache', 'mirbuild', 'artifacts')
+        assert len(glob.glob(posixpath.join(local, 'entries', '*.json'))) == len(DEPS)
+        # the server doesn't take objects that don't match their name
+        request = urllib2.Request(url + '/objects/' + hashlib.sha1('a').hexdigest(), 'b')
+        request.get_method = lambda: 'PUT'
+        with pytest.raises(urllib2.HTTPError) as ex:
+            urllib2.urlopen(request)
+        assert ex.value.code == 400
+        # nor does it replace entries that have been stored already
+        entry = glob.glob(posixpath.join(shared, 'entries', '*.json'))[0]
+        data = open(entry).read()
+        request = urllib2.Request(url + '/entries/' + posixpath.basename(entry)[:-5], '{}')
+        request.get_method = lambda: 'PUT'
+        with pytest.raises(urllib2.HTTPError) as ex:
+            urllib2.urlopen(request)
+        assert ex.value.code == 409
+        assert open(entry).read() == data
+        # objects it already has are the same files anyway
+        obj = glob.glob(posixpath.join(shared, 'objects', '*', '*'))[0]
+        request = urllib2.Request(url + '/objects/' + posixpath.basename(obj), open(obj, 'rb').read())
+        request.get_method = lambda: 'PUT'
+        assert urllib2.urlopen(request).getcode() == 201
+        # clients losing the race for an entry just leave the first one there
+        RemoteCache(url).put_entry(posixpath.basename(entry)[:-5], {})
+        assert open(entry).read() == data
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(shared, True)
@@ -11,3 +11,11 @@ alias doinstall='python build.py install'
 alias uninstall='python build.py install'
 alias package='python build.py package'
 alias coverage='python build.py coverage'
+
+# Same as above, but using a running build server (python -m mirbuild.server)
+# if there is one
+MIRBUILD_CLIENT="$(python -c 'import imp, os; print os.path.join(imp.find_module("mirbuild")[1], "client.py")')"
+alias sbuild='python "$MIRBUILD_CLIENT" build'
+alias sconfig='python "$MIRBUILD_CLIENT" configure'
+alias sutest='python "$MIRBUILD_CLIENT" test'
+alias swalk='python "$MIRBUILD_CLIENT" --walk'